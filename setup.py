@@ -144,6 +144,7 @@ scripts = [
     'bin/brainy-frames',
     'bin/brainy-project',
     'bin/brainy-web',
+    'bin/brainy-bench',
 ]
 
 # packages = [
@@ -274,6 +275,10 @@ setuptools.setup(
         'Twisted>=14.0.2',
         'DaemonCxt>=1.5.7',
     ],
+    extras_require={
+        # Event-driven wakeups of the daemon, see brainy.watcher
+        'inotify': ['pyinotify>=0.9.4'],
+    },
     cmdclass={
         'install': install,
     },
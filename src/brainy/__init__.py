@@ -69,6 +69,7 @@ DUTIES = {
             'run',
             'clean',
             'init',
+            'report',
         ],
         'subjectives': [
             'project',
@@ -77,6 +78,18 @@ DUTIES = {
         'description': 'Manage brainy projects: create new onces, '
                        'run existing.',
     },
+    'brainy-bench': {
+        'imperatives': [
+            'help',
+            'run',
+            'micro',
+        ],
+        'subjectives': [
+            'bench',
+            'benchmark',
+        ],
+        'description': 'Benchmark brainy overhead on synthetic projects.',
+    },
     'brainy-web': {
         'imperatives': [
             'help',
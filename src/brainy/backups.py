@@ -0,0 +1,464 @@
+'''
+brainy.backups
+
+Incremental snapshots of the BATCH folder in the style of rsync --link-dest.
+Every snapshot is a complete folder BACKUPS/BATCH_<timestamp>, but files that
+have not changed since the previous snapshot (same size, mtime and optionally
+sha1) are hardlinks into it. Only changed files are copied, by a pool of
+workers.
+
+A snapshot is built in a hidden `.partial-BATCH_<timestamp>` folder, which is
+renamed once all the files are in place. An interrupted backup is resumed by
+the next call: files already present in the partial folder are kept. Finally,
+the snapshot is described by `BATCH_<timestamp>.manifest.json` next to it.
+Snapshots without a manifest (e.g. made by plain copying) are never linked
+to.
+
+With dedup, files are also deduplicated by content across all the snapshots:
+every file is hashed (files are hashed in parallel, each one in chunks) and
+linked to its object in `BACKUPS/.objects/<sha1[:2]>/<sha1>`, which is copied
+only if not known yet. Objects no snapshot links to any more are removed by
+prune_snapshots(), which also implements retention (keep last N, daily and
+weekly snapshots).
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import json
+import errno
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from brainy.utils import get_timestamp_str
+from brainy.trash import remove_tree
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PREFIX = 'BATCH_'
+PARTIAL_PREFIX = '.partial-'
+MANIFEST_EXTENSION = '.manifest.json'
+OBJECTS_FOLDER = '.objects'
+SNAPSHOT_TIME_FORMAT = '%Y%m%d%H%M%S'
+DEFAULT_BACKUP_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, chunk_size=HASH_CHUNK_SIZE):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as stream:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_manifest_path(snapshot_path):
+    return snapshot_path + MANIFEST_EXTENSION
+
+
+def load_manifest(snapshot_path):
+    manifest_path = get_manifest_path(snapshot_path)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as stream:
+        return json.load(stream)
+
+
+def save_manifest(snapshot_path, manifest):
+    '''Write manifest atomically, it marks the snapshot as complete.'''
+    manifest_path = get_manifest_path(snapshot_path)
+    with open(manifest_path + '.tmp', 'w+') as stream:
+        json.dump(manifest, stream, indent=1, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def list_snapshots(backups_path):
+    '''Return paths of complete snapshots (having manifests), oldest first.'''
+    return [os.path.join(backups_path, name)
+            for name in sorted(os.listdir(backups_path))
+            if name.startswith(SNAPSHOT_PREFIX)
+            and os.path.isdir(os.path.join(backups_path, name))
+            and os.path.exists(get_manifest_path(
+                os.path.join(backups_path, name)))]
+
+
+def list_partial_snapshots(backups_path):
+    return [os.path.join(backups_path, name)
+            for name in sorted(os.listdir(backups_path))
+            if name.startswith(PARTIAL_PREFIX + SNAPSHOT_PREFIX)]
+
+
+def scan_folder(path):
+    '''
+    Walk the folder once. Return a list of relative folder names and a dict
+    of relative file names to their sizes and mtimes. Like `copytree`,
+    symlinks are followed.
+    '''
+    folders = list()
+    files = dict()
+    for root, dirnames, filenames in os.walk(path, followlinks=True):
+        relative_root = os.path.relpath(root, path)
+        if relative_root == '.':
+            relative_root = ''
+        for dirname in dirnames:
+            folders.append(os.path.join(relative_root, dirname))
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            files[os.path.join(relative_root, filename)] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+            }
+    return folders, files
+
+
+def parse_snapshot_time(snapshot_name):
+    try:
+        return datetime.strptime(snapshot_name[len(SNAPSHOT_PREFIX):],
+                                 SNAPSHOT_TIME_FORMAT)
+    except ValueError:
+        return None
+
+
+def is_same_file(path, other_path):
+    try:
+        return os.path.samefile(path, other_path)
+    except OSError:
+        return False
+
+
+def has_same_stat(path, entry):
+    try:
+        stat = os.stat(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+
+class ObjectStore(object):
+    '''
+    Content-addressed files shared by all the snapshots. Snapshots hardlink
+    to objects, so an object that has a single link is garbage.
+    '''
+
+    def __init__(self, backups_path):
+        self.path = os.path.join(backups_path, OBJECTS_FOLDER)
+
+    def get_object_path(self, sha1):
+        return os.path.join(self.path, sha1[:2], sha1)
+
+    def add(self, source_path, sha1):
+        '''
+        Copy the file into the store. Return False if it was known, also if
+        another worker has added the same object meanwhile.
+        '''
+        object_path = self.get_object_path(sha1)
+        if os.path.exists(object_path):
+            return False
+        folder = os.path.dirname(object_path)
+        try:
+            os.makedirs(folder)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        temp_path = '%s.%d.%d.tmp' % (object_path, os.getpid(),
+                                      threading.current_thread().ident)
+        shutil.copy2(source_path, temp_path)
+        # Unlike rename, link never replaces the object, which snapshots
+        # may be linking to already.
+        try:
+            os.link(temp_path, object_path)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+            return False
+        finally:
+            os.unlink(temp_path)
+        return True
+
+    def collect_garbage(self):
+        '''Remove objects that no snapshot links to. Return their number.'''
+        removed = 0
+        if not os.path.exists(self.path):
+            return removed
+        for root, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                object_path = os.path.join(root, filename)
+                # Leftovers of interrupted copying are garbage too.
+                if filename.endswith('.tmp') or \
+                        os.stat(object_path).st_nlink == 1:
+                    os.unlink(object_path)
+                    removed += 1
+        return removed
+
+
+class SnapshotProgress(object):
+    '''Thread-safe counters of the snapshot.'''
+
+    ACTIONS = ('linked', 'copied', 'deduplicated', 'resumed')
+
+    def __init__(self):
+        self.counts = dict((action, 0) for action in self.ACTIONS)
+        self.copied_bytes = 0
+        self.__lock = threading.Lock()
+
+    def add(self, action, size):
+        with self.__lock:
+            self.counts[action] += 1
+            if action == 'copied':
+                self.copied_bytes += size
+
+    def summarize(self):
+        summary = dict(self.counts)
+        summary['copied_bytes'] = self.copied_bytes
+        return summary
+
+
+class Snapshot(object):
+    '''
+    A single incremental snapshot of the data folder. Call make() to build
+    it, see make_snapshot().
+    '''
+
+    def __init__(self, data_path, backups_path, checksum=False, dedup=False,
+                 workers=DEFAULT_BACKUP_WORKERS):
+        self.data_path = data_path
+        self.backups_path = backups_path
+        # Deduplication is driven by the hashes.
+        self.checksum = checksum or dedup
+        self.dedup = dedup
+        self.store = ObjectStore(backups_path)
+        self.workers = workers
+        self.progress = SnapshotProgress()
+        self.previous_path = None
+        self.previous_files = dict()
+        snapshots = list_snapshots(backups_path)
+        if snapshots:
+            self.previous_path = snapshots[-1]
+            self.previous_files = load_manifest(self.previous_path)['files']
+
+    def is_unchanged(self, name, entry):
+        previous_entry = self.previous_files.get(name)
+        if previous_entry is None or \
+                previous_entry['size'] != entry['size'] or \
+                previous_entry['mtime'] != entry['mtime']:
+            return False
+        if self.checksum:
+            if 'sha1' not in previous_entry:
+                # Previous snapshot was made without checksums.
+                previous_entry['sha1'] = hash_file(
+                    os.path.join(self.previous_path, name))
+            return previous_entry['sha1'] == entry['sha1']
+        return True
+
+    def backup_file(self, partial_path, name, entry):
+        source_path = os.path.join(self.data_path, name)
+        target_path = os.path.join(partial_path, name)
+        if self.checksum:
+            entry['sha1'] = hash_file(source_path)
+        if self.is_unchanged(name, entry):
+            previous_path = os.path.join(self.previous_path, name)
+            if is_same_file(previous_path, target_path):
+                # Linked by the interrupted run.
+                return self.progress.add('resumed', entry['size'])
+            # Anything else (e.g. a copy) is linked again.
+            self.remove(target_path)
+            try:
+                os.link(previous_path, target_path)
+                return self.progress.add('linked', entry['size'])
+            except OSError as error:
+                # E.g. too many links or previous snapshot was moved to
+                # another file system.
+                logger.warn('Failed to link %s, copying it instead: %s' %
+                            (name, error))
+        elif self.is_resumed(name, entry, target_path):
+            return self.progress.add('resumed', entry['size'])
+        # Never write through a hardlink, it is shared with older snapshots.
+        self.remove(target_path)
+        if self.dedup:
+            try:
+                return self.link_object(source_path, target_path, entry)
+            except OSError as error:
+                logger.warn('Failed to deduplicate %s, copying it instead: '
+                            '%s' % (name, error))
+                self.remove(target_path)
+        shutil.copy2(source_path, target_path)
+        self.progress.add('copied', entry['size'])
+
+    def link_object(self, source_path, target_path, entry):
+        if self.store.add(source_path, entry['sha1']):
+            self.progress.add('copied', entry['size'])
+        else:
+            self.progress.add('deduplicated', entry['size'])
+        os.link(self.store.get_object_path(entry['sha1']), target_path)
+
+    def is_resumed(self, name, entry, target_path):
+        '''Check if the changed file was copied by the interrupted run.'''
+        if self.dedup:
+            return is_same_file(self.store.get_object_path(entry['sha1']),
+                                target_path)
+        # Note that copy2 sets mtime at the end.
+        return has_same_stat(target_path, entry) and \
+            not (name in self.previous_files and is_same_file(
+                os.path.join(self.previous_path, name), target_path))
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.unlink(path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+
+    def get_partial_path(self):
+        '''Resume the interrupted snapshot or start a new one.'''
+        partial_snapshots = list_partial_snapshots(self.backups_path)
+        if partial_snapshots:
+            logger.info('Resuming interrupted backup: %s' %
+                        partial_snapshots[-1])
+            return partial_snapshots[-1]
+        snapshot_name = SNAPSHOT_PREFIX + get_timestamp_str()
+        if os.path.exists(os.path.join(self.backups_path, snapshot_name)):
+            raise IOError('BACKUP destination already exists: %s' %
+                          os.path.join(self.backups_path, snapshot_name))
+        partial_path = os.path.join(self.backups_path,
+                                    PARTIAL_PREFIX + snapshot_name)
+        os.mkdir(partial_path)
+        return partial_path
+
+    def make(self):
+        '''Build the snapshot, return its path and the manifest.'''
+        partial_path = self.get_partial_path()
+        folders, files = scan_folder(self.data_path)
+        for folder in folders:
+            folder_path = os.path.join(partial_path, folder)
+            if not os.path.isdir(folder_path):
+                os.makedirs(folder_path)
+        pool = ThreadPool(max(1, self.workers))
+        try:
+            pool.map(lambda name: self.backup_file(partial_path, name,
+                                                   files[name]),
+                     sorted(files))
+        finally:
+            pool.close()
+            pool.join()
+        for folder in [''] + folders:
+            shutil.copystat(os.path.join(self.data_path, folder),
+                            os.path.join(partial_path, folder))
+        snapshot_path = os.path.join(
+            self.backups_path,
+            os.path.basename(partial_path)[len(PARTIAL_PREFIX):])
+        manifest = {
+            'source': self.data_path,
+            'previous': os.path.basename(self.previous_path)
+            if self.previous_path else None,
+            'checksum': self.checksum,
+            'dedup': self.dedup,
+            'files': files,
+            'summary': self.progress.summarize(),
+        }
+        # Manifest goes first: a crash before renaming leaves the partial
+        # snapshot, which is quickly resumed.
+        save_manifest(snapshot_path, manifest)
+        os.rename(partial_path, snapshot_path)
+        logger.info(('Backup %(snapshot)s: %(linked)d file(s) linked, '
+                     '%(copied)d copied (%(copied_bytes)d bytes), '
+                     '%(deduplicated)d deduplicated, %(resumed)d kept from '
+                     'the interrupted run.') % dict(
+                    snapshot=snapshot_path, **manifest['summary']))
+        return snapshot_path, manifest
+
+
+def make_snapshot(data_path, backups_path, checksum=False, dedup=False,
+                  workers=DEFAULT_BACKUP_WORKERS):
+    '''
+    Make an incremental snapshot of data_path inside of backups_path. With
+    checksum, unchanged files must also have the same sha1. With dedup,
+    changed files are linked to the objects of the same content. Return the
+    path of the snapshot.
+    '''
+    snapshot = Snapshot(data_path, backups_path, checksum=checksum,
+                        dedup=dedup, workers=workers)
+    return snapshot.make()[0]
+
+
+def describe_copy(data_path, snapshot_path):
+    '''Write manifest of the snapshot made by plain copying.'''
+    files = scan_folder(data_path)[1]
+    manifest = {
+        'source': data_path,
+        'previous': None,
+        'checksum': False,
+        'dedup': False,
+        'files': files,
+        'summary': {'copied': len(files), 'copied_bytes': sum(
+            entry['size'] for entry in files.values())},
+    }
+    save_manifest(snapshot_path, manifest)
+    return manifest
+
+
+def select_snapshots_to_keep(snapshot_names, keep_last=0, keep_daily=0,
+                             keep_weekly=0):
+    '''
+    Return names of the last `keep_last` snapshots plus the newest snapshot
+    of each of the last `keep_daily` days and `keep_weekly` weeks that have
+    any snapshots. Snapshots named in unknown format are always kept.
+    '''
+    newest_first = sorted(snapshot_names, reverse=True)
+    keep = set(newest_first[:keep_last])
+    keep.update(name for name in newest_first
+                if parse_snapshot_time(name) is None)
+    periods = (
+        (keep_daily, lambda time: time.date()),
+        (keep_weekly, lambda time: time.isocalendar()[:2]),
+    )
+    for count, get_period in periods:
+        seen = set()
+        for name in newest_first:
+            if len(seen) >= count:
+                break
+            time = parse_snapshot_time(name)
+            if time is None or get_period(time) in seen:
+                continue
+            seen.add(get_period(time))
+            keep.add(name)
+    return keep
+
+
+def prune_snapshots(backups_path, keep_last=0, keep_daily=0, keep_weekly=0):
+    '''
+    Remove snapshots beyond retention, then objects no snapshot links to.
+    Nothing is removed unless some retention is set. Return names of the
+    removed snapshots.
+    '''
+    if not (keep_last or keep_daily or keep_weekly):
+        return []
+    snapshot_names = [name for name in os.listdir(backups_path)
+                      if name.startswith(SNAPSHOT_PREFIX) and
+                      os.path.isdir(os.path.join(backups_path, name))]
+    keep = select_snapshots_to_keep(snapshot_names, keep_last=keep_last,
+                                    keep_daily=keep_daily,
+                                    keep_weekly=keep_weekly)
+    removed = list()
+    for name in sorted(set(snapshot_names) - keep):
+        snapshot_path = os.path.join(backups_path, name)
+        logger.info('Pruning backup: %s' % snapshot_path)
+        # Without manifest, the snapshot is never linked to again.
+        manifest_path = get_manifest_path(snapshot_path)
+        if os.path.exists(manifest_path):
+            os.unlink(manifest_path)
+        remove_tree(snapshot_path)
+        removed.append(name)
+    collected = ObjectStore(backups_path).collect_garbage()
+    if collected:
+        logger.info('Removed %d unused backup object(s).' % collected)
+    return removed
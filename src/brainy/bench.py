@@ -0,0 +1,312 @@
+'''
+brainy.bench
+
+End-to-end benchmark of brainy's own overhead. Synthetic projects are
+generated for every combination of the scenario matrix:
+
+ - pipes: number of pipes in the sequence
+ - processes: number of steps per pipe
+ - foreach: number of values of the foreach loop of each step (0 is none)
+ - job_reports: number of job reports per step
+ - flags: state of every step before a tick: fresh, submitted or complete
+ - engine: shellcmd or lsf (fake LSF without slots, so that jobs stay
+   pending, see brainy.scheduler.fakelsf)
+
+Each tick is a single in-process run of the project, started from the same
+state. Measured are tick latency, CPU time, read/write syscalls (from
+/proc/self/io), spawned subprocesses and peak memory. Results are JSON, see
+`brainy bench run`.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import json
+import time
+import shutil
+import logging
+import resource
+import tempfile
+import itertools
+from datetime import datetime
+from brainy.version import brainy_version
+from brainy.config import write_project_config, load_brainy_config
+from brainy.log import json_handler
+from brainy.scheduler.fakelsf import FakeLsf
+logger = logging.getLogger(__name__)
+
+FLAG_STATES = ('fresh', 'submitted', 'complete')
+ENGINES = ('shellcmd', 'lsf')
+DEFAULT_MATRIX = {
+    'pipes': [1],
+    'processes': [1],
+    'foreach': [0],
+    'job_reports': [0],
+    'flags': ['fresh'],
+    'engine': ['shellcmd'],
+}
+MATRIX_KEYS = ('pipes', 'processes', 'foreach', 'job_reports', 'flags',
+               'engine')
+PROJECT_FILES = ('sequence', '.brainy')
+JOB_REPORT = '''Sender: LSF System <lsfadmin@bench>
+Subject: Job 1: <bench> Done
+
+Successfully completed.
+
+Resource usage summary:
+
+    CPU time   :      0.10 sec.
+'''
+
+
+class SpawnCounter(object):
+    '''
+    Count forks of this process, which covers both subprocess.Popen and sh
+    commands.
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.original_fork = None
+
+    def install(self):
+        self.original_fork = os.fork
+
+        def counting_fork():
+            self.count += 1
+            return self.original_fork()
+
+        os.fork = counting_fork
+
+    def uninstall(self):
+        if self.original_fork is not None:
+            os.fork = self.original_fork
+            self.original_fork = None
+
+
+def read_proc_io():
+    '''Return I/O counters of this process or an empty dict (not Linux).'''
+    try:
+        with open('/proc/self/io') as stream:
+            return dict((key, int(value)) for key, value in
+                        (line.split(':') for line in stream if ':' in line))
+    except IOError:
+        return dict()
+
+
+def reset_peak_memory():
+    '''Reset VmHWM of this process. Return False if not supported.'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as stream:
+            stream.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def read_peak_memory(is_reset):
+    '''Return peak resident memory in KB, since reset if possible.'''
+    if is_reset:
+        try:
+            with open('/proc/self/status') as stream:
+                for line in stream:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        except IOError:
+            pass
+    # Linux reports KB. This is a peak over the whole process lifetime.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class SyntheticProject(object):
+
+    def __init__(self, root_path, pipes=1, processes=1, foreach=0,
+                 job_reports=0, flags='fresh', engine='shellcmd',
+                 name='bench_project'):
+        if flags not in FLAG_STATES:
+            raise Exception('Unknown flag state: %s' % flags)
+        if engine not in ENGINES:
+            raise Exception('Unknown engine: %s' % engine)
+        self.name = name
+        self.path = os.path.join(root_path, name)
+        self.pipes = pipes
+        self.processes = processes
+        self.foreach = foreach
+        self.job_reports = job_reports
+        self.flags = flags
+        self.engine = engine
+
+    @property
+    def pipe_names(self):
+        return ['pipe_%d' % index for index in range(1, self.pipes + 1)]
+
+    @property
+    def step_names(self):
+        return ['step_%d' % index for index in range(1, self.processes + 1)]
+
+    def make_pipe_definition(self):
+        chain = list()
+        for step_name in self.step_names:
+            step = {
+                'type': 'CustomCode.BashCall',
+                'name': step_name,
+                'call': 'echo %s' % step_name,
+            }
+            if self.foreach:
+                step['call'] = 'echo %s {item}' % step_name
+                step['foreach'] = {
+                    'var': 'item',
+                    'in': json.dumps(range(self.foreach)),
+                }
+            chain.append(step)
+        return {'type': 'CustomCode.CustomPipe', 'chain': chain}
+
+    def create(self):
+        os.makedirs(self.path)
+        write_project_config(self.path, override_config={
+            'scheduling': {'engine': self.engine},
+            # Every tick must do the work.
+            'brainy': {'skip_unchanged_runs': False},
+        })
+        definition = json.dumps(self.make_pipe_definition(), indent=2)
+        for pipe_name in self.pipe_names:
+            with open(os.path.join(self.path, pipe_name + '.br'),
+                      'w+') as stream:
+                stream.write(definition)
+        with open(os.path.join(self.path, 'sequence'), 'w+') as stream:
+            stream.write('\n'.join(name + '.br' for name in self.pipe_names))
+        self.reset_state()
+        return self
+
+    def reset_state(self):
+        '''Remove output of the previous tick and lay down the scenario.'''
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if os.path.isdir(path) and name not in PROJECT_FILES:
+                shutil.rmtree(path)
+        for pipe_name in self.pipe_names:
+            pipe_path = os.path.join(self.path, pipe_name)
+            os.makedirs(pipe_path)
+            for step_name in self.step_names:
+                reports_path = os.path.join(pipe_path,
+                                            'job_reports_of_' + step_name)
+                os.makedirs(reports_path)
+                for index in range(self.job_reports):
+                    report_filepath = os.path.join(
+                        reports_path, '%s_%012d.job_report' %
+                        (step_name, index))
+                    with open(report_filepath, 'w+') as stream:
+                        stream.write(JOB_REPORT)
+                if self.flags != 'fresh':
+                    flag_path = os.path.join(pipe_path, '%s.%s' % (
+                        step_name, self.flags))
+                    open(flag_path, 'w+').close()
+
+
+def measure_tick(project, spawn_counter):
+    # Import here to avoid circular imports.
+    from brainy.project.base import BrainyProject
+    brainy_project = BrainyProject(project.name, project.path)
+    # Settings of the scenario must win over the user config.
+    brainy_config = load_brainy_config()
+    brainy_config['scheduling']['engine'] = project.engine
+    brainy_config['brainy']['skip_unchanged_runs'] = False
+    # Every tick starts with a fresh log, like in-process daemon runs do.
+    json_handler.reset_output()
+    is_reset = reset_peak_memory()
+    io_before = read_proc_io()
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    spawns_before = spawn_counter.count
+    started_at = time.time()
+    brainy_project.run(brainy_config=brainy_config)
+    latency = time.time() - started_at
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_after = read_proc_io()
+    return {
+        'latency_seconds': latency,
+        'cpu_seconds': (usage.ru_utime - usage_before.ru_utime) +
+        (usage.ru_stime - usage_before.ru_stime),
+        'children_cpu_seconds':
+        (children.ru_utime - children_before.ru_utime) +
+        (children.ru_stime - children_before.ru_stime),
+        'read_syscalls': io_after.get('syscr', 0) - io_before.get('syscr', 0)
+        if io_after else None,
+        'write_syscalls': io_after.get('syscw', 0) -
+        io_before.get('syscw', 0) if io_after else None,
+        'context_switches': (usage.ru_nvcsw - usage_before.ru_nvcsw) +
+        (usage.ru_nivcsw - usage_before.ru_nivcsw),
+        'subprocess_spawns': spawn_counter.count - spawns_before,
+        'peak_rss_kb': read_peak_memory(is_reset),
+    }
+
+
+def summarize_ticks(ticks):
+    summary = dict()
+    for key in ticks[0]:
+        values = sorted(tick[key] for tick in ticks
+                        if tick[key] is not None)
+        if not values:
+            summary[key] = None
+            continue
+        summary[key] = {
+            'min': values[0],
+            'median': values[len(values) // 2],
+            'mean': sum(values) / float(len(values)),
+            'max': values[-1],
+        }
+    return summary
+
+
+def run_scenario(scenario, ticks=5, warmup=1, root_path=None):
+    '''Generate a project for the scenario and measure its ticks.'''
+    root_path = tempfile.mkdtemp(dir=root_path, prefix='brainy_bench_')
+    project = SyntheticProject(root_path, **scenario).create()
+    # No slots: submitted jobs never run, so every tick starts the same.
+    fake_lsf = FakeLsf(os.path.join(root_path, 'lsf'), slots=0)
+    spawn_counter = SpawnCounter()
+    if project.engine == 'lsf':
+        fake_lsf.install()
+    spawn_counter.install()
+    measured = list()
+    try:
+        for index in range(warmup + ticks):
+            project.reset_state()
+            fake_lsf.reset()
+            tick = measure_tick(project, spawn_counter)
+            if index >= warmup:
+                measured.append(tick)
+    finally:
+        spawn_counter.uninstall()
+        fake_lsf.uninstall()
+        shutil.rmtree(root_path, ignore_errors=True)
+    return {
+        'scenario': scenario,
+        'ticks': measured,
+        'summary': summarize_ticks(measured),
+    }
+
+
+def iter_scenarios(matrix):
+    '''Yield every combination of the matrix, see DEFAULT_MATRIX.'''
+    values = [matrix.get(key, DEFAULT_MATRIX[key]) for key in MATRIX_KEYS]
+    for combination in itertools.product(*values):
+        yield dict(zip(MATRIX_KEYS, combination))
+
+
+def run_benchmark(matrix=DEFAULT_MATRIX, ticks=5, warmup=1, root_path=None):
+    results = {
+        'brainy_version': brainy_version,
+        'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'ticks': ticks,
+        'warmup': warmup,
+        'scenarios': list(),
+    }
+    for scenario in iter_scenarios(matrix):
+        logger.info('Benchmarking scenario: %s' % json.dumps(scenario))
+        results['scenarios'].append(run_scenario(
+            scenario, ticks=ticks, warmup=warmup, root_path=root_path))
+    return results
@@ -12,8 +12,10 @@ Save and load configuration files.
 Copyright (c) 2014-2015 Pelkmans Lab
 '''
 import os
-from getpass import getuser
+import hashlib
 import logging
+import cPickle as pickle
+from getpass import getuser
 from brainy.version import brainy_version
 from brainy.utils import (merge_dicts, load_yaml, dump_yaml,
                           replace_template_params)
@@ -65,10 +67,63 @@ brainy:
   # iBRAIN is a framework_name iBRAIN will look for by default.
   default_framework: 'iBRAIN'
 
+  # Skip `brainy project run` if flags, job reports, workflow files and
+  # states of the project jobs are the same as after the last run that has
+  # changed nothing. Still run at least once in that many seconds. Meant for
+  # projects run by the daemon, since a skipped run does nothing at all.
+  skip_unchanged_runs: false
+  unchanged_run_max_age: 3600
+
 # Which scheduling API to use by default?
 scheduling:
   # Possible choices are: {'shellcmd', 'lsf', 'slurm'}
   engine: 'shellcmd'
+  # Project runs started by the daemon reuse its listing of cluster jobs
+  # (e.g. `bjobs -aw`) if it is not older than that many seconds.
+  snapshot_ttl: 60
+
+# Run reports of `brainy project run`.
+reports:
+  # Either 'yaml' (report is kept in memory and dumped at the end of the run)
+  # or 'jsonl' (report events are appended to disk as they happen, so memory
+  # stays constant and a crash does not lose the report).
+  backend: 'yaml'
+  # Rebuild YAML report out of 'jsonl' events for the web UI.
+  materialize_yaml: true
+  # Keep only that many last run reports. Older ones are compressed into
+  # daily archives inside reports/archive. Zero keeps every report.
+  keep_last: 0
+  # Regenerate the report listing of the web UI at most once in that many
+  # seconds. Zero regenerates it after every run.
+  index_update_interval: 0
+  # Symlink shared web UI assets into projects instead of copying them.
+  link_assets: true
+  # Index reports and their messages into reports/reports.sqlite. See
+  # `brainy project report --query`.
+  sqlite_index: true
+  # Also index into user-wide ~/.brainy/reports.sqlite
+  global_index: false
+  # Time phases of every step (job listing, data and log checks, template
+  # compilation, submission) into the `timings` section of the report.
+  timings: false
+  # Optionally dump timings next to the report: 'csv' or 'json'.
+  timings_dump: ''
+  # Record pipes, steps, state decisions, scheduler calls and subprocesses
+  # of the run as a timeline next to the report (Chrome trace-event JSON,
+  # open with chrome://tracing or https://ui.perfetto.dev).
+  trace: false
+  # Keep at most that many MB of the run log in memory. Older log records
+  # are spilled into a gzipped JSON lines file next to the report, which is
+  # referenced as `log_spill`. Zero keeps the whole log in memory.
+  log_max_mb: 32
+
+# Profiles of `brainy project run --profile` (and sampled daemon ticks) saved
+# into reports/profiles of the project.
+profiling:
+  # Keep only that many last profiles. Zero keeps every profile.
+  keep_last: 20
+  # Number of functions listed in text summaries.
+  limit: 40
 
 # Preliminary programming languages. Note that each `path` entry
 # for a corresponding language is a setting that brainy prependeds
@@ -99,6 +154,9 @@ project_parameters:
 
 BRAINY_USER_CONFIG_PATH = os.path.expanduser('~/.brainy/config')
 
+# Merged configs are cached here, see ConfigCache.
+BRAINY_CONFIG_CACHE_PATH = os.path.expanduser('~/.brainy/cache/config')
+
 BRAINY_USER_PACKAGES_INDEX_PATH_TPL = os.path.expanduser(
     '~/.brainy/%(framework_name)s.packages_index')
 
@@ -259,25 +317,186 @@ def load_packages_index(framework_name):
         return load_yaml(stream.read())
 
 
-def load_brainy_config():
+def get_framework_config_path(framework):
+    # Such path formation might change in the future.
+    return os.path.expanduser('~/%s/config.yaml' % framework)
+
+
+class ConfigCache(object):
+    '''
+    Cache of merged configs. Every entry remembers pathnames of all the files
+    that contributed to it, together with their mtimes, sizes and hashes. An
+    entry is valid as long as none of these files has changed (or appeared).
+    Files are hashed only if their mtime or size has changed, so a cache hit
+    costs a stat per file.
+
+    Entries are kept pickled both in memory (warm daemon) and on disk (warm
+    CLI). Unpickling returns a fresh copy, so callers are free to modify it.
     '''
-    Merge user-wide config and every framework config.
 
-    This does not include project specific or workflow (pipe specific)
-    settings.
+    def __init__(self, cache_path=BRAINY_CONFIG_CACHE_PATH):
+        self.cache_path = cache_path
+        self.memory = dict()
+
+    @staticmethod
+    def hash_file(config_path):
+        with open(config_path, 'rb') as stream:
+            return hashlib.sha1(stream.read()).hexdigest()
+
+    @classmethod
+    def get_signature(cls, config_paths):
+        signature = list()
+        for config_path in config_paths:
+            try:
+                stat = os.stat(config_path)
+            except OSError:
+                # Missing file is a part of the key too.
+                signature.append((config_path, None))
+                continue
+            signature.append((config_path, stat.st_mtime, stat.st_size,
+                              cls.hash_file(config_path)))
+        return signature
+
+    def refresh_signature(self, signature):
+        '''
+        Return the signature updated with new mtimes of files which were
+        touched, but kept their content. Return None if any file has changed,
+        appeared or disappeared.
+        '''
+        refreshed = list()
+        for entry in signature:
+            config_path = entry[0]
+            try:
+                stat = os.stat(config_path)
+            except OSError:
+                if entry[1] is not None:
+                    return None
+                refreshed.append(entry)
+                continue
+            if entry[1] is None:
+                return None
+            if (stat.st_mtime, stat.st_size) == entry[1:3]:
+                refreshed.append(entry)
+                continue
+            digest = self.hash_file(config_path)
+            if stat.st_size != entry[2] or digest != entry[3]:
+                return None
+            refreshed.append((config_path, stat.st_mtime, stat.st_size,
+                              digest))
+        return refreshed
+
+    def get_cache_filepath(self, name):
+        return os.path.join(self.cache_path,
+                            hashlib.sha1(name).hexdigest() + '.pickle')
+
+    def lookup(self, name):
+        '''Return (config_paths, signature, pickled config) or None'''
+        if name in self.memory:
+            return self.memory[name]
+        cache_filepath = self.get_cache_filepath(name)
+        if not os.path.exists(cache_filepath):
+            return None
+        try:
+            with open(cache_filepath, 'rb') as stream:
+                entry = pickle.load(stream)
+        except Exception as error:
+            logger.warn('Ignoring broken config cache %s: %s' %
+                        (cache_filepath, error))
+            return None
+        self.memory[name] = entry
+        return entry
+
+    def store(self, name, config_paths, signature, config):
+        entry = (config_paths, signature,
+                 pickle.dumps(config, pickle.HIGHEST_PROTOCOL))
+        self.memory[name] = entry
+        try:
+            if not os.path.exists(self.cache_path):
+                os.makedirs(self.cache_path)
+            cache_filepath = self.get_cache_filepath(name)
+            # Write atomically, since other brainy processes may read it.
+            with open(cache_filepath + '.tmp', 'wb') as stream:
+                pickle.dump(entry, stream, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_filepath + '.tmp', cache_filepath)
+        except (IOError, OSError) as error:
+            logger.warn('Failed to write config cache: %s' % error)
+
+    def load(self, name, build):
+        '''
+        Return cached config called `name`, or call build() which must return
+        a tuple of (config_paths, config) and cache the result.
+        '''
+        entry = self.lookup(name)
+        if entry is not None:
+            config_paths, signature, data = entry
+            refreshed = self.refresh_signature(signature)
+            if refreshed is not None:
+                logger.debug('Using cached config: %s' % name)
+                if refreshed != signature:
+                    # Do not hash touched files again.
+                    self.memory[name] = (config_paths, refreshed, data)
+                return pickle.loads(data)
+        config_paths, config = build()
+        self.store(name, config_paths, self.get_signature(config_paths),
+                   config)
+        return config
+
+    def clear(self):
+        self.memory.clear()
+        if not os.path.exists(self.cache_path):
+            return
+        for filename in os.listdir(self.cache_path):
+            os.unlink(os.path.join(self.cache_path, filename))
+
+
+config_cache = ConfigCache()
+
+
+def build_brainy_config():
+    '''
+    Merge user-wide config and every framework config. Return pathnames of
+    all the (possibly missing) contributing config files and the config.
     '''
     config = load_user_config()
     # For now we merge only one framework.
     frameworks = [config['brainy']['default_framework']]
+    config_paths = [BRAINY_USER_CONFIG_PATH]
     configs = [config]
     for framework in frameworks:
-        # Such path formation might change in the future.
-        framework_config_path = os.path.expanduser('~/%s/config.yaml' %
-                                                   framework)
+        framework_config_path = get_framework_config_path(framework)
+        config_paths.append(framework_config_path)
         if not os.path.exists(framework_config_path):
             continue
         logger.info('Merging config: %s' % framework_config_path)
         configs.append(load_config(framework_config_path))
     if len(configs) > 1:
-        return merge_config(*configs)
-    return config
+        return config_paths, merge_config(*configs)
+    return config_paths, config
+
+
+def load_brainy_config(use_cache=True):
+    '''
+    Merge user-wide config and every framework config.
+
+    This does not include project specific or workflow (pipe specific)
+    settings.
+    '''
+    if not use_cache:
+        return build_brainy_config()[1]
+    return config_cache.load('brainy', build_brainy_config)
+
+
+def load_merged_project_config(project_path,
+                               config_name=BRAINY_PROJECT_CONFIG_NAME):
+    '''
+    Return brainy config overridden by the project config. The merged result
+    is cached per project, see ConfigCache.
+    '''
+    def build_merged_config():
+        config_paths, brainy_config = build_brainy_config()
+        config_paths.append(os.path.join(project_path, config_name))
+        project_config = load_project_config(project_path, config_name)
+        return config_paths, merge_dicts(brainy_config, project_config)
+
+    return config_cache.load('project:' + os.path.abspath(project_path),
+                             build_merged_config)
@@ -16,6 +16,12 @@ import time
 import logging
 import ConfigParser
 from brainy.project.manager import ProjectManager
+from brainy.watcher import build_watcher
+from brainy.project.schedule import ProjectSchedule
+from brainy.metrics import metrics, MetricsServer
+from brainy.fs import accounting as fs_accounting
+from brainy.memory import MemoryMonitor
+from brainy.log import json_handler
 
 logger = logging.getLogger(__name__)
 
@@ -32,10 +38,16 @@ class BrainyApp(object):
         project_list_path = os.path.join(BRAINY_USER_PATH, 'project_list.yaml')
         self.project_manager = ProjectManager(project_list_path)
 
-    def step(self):
-        '''A single step of actual work, done by daemon'''
+    def step(self, only_paths=None):
+        '''
+        A single step of actual work, done by daemon. If only_paths is given,
+        only these projects are run.
+        '''
         self.project_manager.build_projects()
-        self.project_manager.run_projects()
+        self.run_projects(only_paths=only_paths)
+
+    def run_projects(self, only_paths=None):
+        self.project_manager.run_projects(only_paths=only_paths)
 
 
 class BrainyDaemonApp(BrainyApp):
@@ -50,6 +62,8 @@ class BrainyDaemonApp(BrainyApp):
     def __init__(self, name, config_vars, debug=True):
         self.name = name
         self.debug = debug
+        self.ticks = 0
+        self.memory_monitor = None
         self.config_name = config_vars.get('config_name')
         self.brainy_user_path = config_vars.get('brainy_user_path')
         self.config = ConfigParser.ConfigParser(defaults=config_vars)
@@ -76,6 +90,54 @@ class BrainyDaemonApp(BrainyApp):
                         '%(brainy_user_path)s/' + self.name + '.pid')
         self.config.set('daemon', 'pidfile_timeout', '5')
         self.config.set('daemon', 'sleeping_pause', '10')
+        # Detach sweepers to delete output of cleaned projects.
+        self.config.set('daemon', 'sweep_trash', 'yes')
+        self.config.set('daemon', 'sweep_workers', '4')
+        # Regenerate deferred report listings at most once in x seconds.
+        self.config.set('daemon', 'report_index_interval', '60')
+        # Run projects inside the daemon on a pool of worker threads instead
+        # of forking `brainy project run` for each one of them. Projects are
+        # not isolated then: e.g. sys.path extended by the user code of one
+        # project is seen by the others.
+        self.config.set('daemon', 'run_in_process', 'no')
+        self.config.set('daemon', 'project_workers', '4')
+        # Stop waiting for in-process runs taking longer than x seconds and
+        # leave them running in background (0 waits for at most an hour).
+        self.config.set('daemon', 'project_timeout', '0')
+        # Query the scheduler (e.g. bjobs) once per tick for all projects.
+        self.config.set('daemon', 'share_scheduler_snapshot', 'yes')
+        # Wake up on changes inside projects: auto, inotify, polling or no
+        # (fixed sleeping_pause). Polling works on NFS, inotify does not, so
+        # auto uses inotify only if all the projects are on local disks.
+        self.config.set('daemon', 'watch', 'auto')
+        self.config.set('daemon', 'watch_poll_interval', '2')
+        # Run all the projects at least once in x seconds.
+        self.config.set('daemon', 'max_idle_interval', '300')
+        # Poll projects that do not change less often: from min to max
+        # interval (in seconds), multiplying it by factor after each idle run.
+        # Complete projects are not run until they change.
+        self.config.set('daemon', 'adaptive_polling', 'yes')
+        self.config.set('daemon', 'polling_min_interval', '10')
+        self.config.set('daemon', 'polling_max_interval', '3600')
+        self.config.set('daemon', 'polling_backoff_factor', '2')
+        self.config.set('daemon', 'schedule_path',
+                        '%(brainy_user_path)s/project_schedule.yaml')
+        # Expose metrics in Prometheus text format on a local port (0 is
+        # disabled) and/or in a file for the node_exporter textfile
+        # collector (empty is disabled).
+        self.config.set('daemon', 'metrics_port', '0')
+        self.config.set('daemon', 'metrics_host', '127.0.0.1')
+        self.config.set('daemon', 'metrics_textfile', '')
+        # Profile project runs of every n-th tick into reports/profiles of
+        # each project (0 is never). Measure wall-clock time including
+        # waiting for the scheduler and subprocesses instead of CPU time.
+        self.config.set('daemon', 'profile_every', '0')
+        self.config.set('daemon', 'profile_waits', 'no')
+        # Snapshot memory every n-th tick (0 is never), log the top x growth
+        # sites and warn if the daemon uses more than y MB (0 is never).
+        self.config.set('daemon', 'memory_monitor_every', '0')
+        self.config.set('daemon', 'memory_monitor_top', '10')
+        self.config.set('daemon', 'memory_warn_mb', '0')
 
     def load_config_file(self, config_name, config_dir):
         '''
@@ -138,7 +200,118 @@ class BrainyDaemonApp(BrainyApp):
         '''Part of DaemonRunner protocol'''
         return self.config.getint('daemon', 'pidfile_timeout')
 
+    def init_schedule(self):
+        if not self.config.getboolean('daemon', 'adaptive_polling'):
+            return
+        if self.project_manager.schedule is not None:
+            return
+        self.project_manager.schedule = ProjectSchedule(
+            self.config.get('daemon', 'schedule_path'),
+            min_interval=self.config.getint('daemon', 'polling_min_interval'),
+            max_interval=self.config.getint('daemon', 'polling_max_interval'),
+            backoff_factor=self.config.getint('daemon',
+                                              'polling_backoff_factor'))
+
+    @property
+    def profile_waits(self):
+        '''Return None unless runs of the current tick are profiled.'''
+        profile_every = self.config.getint('daemon', 'profile_every')
+        if not profile_every or self.ticks % profile_every:
+            return None
+        return self.config.getboolean('daemon', 'profile_waits')
+
+    def run_projects(self, only_paths=None):
+        # Schedule is set up lazily, after daemon.conf was loaded.
+        self.init_schedule()
+        self.project_manager.run_projects(
+            in_process=self.config.getboolean('daemon', 'run_in_process'),
+            workers=self.config.getint('daemon', 'project_workers'),
+            timeout=self.config.getint('daemon', 'project_timeout'),
+            only_paths=only_paths,
+            share_scheduler_snapshot=self.config.getboolean(
+                'daemon', 'share_scheduler_snapshot'),
+            profile_waits=self.profile_waits)
+
+    def step(self, only_paths=None):
+        self.ticks += 1
+        with metrics.timer('brainy_daemon_tick_seconds'):
+            super(BrainyDaemonApp, self).step(only_paths=only_paths)
+        logger.info('Project runs so far: %d (%d skipped as unchanged)' % (
+                    metrics.get('brainy_project_runs_total'),
+                    metrics.get('brainy_project_runs_skipped_total')))
+        self.project_manager.flush_report_indexes(
+            deferred_interval=self.config.getint('daemon',
+                                                 'report_index_interval'))
+        if self.config.getboolean('daemon', 'sweep_trash'):
+            self.project_manager.sweep_trash(
+                workers=self.config.getint('daemon', 'sweep_workers'))
+        # Calls made by the daemon itself, e.g. taking a scheduler snapshot.
+        fs_accounting.flush()
+        # Logs of the daemon thread are never reported, do not keep them.
+        json_handler.reset_output()
+        self.check_memory()
+        metrics_textfile = self.config.get('daemon', 'metrics_textfile')
+        if metrics_textfile:
+            metrics.write_textfile(metrics_textfile)
+
+    def check_memory(self):
+        memory_monitor_every = self.config.getint('daemon',
+                                                  'memory_monitor_every')
+        if not memory_monitor_every or self.ticks % memory_monitor_every:
+            return None
+        if self.memory_monitor is None:
+            self.memory_monitor = MemoryMonitor(
+                top=self.config.getint('daemon', 'memory_monitor_top'),
+                warn_rss_mb=self.config.getint('daemon', 'memory_warn_mb'))
+        return self.memory_monitor.check(self.ticks)
+
+    def start_metrics_server(self):
+        metrics_port = self.config.getint('daemon', 'metrics_port')
+        if not metrics_port:
+            return None
+        return MetricsServer(
+            metrics_port,
+            host=self.config.get('daemon', 'metrics_host')).start()
+
+    def watch_and_run(self, watcher):
+        '''
+        Event-driven loop. Only changed projects are run, while all of them
+        are run at least once in max_idle_interval seconds.
+        '''
+        max_idle_interval = self.config.getint('daemon', 'max_idle_interval')
+        last_full_step = 0
+        while True:
+            idle = time.time() - last_full_step
+            if idle >= max_idle_interval:
+                # Changes made during the runs are noticed by the next wait.
+                watcher.rebase(watcher.project_paths)
+                self.step()
+                last_full_step = time.time()
+                # Pick up new projects.
+                watcher.watch([project['path'] for project
+                               in self.project_manager.projects])
+                continue
+            changed = watcher.wait(max_idle_interval - idle)
+            if not changed:
+                continue
+            logger.info('Changed projects: %s' % ', '.join(sorted(changed)))
+            watcher.rebase(changed)
+            self.step(only_paths=changed)
+
     def run(self):
+        self.start_metrics_server()
+        watch_mode = self.config.get('daemon', 'watch')
+        if watch_mode != 'no':
+            watcher = build_watcher(
+                watch_mode,
+                poll_interval=self.config.getint('daemon',
+                                                 'watch_poll_interval'),
+                project_paths=[project['path'] for project
+                               in self.project_manager.projects])
+            try:
+                self.watch_and_run(watcher)
+            finally:
+                watcher.close()
         sleeping_pause = self.config.getint('daemon', 'sleeping_pause')
         while True:
             self.step()
@@ -1,4 +1,5 @@
 import re
+from brainy import fs
 
 
 MAX_ERROR_MSG_SIZE = 1000
@@ -109,7 +110,8 @@ def check_for_known_error(text):
 
 
 def check_report_file_for_errors(report_filepath):
-    report_text = open(report_filepath).read()
+    with fs.open_file(report_filepath) as report_file:
+        report_text = report_file.read()
     try:
         check_for_known_error(report_text)
     except KnownError as error:
@@ -1,5 +1,5 @@
-import os
 from sh import touch
+from brainy import fs
 
 
 class FlagManager(object):
@@ -9,20 +9,20 @@ class FlagManager(object):
 
     @property
     def is_complete(self):
-        return os.path.exists('%s.complete' % self._get_flag_prefix())
+        return fs.exists('%s.complete' % self._get_flag_prefix())
 
     @property
     def is_submitted(self):
-        return os.path.exists('%s.submitted' % self._get_flag_prefix())
+        return fs.exists('%s.submitted' % self._get_flag_prefix())
 
     @property
     def is_resubmitted(self):
-        return os.path.exists('%s.submitted' % self._get_flag_prefix()) \
-            and os.path.exists('%s.resubmitted' % self._get_flag_prefix())
+        return fs.exists('%s.submitted' % self._get_flag_prefix()) \
+            and fs.exists('%s.resubmitted' % self._get_flag_prefix())
 
     @property
     def has_runlimit(self):
-        return os.path.exists('%s.runlimit' % self._get_flag_prefix())
+        return fs.exists('%s.runlimit' % self._get_flag_prefix())
 
     def reset_submitted(self):
         '''
@@ -46,6 +46,7 @@ class FlagManager(object):
 
     def set_flag(self, flag='submitted'):
         flag = '.'.join((self._get_flag_prefix(), flag))
+        fs.count_spawn('touch')
         touch(flag)
 
     def get_flag(self, flag='submitted'):
@@ -53,7 +54,7 @@ class FlagManager(object):
 
     def reset_flag(self, flag='submitted'):
         flag_path = self.get_flag(flag)
-        if not os.path.exists(flag_path):
+        if not fs.exists(flag_path):
             print('Failed to reset: "%s" flag not found.' % flag)
             return
-        os.remove(flag_path)
+        fs.unlink(flag_path)
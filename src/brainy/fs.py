@@ -0,0 +1,122 @@
+'''
+brainy.fs
+
+Central helpers for the filesystem calls and subprocess spawns that brainy
+makes while evaluating steps. Every call is counted per (pipe, step) of the
+current thread, so that the load brainy puts on (network) filesystems can be
+measured, e.g.
+
+    from brainy import fs
+    if fs.exists(flag_path):
+        ...
+
+Counts are summarized into the run report (see `fs_calls`) and flushed into
+the daemon metrics as brainy_fs_calls_total and
+brainy_subprocess_spawns_total.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import threading
+from brainy.tracing import tracer
+from brainy.metrics import metrics
+
+FS_CALL = 'fs'
+SPAWN = 'spawn'
+FS_CALLS_METRIC = 'brainy_fs_calls_total'
+SPAWNS_METRIC = 'brainy_subprocess_spawns_total'
+
+
+class FsAccounting(threading.local):
+
+    def __init__(self):
+        # (pipe, step, kind, name) -> count
+        self.counts = dict()
+        # Counts not yet flushed into metrics: (kind, name) -> count
+        self.unflushed = dict()
+
+    def start(self):
+        self.counts = dict()
+
+    def count(self, kind, name):
+        # Current step is known to the tracer, even if tracing is off.
+        key = (tracer.pipe, tracer.step, kind, name)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        key = (kind, name)
+        self.unflushed[key] = self.unflushed.get(key, 0) + 1
+
+    def flush(self, registry=metrics):
+        '''Add counts since the last flush to the metrics.'''
+        for (kind, name), amount in self.unflushed.items():
+            if kind == FS_CALL:
+                registry.inc(FS_CALLS_METRIC, amount, call=name)
+            else:
+                registry.inc(SPAWNS_METRIC, amount, command=name)
+        self.unflushed = dict()
+
+    def summarize(self):
+        '''Return counts per step and in total as plain dicts.'''
+        steps = list()
+        totals = {FS_CALL: dict(), SPAWN: dict()}
+        for (pipe, step, kind, name), count in \
+                sorted(self.counts.items(), key=lambda item: item[0]):
+            steps.append({
+                'pipe': pipe,
+                'step': step,
+                'kind': kind,
+                'name': name,
+                'count': count,
+            })
+            totals[kind][name] = totals[kind].get(name, 0) + count
+        return {'steps': steps, 'totals': totals}
+
+
+accounting = FsAccounting()
+
+
+def count_spawn(command):
+    '''Count a subprocess spawned by brainy, e.g. bsub or an sh call.'''
+    accounting.count(SPAWN, command)
+
+
+def exists(path):
+    accounting.count(FS_CALL, 'exists')
+    return os.path.exists(path)
+
+
+def stat(path):
+    accounting.count(FS_CALL, 'stat')
+    return os.stat(path)
+
+
+def lstat(path):
+    accounting.count(FS_CALL, 'lstat')
+    return os.lstat(path)
+
+
+def listdir(path):
+    accounting.count(FS_CALL, 'listdir')
+    return os.listdir(path)
+
+
+def open_file(path, mode='r'):
+    accounting.count(FS_CALL, 'open')
+    return open(path, mode)
+
+
+def unlink(path):
+    accounting.count(FS_CALL, 'unlink')
+    return os.unlink(path)
+
+
+def rename(source, destination):
+    accounting.count(FS_CALL, 'rename')
+    return os.rename(source, destination)
+
+
+def makedirs(path):
+    accounting.count(FS_CALL, 'makedirs')
+    return os.makedirs(path)
@@ -1,8 +1,28 @@
+import gzip
+import json
 import logging
 import atexit
-from tree_output.houtput import HierarchicalOutput
+import threading
+from pprint import pformat
+from tree_output.houtput import HierarchicalOutput, JsonOutput
 from tree_output.log_handler import HierarchicalOutputHandler
 LOGGING_OPTIONS = ('silent', 'console', 'json')
+LOG_SPILL_EXTENSION = '.log.jsonl.gz'
+
+
+class lazy_pformat(object):
+    '''
+    Pretty print value only when the record is emitted, e.g.
+    logger.debug('%s', lazy_pformat(parameters))
+    '''
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return pformat(self.value)
 
 
 def make_console_handler(level):
@@ -11,9 +31,110 @@ def make_console_handler(level):
     return console
 
 
+class BoundedJsonOutput(JsonOutput):
+    '''
+    JSON log kept in memory up to max_bytes of messages (zero is no limit).
+    Older records beyond that are spilled as JSON lines into a gzipped file,
+    or passed to spill_writer (e.g. streamed into the report) if given.
+    '''
+
+    def __init__(self, max_bytes=0, spill_filepath=None, spill_writer=None):
+        super(BoundedJsonOutput, self).__init__()
+        self.size = 0
+        self.spilled = 0
+        self.spill_stream = None
+        self.max_bytes = max_bytes
+        self.spill_filepath = spill_filepath
+        self.spill_writer = spill_writer
+
+    def set_limit(self, max_bytes, spill_filepath=None, spill_writer=None):
+        self.close_spill()
+        self.max_bytes = max_bytes
+        self.spill_filepath = spill_filepath
+        self.spill_writer = spill_writer
+        self.spill()
+
+    def emit(self, record, closed=False):
+        super(BoundedJsonOutput, self).emit(record, closed)
+        self.size += len(record)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.spill()
+
+    def spill(self):
+        if not self.max_bytes or \
+                not (self.spill_filepath or self.spill_writer):
+            return
+        # Spill down to 3/4 of the limit at once, since deleting from the
+        # head of the list is linear in its length.
+        target_size = self.max_bytes * 3 // 4
+        # Levels that are still open can not be spilled.
+        open_levels = set(id(data) for data in self.parents)
+        open_levels.add(id(self.data))
+        count = 0
+        for record in self.root:
+            if self.size <= target_size or id(record) in open_levels:
+                break
+            if self.spill_writer is not None:
+                self.spill_writer(record)
+            else:
+                if self.spill_stream is None:
+                    self.spill_stream = gzip.open(self.spill_filepath, 'ab')
+                self.spill_stream.write(json.dumps(record) + '\n')
+            self.size -= len(record)
+            count += 1
+        del self.root[:count]
+        self.spilled += count
+
+    def close_spill(self):
+        if self.spill_stream is not None:
+            self.spill_stream.close()
+            self.spill_stream = None
+
+
+class ThreadLocalOutputHandler(HierarchicalOutputHandler):
+    '''
+    Keeps a separate hierarchical output per thread, so that projects run
+    in-process by the daemon do not mix their logs in reports.
+    '''
+
+    def __init__(self, level=logging.NOTSET, format='json'):
+        logging.Handler.__init__(self, level)
+        self.format_name = format
+        self.local = threading.local()
+
+    @property
+    def houtput(self):
+        if not hasattr(self.local, 'houtput'):
+            self.reset_output()
+        return self.local.houtput
+
+    @houtput.setter
+    def houtput(self, value):
+        self.local.houtput = value
+
+    def reset_output(self):
+        '''Start a fresh log for the current thread.'''
+        if hasattr(self.local, 'houtput') and \
+                isinstance(self.local.houtput, BoundedJsonOutput):
+            self.local.houtput.close_spill()
+        if self.format_name == 'json':
+            self.local.houtput = BoundedJsonOutput()
+        else:
+            self.local.houtput = HierarchicalOutput.factory(
+                format=self.format_name)
+
+    def capture(self, max_bytes, spill_filepath=None, spill_writer=None):
+        '''
+        Keep at most max_bytes of the log of the current thread in memory and
+        spill older records into spill_filepath or spill_writer.
+        '''
+        if isinstance(self.houtput, BoundedJsonOutput):
+            self.houtput.set_limit(max_bytes, spill_filepath=spill_filepath,
+                                   spill_writer=spill_writer)
+
+
 def make_hierarchical_handler(format):
-    houtput = HierarchicalOutput.factory(format='json')
-    return HierarchicalOutputHandler(houtput=houtput)
+    return ThreadLocalOutputHandler(format=format)
 
 
 # We always need a json handler for project reports.
@@ -0,0 +1,168 @@
+'''
+brainy.memory
+
+Opt-in memory monitor of the long-running daemon. At tick boundaries it
+snapshots memory, logs the sites that have grown the most since the previous
+snapshot, keeps the trend of the resident memory (RSS) and warns once RSS is
+past the threshold. Numbers also go to the metrics (see brainy.metrics).
+
+Growth sites are source lines (file:line) if `tracemalloc` is available
+(Python 3.4+ or pytracemalloc). Otherwise, the monitor falls back to counting
+live objects by type with the gc module, which is coarser and slower.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import gc
+import logging
+import resource
+from collections import deque
+from brainy.metrics import metrics
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_SITES = 10
+DEFAULT_TREND_TICKS = 100
+DEFAULT_TRACE_FRAMES = 1
+
+
+def read_rss():
+    '''Return resident memory of this process in bytes.'''
+    try:
+        with open('/proc/self/status') as stream:
+            for line in stream:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    # Not Linux: peak instead of current memory, in KB.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_slope(points):
+    '''Least squares slope of (x, y) points, i.e. growth of y per x.'''
+    if len(points) < 2:
+        return 0.0
+    count = float(len(points))
+    mean_x = sum(x for x, y in points) / count
+    mean_y = sum(y for x, y in points) / count
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    if not variance:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+
+def count_objects_by_type():
+    counts = dict()
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+class MemoryMonitor(object):
+
+    def __init__(self, top=DEFAULT_TOP_SITES, warn_rss_mb=0,
+                 trend_ticks=DEFAULT_TREND_TICKS,
+                 frames=DEFAULT_TRACE_FRAMES, use_tracemalloc=True):
+        self.top = top
+        self.warn_rss_mb = warn_rss_mb
+        self.frames = frames
+        self.use_tracemalloc = use_tracemalloc and tracemalloc is not None
+        self.trend = deque(maxlen=trend_ticks)
+        self.previous = None
+        self.is_started = False
+
+    def start(self):
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.is_started = True
+        # Baseline to compare the first tick with.
+        self.previous = self.take_snapshot()
+        logger.info('Memory monitor is started (%s).' % (
+            'tracemalloc' if self.use_tracemalloc else 'gc object counts'))
+
+    def stop(self):
+        if self.use_tracemalloc and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.is_started = False
+        self.previous = None
+
+    def take_snapshot(self):
+        if self.use_tracemalloc:
+            return tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            ))
+        return count_objects_by_type()
+
+    def compare(self, snapshot):
+        '''Return the top growth sites since the previous snapshot.'''
+        if self.use_tracemalloc:
+            growth = [{
+                'site': str(stat.traceback[0]),
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+            } for stat in snapshot.compare_to(self.previous, 'lineno')
+                if stat.size_diff > 0]
+            return growth[:self.top]
+        growth = [{
+            'site': name,
+            'size_diff': None,
+            'count_diff': count - self.previous.get(name, 0),
+        } for name, count in snapshot.items()
+            if count > self.previous.get(name, 0)]
+        growth.sort(key=lambda site: site['count_diff'], reverse=True)
+        return growth[:self.top]
+
+    def check(self, tick):
+        '''Snapshot memory at the tick boundary. Return the summary.'''
+        if not self.is_started:
+            self.start()
+        rss = read_rss()
+        self.trend.append((tick, rss))
+        snapshot = self.take_snapshot()
+        growth = self.compare(snapshot)
+        self.previous = snapshot
+        summary = {
+            'tick': tick,
+            'rss_bytes': rss,
+            'rss_growth_bytes_per_tick': get_slope(self.trend),
+            'growth': growth,
+        }
+        if self.use_tracemalloc:
+            summary['traced_bytes'] = tracemalloc.get_traced_memory()[0]
+            metrics.set('brainy_daemon_traced_memory_bytes',
+                        summary['traced_bytes'])
+        metrics.set('brainy_daemon_rss_bytes', rss)
+        metrics.set('brainy_daemon_rss_growth_bytes_per_tick',
+                    summary['rss_growth_bytes_per_tick'])
+        self.log(summary)
+        return summary
+
+    def log(self, summary):
+        logger.info('Memory at tick %d: RSS %.1f MB, trend %+.1f KB/tick' % (
+            summary['tick'], summary['rss_bytes'] / 1048576.,
+            summary['rss_growth_bytes_per_tick'] / 1024.))
+        for site in summary['growth']:
+            if site['size_diff'] is None:
+                logger.info('  +%d objects of %s' % (site['count_diff'],
+                                                    site['site']))
+            else:
+                logger.info('  +%.1f KB (%+d blocks) at %s' % (
+                    site['size_diff'] / 1024., site['count_diff'],
+                    site['site']))
+        if self.warn_rss_mb and \
+                summary['rss_bytes'] > self.warn_rss_mb * 1048576:
+            metrics.inc('brainy_daemon_memory_warnings_total')
+            logger.warn(('Daemon uses %.1f MB of memory, more than %d MB. It '
+                         'keeps growing by %.1f KB per tick. Top growth: %s') %
+                        (summary['rss_bytes'] / 1048576., self.warn_rss_mb,
+                         summary['rss_growth_bytes_per_tick'] / 1024.,
+                         ', '.join(site['site']
+                                   for site in summary['growth'][:3])))
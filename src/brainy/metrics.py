@@ -0,0 +1,257 @@
+'''
+brainy.metrics
+
+Process-wide registry of daemon metrics: counters, gauges and histograms.
+Projects run in-process by the daemon (see brainy.project.manager) all count
+into the same registry, projects run in subprocesses pass their counters back
+to the daemon. Metrics are exposed in Prometheus text format, either
+by a local HTTP server (MetricsServer) or by a file for the textfile
+collector of node_exporter (write_textfile).
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+# Upper bounds of histogram buckets (seconds).
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900,
+                   float('inf'))
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metrics of brainy: name -> (type, help).
+METRICS = {
+    'brainy_daemon_tick_seconds': (
+        HISTOGRAM, 'Duration of a daemon tick.'),
+    'brainy_project_runs_total': (
+        COUNTER, 'Project runs.'),
+    'brainy_project_runs_skipped_total': (
+        COUNTER, 'Project runs skipped, since nothing has changed.'),
+    'brainy_project_run_seconds': (
+        HISTOGRAM, 'Duration of a project run.'),
+    'brainy_jobs_submitted_total': (
+        COUNTER, 'Jobs submitted to the scheduler.'),
+    'brainy_jobs_resubmitted_total': (
+        COUNTER, 'Jobs resubmitted to the scheduler.'),
+    'brainy_errors_total': (
+        COUNTER, 'Known and unknown errors reported by steps.'),
+    'brainy_scheduler_call_seconds': (
+        HISTOGRAM, 'Latency of calls to the scheduler.'),
+    'brainy_scheduler_jobs': (
+        GAUGE, 'Jobs known to the scheduler by state.'),
+    'brainy_fs_calls_total': (
+        COUNTER, 'Filesystem calls (exists, stat, listdir, open, unlink).'),
+    'brainy_subprocess_spawns_total': (
+        COUNTER, 'Subprocesses spawned, e.g. bsub, bjobs, touch, invoke.'),
+    'brainy_daemon_rss_bytes': (
+        GAUGE, 'Resident memory of the daemon.'),
+    'brainy_daemon_rss_growth_bytes_per_tick': (
+        GAUGE, 'Trend of the resident memory of the daemon.'),
+    'brainy_daemon_traced_memory_bytes': (
+        GAUGE, 'Memory traced by tracemalloc.'),
+    'brainy_daemon_memory_warnings_total': (
+        COUNTER, 'Ticks at which the daemon used too much memory.'),
+}
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def escape_label_value(value):
+    return unicode(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value))
+                             for name, value in labels)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+                # Counts are made cumulative only when rendered.
+                break
+
+
+class MetricsRegistry(object):
+    '''Thread-safe named counters, gauges and histograms with labels.'''
+
+    def __init__(self):
+        self.counters = dict()
+        self.gauges = dict()
+        self.histograms = dict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def make_key(name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name, amount=1, **labels):
+        key = self.make_key(name, labels)
+        with self.__lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.__lock:
+            self.gauges[self.make_key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.make_key(name, labels)
+        with self.__lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''Observe duration of the block in seconds.'''
+        started_at = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started_at, **labels)
+
+    def get(self, name, **labels):
+        key = self.make_key(name, labels)
+        if key in self.gauges:
+            return self.gauges[key]
+        if key in self.histograms:
+            return self.histograms[key].count
+        return self.counters.get(key, 0)
+
+    def collect(self):
+        '''Return a copy of {(name, labels): value} of counters and gauges.'''
+        with self.__lock:
+            values = dict(self.counters)
+            values.update(self.gauges)
+            return values
+
+    def dump_counters(self):
+        '''Return counters as a JSON-friendly [[name, labels, value]].'''
+        with self.__lock:
+            return [[name, dict(labels), value]
+                    for (name, labels), value in self.counters.items()]
+
+    def add_counters(self, counters):
+        '''Add counters dumped by another process, see dump_counters().'''
+        for name, labels, value in counters:
+            self.inc(name, value, **labels)
+
+    def reset(self):
+        with self.__lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+    def render(self):
+        '''Render all the metrics in Prometheus text exposition format.'''
+        samples = dict()
+        with self.__lock:
+            for (name, labels), value in self.counters.items() + \
+                    self.gauges.items():
+                samples.setdefault(name, []).append(
+                    '%s%s %s' % (name, format_labels(labels),
+                                 format_value(value)))
+            for (name, labels), histogram in self.histograms.items():
+                lines = samples.setdefault(name, [])
+                cumulative = 0
+                for upper_bound, count in zip(histogram.buckets,
+                                              histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name,
+                        format_labels(labels +
+                                      (('le', format_value(upper_bound)),)),
+                        cumulative))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              format_value(histogram.sum)))
+                lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                                histogram.count))
+        output = list()
+        for name in sorted(samples):
+            metric_type, help_text = METRICS.get(name, ('untyped', name))
+            output.append('# HELP %s %s' % (name, help_text))
+            output.append('# TYPE %s %s' % (name, metric_type))
+            output.extend(sorted(samples[name]))
+        return '\n'.join(output) + '\n'
+
+    def write_textfile(self, textfile_path):
+        '''Atomically write metrics for the node_exporter textfile collector.'''
+        with open(textfile_path + '.tmp', 'w+') as stream:
+            stream.write(self.render().encode('utf-8'))
+        os.rename(textfile_path + '.tmp', textfile_path)
+
+
+metrics = MetricsRegistry()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics scrape: ' + format % args)
+
+
+class MetricsServer(object):
+    '''Serve metrics over HTTP from a background thread.'''
+
+    def __init__(self, port, host='127.0.0.1', registry=metrics):
+        self.httpd = HTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_port
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='brainy-metrics')
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info('Serving metrics on http://%s:%d/metrics' %
+                    self.httpd.server_address)
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,402 @@
+'''
+brainy.microbench
+
+Micro-benchmarks of the primitives that run many times per tick:
+
+ - format_code: stripping bash and python code before submission
+ - format_with_params: template compilation of process parameters
+ - restrict_to_safe_path: jailing of paths within the project
+ - check_report_file_for_errors: scanning small and large job reports
+ - flags: FlagManager checks of a step
+ - merge_dicts: merging nested configs
+ - link_files_has_data: LinkFiles.has_data on many linked files
+ - link_files: linking many files into a fresh folder
+ - count_working_jobs: Lsf.count_working_jobs on a large bjobs output
+
+Fixtures are generated from a seed, so that numbers of two runs (e.g. before
+and after an optimisation) are comparable. Results are JSON, see
+`brainy bench micro`.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import json
+import random
+import shutil
+import logging
+import tempfile
+import timeit
+import zlib
+from datetime import datetime
+from brainy.version import brainy_version
+from brainy.config import write_project_config
+from brainy.utils import merge_dicts
+from brainy.errors import check_report_file_for_errors
+from brainy.scheduler.snapshot import SchedulerSnapshot
+logger = logging.getLogger(__name__)
+
+DEFAULT_SEED = 0
+DEFAULT_REPEAT = 5
+DEFAULT_LARGE_REPORT_MB = 16
+DEFAULT_CODE_LINES = 200
+DEFAULT_LINKED_FILES = 1000
+DEFAULT_BJOBS_LINES = 50000
+DEFAULT_CONFIG_KEYS = 200
+MICRO_CASES = (
+    'format_code',
+    'format_with_params',
+    'restrict_to_safe_path',
+    'check_report_file_for_errors',
+    'flags',
+    'merge_dicts',
+    'link_files_has_data',
+    'link_files',
+    'count_working_jobs',
+)
+PROJECT_NAME = 'microbench_project'
+PIPE_NAME = 'micro'
+WORDS = ('cells', 'nuclei', 'plate', 'well', 'site', 'channel', 'mask',
+         'intensity', 'area', 'illumination', 'segmentation', 'batch')
+JOB_STATES_MIX = ('RUN', 'PEND', 'DONE', 'EXIT')
+REPORT_HEADER = '''Sender: LSF System <lsfadmin@microbench>
+Subject: Job 1: <microbench> Done
+
+Job was executed on host(s) <microbench>, in queue <normal>.
+'''
+REPORT_FOOTER = '''
+Successfully completed.
+
+Resource usage summary:
+
+    CPU time   :      0.10 sec.
+'''
+
+
+def make_text_line(rand):
+    return ' '.join(rand.choice(WORDS) for index in range(rand.randint(3, 12)))
+
+
+def make_code(rand, lines, lang='bash'):
+    '''Return indented code with blank lines, as found in pipe definitions.'''
+    code = list()
+    for index in range(lines):
+        if rand.random() < 0.1:
+            code.append('')
+            continue
+        indent = '    ' * (2 + rand.randint(0, 2 if lang == 'python' else 0))
+        code.append('%secho "%s"  ' % (indent, make_text_line(rand)))
+    return '\n'.join(code)
+
+
+def make_nested_dict(rand, keys, depth=3):
+    result = dict()
+    for index in range(keys):
+        key = '%s_%d' % (rand.choice(WORDS), index)
+        if depth > 1 and rand.random() < 0.2:
+            result[key] = make_nested_dict(rand, max(1, keys // 10),
+                                           depth - 1)
+        else:
+            result[key] = rand.randint(0, 1000)
+    return result
+
+
+def make_bjobs_lines(rand, count, project_path):
+    lines = ['JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME SUBMIT_TIME']
+    for job_id in range(1, count + 1):
+        # Only a few jobs belong to the benchmarked project.
+        if rand.random() < 0.01:
+            path = os.path.join(project_path, PIPE_NAME)
+        else:
+            path = '/cluster/other_%d/%s' % (rand.randint(0, 500),
+                                             rand.choice(WORDS))
+        lines.append('%d user %s normal login node_%d %s Jan %d 00:00' % (
+            job_id, rand.choice(JOB_STATES_MIX), rand.randint(0, 99),
+            path, rand.randint(1, 28)))
+    return lines
+
+
+def write_report(report_filepath, rand, size):
+    '''Write a successful job report of about size bytes.'''
+    # Repeat a seeded block, since generating gigabytes line by line is slow.
+    block = '\n'.join(make_text_line(rand) for index in range(20000)) + '\n'
+    with open(report_filepath, 'w+') as stream:
+        stream.write(REPORT_HEADER)
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            stream.write(chunk)
+            written += len(chunk)
+        stream.write(REPORT_FOOTER)
+    return report_filepath
+
+
+class MicroFixtures(object):
+    '''
+    A project with a pipe of a bash step and a LinkFiles step, plus reports,
+    linked files and bjobs output, all generated from the seed.
+    '''
+
+    def __init__(self, root_path, seed=DEFAULT_SEED,
+                 large_report_mb=DEFAULT_LARGE_REPORT_MB,
+                 code_lines=DEFAULT_CODE_LINES,
+                 linked_files=DEFAULT_LINKED_FILES,
+                 bjobs_lines=DEFAULT_BJOBS_LINES,
+                 config_keys=DEFAULT_CONFIG_KEYS):
+        self.root_path = root_path
+        self.seed = seed
+        self.large_report_mb = large_report_mb
+        self.code_lines = code_lines
+        self.linked_files = linked_files
+        self.bjobs_lines = bjobs_lines
+        self.config_keys = config_keys
+        self.path = os.path.join(root_path, PROJECT_NAME)
+        self.processes = None
+
+    @property
+    def params(self):
+        return {
+            'seed': self.seed,
+            'large_report_mb': self.large_report_mb,
+            'code_lines': self.code_lines,
+            'linked_files': self.linked_files,
+            'bjobs_lines': self.bjobs_lines,
+            'config_keys': self.config_keys,
+        }
+
+    def random(self, name):
+        '''Return a random generator per fixture, independent of the order.'''
+        return random.Random(zlib.crc32('%s:%s' % (self.seed, name)))
+
+    def make_pipe_definition(self):
+        return {
+            'type': 'CustomCode.CustomPipe',
+            'chain': [
+                {
+                    'type': 'CustomCode.BashCall',
+                    'name': 'bash_step',
+                    'call': 'echo {process_path} {data_path} {name}',
+                },
+                {
+                    'type': 'FileTools.LinkFiles',
+                    'name': 'link_step',
+                    'source_location': '{project_path}/source',
+                    'target_location': '{project_path}/target',
+                    'file_patterns': {'symlink': ['file_*']},
+                },
+            ],
+        }
+
+    def create(self):
+        os.makedirs(self.path)
+        write_project_config(self.path)
+        with open(os.path.join(self.path, PIPE_NAME + '.br'), 'w+') as stream:
+            stream.write(json.dumps(self.make_pipe_definition(), indent=2))
+        with open(os.path.join(self.path, 'sequence'), 'w+') as stream:
+            stream.write(PIPE_NAME + '.br')
+        self.create_linked_files()
+        self.processes = self.bake_processes()
+        return self
+
+    def create_linked_files(self):
+        source_path = os.path.join(self.path, 'source')
+        target_path = os.path.join(self.path, 'target')
+        os.makedirs(source_path)
+        os.makedirs(target_path)
+        rand = self.random('linked_files')
+        for index in range(self.linked_files):
+            filename = 'file_%06d_%s' % (index, rand.choice(WORDS))
+            open(os.path.join(source_path, filename), 'w+').close()
+            os.symlink(os.path.join('..', 'source', filename),
+                       os.path.join(target_path, filename))
+
+    def bake_processes(self):
+        '''Return processes of the pipe by name, ready to be measured.'''
+        # Import here to avoid circular imports.
+        from brainy.project.base import BrainyProject
+        from brainy.pipes.manager import PipesManager
+        from brainy.scheduler import BrainyScheduler
+        project = BrainyProject(PROJECT_NAME, self.path)
+        project.load_config()
+        project.scheduler = BrainyScheduler.build_scheduler('shellcmd')
+        pipes = PipesManager(project)
+        processes = dict()
+        for pipeline in pipes.pipelines:
+            for process in pipeline.bake_processes():
+                process.parameters.update(pipeline.get_process_parameters())
+                processes[process.name] = process
+        if not os.path.exists(processes['bash_step'].process_path):
+            os.makedirs(processes['bash_step'].process_path)
+        return processes
+
+    def make_report(self, name, size):
+        report_filepath = os.path.join(self.root_path, name + '.job_report')
+        return write_report(report_filepath, self.random(name), size)
+
+    def make_code(self, lang):
+        return make_code(self.random('code_' + lang), self.code_lines, lang)
+
+    def make_config(self):
+        return make_nested_dict(self.random('config'), self.config_keys)
+
+    def make_bjobs_snapshot(self):
+        return SchedulerSnapshot('lsf', make_bjobs_lines(
+            self.random('bjobs'), self.bjobs_lines, self.path))
+
+
+def measure(func, number=1, repeat=DEFAULT_REPEAT):
+    '''Call func number times per repeat, return seconds per call.'''
+    timer = timeit.Timer(func)
+    timings = sorted(timing / number for timing in
+                     timer.repeat(repeat=repeat, number=number))
+    return {
+        'number': number,
+        'repeat': repeat,
+        'min_seconds': timings[0],
+        'median_seconds': timings[len(timings) // 2],
+        'mean_seconds': sum(timings) / len(timings),
+        'max_seconds': timings[-1],
+    }
+
+
+def bench_format_code(fixtures, repeat):
+    from brainy.process.base import format_code
+    results = list()
+    for lang in ('bash', 'python'):
+        code = fixtures.make_code(lang)
+        results.append(('format_code', {'lang': lang}, measure(
+            lambda: format_code(code, lang), number=100, repeat=repeat)))
+    return results
+
+
+def bench_format_with_params(fixtures, repeat):
+    process = fixtures.processes['bash_step']
+    template = process.description['call']
+
+    def compile_template():
+        process.compiled_params.clear()
+        process.format_with_params('call', template)
+
+    return [
+        ('format_with_params', {'cached': False},
+         measure(compile_template, number=100, repeat=repeat)),
+        ('format_with_params', {'cached': True},
+         measure(lambda: process.format_with_params('call', template),
+                 number=1000, repeat=repeat)),
+    ]
+
+
+def bench_restrict_to_safe_path(fixtures, repeat):
+    process = fixtures.processes['bash_step']
+    pathname = os.path.join(process.process_path, '../../data/../file.txt')
+    return [('restrict_to_safe_path', {}, measure(
+        lambda: process.restrict_to_safe_path(pathname), number=1000,
+        repeat=repeat))]
+
+
+def bench_check_report_file_for_errors(fixtures, repeat):
+    results = list()
+    small_report = fixtures.make_report('small', 1024)
+    results.append(('check_report_file_for_errors', {'size_mb': 0.001},
+                    measure(lambda: check_report_file_for_errors(
+                        small_report), number=100, repeat=repeat)))
+    if fixtures.large_report_mb:
+        large_report = fixtures.make_report(
+            'large', fixtures.large_report_mb * 1024 * 1024)
+        try:
+            results.append((
+                'check_report_file_for_errors',
+                {'size_mb': fixtures.large_report_mb},
+                measure(lambda: check_report_file_for_errors(large_report),
+                        number=1, repeat=min(repeat, 3))))
+        finally:
+            os.unlink(large_report)
+    return results
+
+
+def bench_flags(fixtures, repeat):
+    process = fixtures.processes['bash_step']
+    # Half of the flags exist.
+    process.set_flag('submitted')
+    process.set_flag('resubmitted')
+
+    def check_flags():
+        return (process.is_submitted, process.is_resubmitted,
+                process.is_complete, process.has_runlimit)
+
+    return [('flags', {'checks': 4}, measure(check_flags, number=1000,
+                                              repeat=repeat))]
+
+
+def bench_merge_dicts(fixtures, repeat):
+    config = fixtures.make_config()
+    user_config = fixtures.make_config()
+    # Merging the same config over itself walks every leaf without changes.
+    return [
+        ('merge_dicts', {'conflicts': False}, measure(
+            lambda: merge_dicts(config, config), number=100, repeat=repeat)),
+        # Merging mutates the config, so a fresh one is built on every call.
+        ('merge_dicts', {'conflicts': True}, measure(
+            lambda: merge_dicts(fixtures.make_config(), user_config),
+            number=10, repeat=repeat)),
+    ]
+
+
+def bench_link_files_has_data(fixtures, repeat):
+    process = fixtures.processes['link_step']
+    return [('link_files_has_data', {'files': fixtures.linked_files},
+             measure(process.has_data, number=1, repeat=repeat))]
+
+
+def bench_link_files(fixtures, repeat):
+    from brainy.pipes.FileTools import LinkingEngine
+    source_path = os.path.join(fixtures.path, 'source')
+
+    def link():
+        # Every call links into a new folder, creating it is measured too.
+        target_path = tempfile.mkdtemp(dir=fixtures.root_path)
+        LinkingEngine(source_path, target_path,
+                      {'symlink': ['file_*']}).run()
+
+    return [('link_files', {'files': fixtures.linked_files},
+             measure(link, number=1, repeat=repeat))]
+
+
+def bench_count_working_jobs(fixtures, repeat):
+    from brainy.scheduler.lsf import Lsf
+    scheduler = Lsf(snapshot=fixtures.make_bjobs_snapshot())
+    return [
+        ('count_working_jobs', {'lines': fixtures.bjobs_lines, 'key': False},
+         measure(scheduler.count_working_jobs, number=1, repeat=repeat)),
+        ('count_working_jobs', {'lines': fixtures.bjobs_lines, 'key': True},
+         measure(lambda: scheduler.count_working_jobs(fixtures.path),
+                 number=1, repeat=repeat)),
+    ]
+
+
+def run_micro_benchmarks(cases=MICRO_CASES, repeat=DEFAULT_REPEAT,
+                         root_path=None, **fixture_params):
+    '''Measure the cases (see MICRO_CASES) and return JSON-able results.'''
+    for name in cases:
+        if name not in MICRO_CASES:
+            raise Exception('Unknown micro-benchmark: %s' % name)
+    root_path = tempfile.mkdtemp(dir=root_path, prefix='brainy_microbench_')
+    try:
+        fixtures = MicroFixtures(root_path, **fixture_params).create()
+        results = {
+            'brainy_version': brainy_version,
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'fixtures': fixtures.params,
+            'benchmarks': list(),
+        }
+        for name in cases:
+            logger.info('Running micro-benchmark: %s' % name)
+            bench = globals()['bench_' + name]
+            for bench_name, params, timing in bench(fixtures, repeat):
+                timing.update({'name': bench_name, 'params': params})
+                results['benchmarks'].append(timing)
+    finally:
+        shutil.rmtree(root_path, ignore_errors=True)
+    return results
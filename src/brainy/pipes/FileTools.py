@@ -1,9 +1,18 @@
 import os
+import re
+import stat
+import errno
 import shutil
+import fnmatch
 import logging
-from findtools.find_files import (find_files, Match, MatchAnyPatternsAndTypes,
+import threading
+from multiprocessing.pool import ThreadPool
+from findtools.find_files import (find_files, MatchAnyPatternsAndTypes,
                                   MatchAllPatternsAndTypes)
 from brainy.utils import get_timestamp_str
+from brainy.backups import (make_snapshot, describe_copy, prune_snapshots,
+                            list_snapshots, load_manifest,
+                            DEFAULT_BACKUP_WORKERS)
 from brainy.errors import BrainyProcessError
 from brainy.process.code import PythonCodeProcess
 from brainy.process.decorator import (
@@ -11,24 +20,50 @@ from brainy.process.decorator import (
     require_key_in_description)
 logger = logging.getLogger(__name__)
 
+LINK_TYPES = ('hardlink', 'symlink')
+DEFAULT_LINK_WORKERS = 8
+# Names linked by a single task of the pool.
+LINK_CHUNK_SIZE = 1000
+FILE_TYPE_CHECKS = {
+    'f': stat.S_ISREG,
+    'd': stat.S_ISDIR,
+    'l': stat.S_ISLNK,
+}
 
 
-def backup_batch_folder(data_path, backups_path):
-    '''Will recursively copy current BATCH to backups path'''
+def backup_batch_folder(data_path, backups_path, incremental=True,
+                        checksum=False, dedup=False,
+                        workers=DEFAULT_BACKUP_WORKERS, keep_last=0,
+                        keep_daily=0, keep_weekly=0):
+    '''
+    Will recursively copy current BATCH to backups path. Incremental backups
+    hardlink files unchanged since the previous backup, deduplicated ones
+    also share files of the same content (see brainy.backups). Older backups
+    are pruned according to the retention.
+    '''
     # Make sure folders exist.
     if not os.path.exists(data_path):
         raise IOError('BATCH path was not found: %s' % data_path)
     if not os.path.exists(backups_path):
         raise IOError('BACKUPS path was not found: %s' % backups_path)
 
-    # Making a backup copy.
-    backuped_data_path = os.path.join(backups_path,
-                                      'BATCH_%s' % get_timestamp_str())
-    if os.path.exists(backuped_data_path):
-        raise IOError('BACKUP destination already exists: %s' %
-                      backuped_data_path)
-    # Note: the destination directory must not already exist.
-    shutil.copytree(data_path, backuped_data_path)
+    if incremental or dedup:
+        backuped_data_path = make_snapshot(data_path, backups_path,
+                                           checksum=checksum, dedup=dedup,
+                                           workers=workers)
+    else:
+        # Making a backup copy.
+        backuped_data_path = os.path.join(backups_path,
+                                          'BATCH_%s' % get_timestamp_str())
+        if os.path.exists(backuped_data_path):
+            raise IOError('BACKUP destination already exists: %s' %
+                          backuped_data_path)
+        # Note: the destination directory must not already exist.
+        shutil.copytree(data_path, backuped_data_path)
+        describe_copy(data_path, backuped_data_path)
+    prune_snapshots(backups_path, keep_last=keep_last, keep_daily=keep_daily,
+                    keep_weekly=keep_weekly)
+    return backuped_data_path
 
 
 class BackupPreviousBatch(PythonCodeProcess):
@@ -47,32 +82,63 @@ class BackupPreviousBatch(PythonCodeProcess):
         if not os.path.exists(self.backups_path):
             os.makedirs(self.backups_path)
 
+    @property
+    def incremental(self):
+        '''Hardlink files unchanged since the previous backup.'''
+        return bool(self.description.get('incremental', True))
+
+    @property
+    def checksum(self):
+        '''Compare sha1 too, before considering a file unchanged.'''
+        return bool(self.description.get('checksum', False))
+
+    @property
+    def dedup(self):
+        '''Share files of the same content between all the backups.'''
+        return bool(self.description.get('dedup', False))
+
+    @property
+    def retention(self):
+        '''How many backups to keep, by default all of them.'''
+        return dict((key, int(self.description.get(key, 0)))
+                    for key in ('keep_last', 'keep_daily', 'keep_weekly'))
+
+    @property
+    def backup_workers(self):
+        return int(self.description.get('backup_workers',
+                                        DEFAULT_BACKUP_WORKERS))
+
     def get_python_code(self):
         '''
         Note that the interpreter call is included by
         self.submit_python_code()
         '''
         return '''
-        from brainy.pipes.Tools import backup_batch_folder
+from brainy.pipes.FileTools import backup_batch_folder
 
-        backup_batch_folder('%(data_path)s', '%(backups_path)s')
-        ''' % {
+backup_batch_folder('%(data_path)s', '%(backups_path)s',
+                    incremental=%(incremental)r, checksum=%(checksum)r,
+                    dedup=%(dedup)r, workers=%(workers)d,
+                    keep_last=%(keep_last)d, keep_daily=%(keep_daily)d,
+                    keep_weekly=%(keep_weekly)d)
+''' % dict({
             'data_path': self.data_path,
             'backups_path': self.backups_path,
-        }
+            'incremental': self.incremental,
+            'checksum': self.checksum,
+            'dedup': self.dedup,
+            'workers': self.backup_workers,
+        }, **self.retention)
 
     def has_data(self):
         '''
-        If backups folder is empty, it means no backup was done.
+        Check the manifest of the latest backup. Backups are listed only once
+        complete, so if there is none, no backup was done.
         '''
-        previous_backups = find_files(
-            path=self.backups_path,
-            match=Match(filetype='directory', name='BATCH_*'),
-            recursive=False,
-        )
-        for item in previous_backups:
-            return True
-        return False
+        backups = list_snapshots(self.backups_path)
+        if not backups:
+            return False
+        return load_manifest(backups[-1])['source'] == self.data_path
 
 
 def relative_symlink(source, target):
@@ -105,6 +171,140 @@ def relative_symlink(source, target):
     os.symlink(relative_source, target)
 
 
+def translate_pattern(pattern):
+    '''
+    Translate pattern into regexp. If pattern string starts and ends with '/'
+    then it is a regexp, otherwise it is fnmatch.
+    '''
+    if pattern.startswith('/') and pattern.endswith('/'):
+        return pattern[1:-1]
+    regexp = fnmatch.translate(pattern)
+    # Python 2 appends flags, which are set for the whole matcher anyway.
+    if regexp.endswith('(?ms)'):
+        regexp = regexp[:-len('(?ms)')]
+    return regexp
+
+
+class LinkMatcher(object):
+    '''
+    A single compiled regexp that matches names against hardlink and
+    symlink patterns at once. Hardlink patterns take precedence.
+    '''
+
+    def __init__(self, file_patterns):
+        self.link_types = [link_type for link_type in LINK_TYPES
+                           if file_patterns.get(link_type)]
+        self.regexp = re.compile('(?ms)' + '|'.join(
+            '(?P<%s>%s)' % (link_type, '|'.join(
+                '(?:%s)' % translate_pattern(pattern)
+                for pattern in file_patterns[link_type]))
+            for link_type in self.link_types))
+
+    def match(self, name):
+        '''Return link type of the name or None.'''
+        match = self.regexp.match(name)
+        if match is None:
+            return None
+        for link_type in self.link_types:
+            if match.group(link_type) is not None:
+                return link_type
+
+
+class LinkingEngine(object):
+    '''
+    Link files matching any of the patterns into the target folder. The
+    source folder is walked once for all the link types, linking is done by
+    a pool of workers in chunks of names of the same folder.
+
+    Symlinks are relative. Unlike relative_symlink(), the relative path of
+    the source folder is computed once per folder, and with os.path.relpath
+    it is correct for sibling folders sharing a name prefix (`data` and
+    `data_old`) too.
+    '''
+
+    def __init__(self, source_path, target_path, file_patterns,
+                 file_type='f', recursively=False,
+                 workers=DEFAULT_LINK_WORKERS):
+        if 'hardlink' in file_patterns and file_type != 'f':
+            raise IOError('Unsupported link type: hardlink of %s' %
+                          file_type)
+        self.source_path = source_path
+        self.target_path = target_path
+        self.matcher = LinkMatcher(file_patterns)
+        self.file_type = file_type
+        self.recursively = recursively
+        self.workers = workers
+        self.counts = dict((name, 0) for name in LINK_TYPES + ('existing',))
+        self.__lock = threading.Lock()
+
+    def list_chunks(self):
+        '''Walk source folder once, return chunks of matched names.'''
+        chunks = list()
+        walker = os.walk(self.source_path)
+        if not self.recursively:
+            walker = [next(walker)]
+        for root, dirs, files in walker:
+            matched = dict((link_type, list()) for link_type in LINK_TYPES)
+            for name in dirs + files:
+                link_type = self.matcher.match(name)
+                if link_type is not None:
+                    matched[link_type].append(name)
+            for link_type in LINK_TYPES:
+                names = matched[link_type]
+                for start in range(0, len(names), LINK_CHUNK_SIZE):
+                    chunks.append((root, link_type,
+                                   names[start:start + LINK_CHUNK_SIZE]))
+        return chunks
+
+    def is_linkable(self, pathname):
+        # Can also accept symlinks sources, not just files or dirs.
+        mode = os.lstat(pathname).st_mode
+        if stat.S_ISLNK(mode):
+            return True
+        check = FILE_TYPE_CHECKS.get(self.file_type)
+        return check is None or check(mode)
+
+    def link_chunk(self, chunk):
+        root, link_type, names = chunk
+        relative_root = os.path.relpath(root, self.target_path)
+        counts = {link_type: 0, 'existing': 0}
+        for name in names:
+            source_file = os.path.join(root, name)
+            if not self.is_linkable(source_file):
+                continue
+            link_path = os.path.join(self.target_path, name)
+            try:
+                if link_type == 'hardlink':
+                    os.link(source_file, link_path)
+                else:
+                    os.symlink(os.path.join(relative_root, name), link_path)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise BrainyProcessError(
+                        message='Unknown input-output error.',
+                        output=str(error))
+                counts['existing'] += 1
+                continue
+            counts[link_type] += 1
+        with self.__lock:
+            for name, count in counts.items():
+                self.counts[name] += count
+
+    def run(self):
+        '''Link everything, return counts of links by type.'''
+        assert os.path.exists(self.source_path)
+        if not os.path.exists(self.target_path):
+            os.makedirs(self.target_path)
+        chunks = self.list_chunks()
+        pool = ThreadPool(max(1, self.workers))
+        try:
+            pool.map(self.link_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        return self.counts
+
+
 @require_keys_in_description('file_patterns')
 class LinkFiles(PythonCodeProcess):
     '''
@@ -133,6 +333,10 @@ class LinkFiles(PythonCodeProcess):
         '''Recursively look for patterns in source_path'''
         return bool(self.description.get('recursively', False))
 
+    @property
+    def link_workers(self):
+        return int(self.description.get('link_workers', DEFAULT_LINK_WORKERS))
+
     def put_on(self):
         super(LinkFiles, self).put_on()
         # Create miss)ing process folder path.
@@ -142,47 +346,33 @@ class LinkFiles(PythonCodeProcess):
     @staticmethod
     def link(source_path, target_path, patterns, link_type='hard',
              file_type='f', recursively=False):
+        '''Link files matching patterns of a single type, see link_all().'''
+        if link_type not in LINK_TYPES:
+            raise IOError('Unsupported link type: %s' % link_type)
+        return LinkFiles.link_all(source_path, target_path,
+                                  {link_type: patterns}, file_type=file_type,
+                                  recursively=recursively)
+
+    @staticmethod
+    def link_all(source_path, target_path, file_patterns, file_type='f',
+                 recursively=False, workers=DEFAULT_LINK_WORKERS):
         '''
-        Expect keys 'hardlink' and 'symlink' keys in
-        description['file_patterns']. If pattern string starts and ends with
-        '/' then it is a regexp, otherwise it is fnmatch.
+        Expect keys 'hardlink' and (or) 'symlink' in file_patterns. If
+        pattern string starts and ends with '/' then it is a regexp,
+        otherwise it is fnmatch. Print a summary instead of every link.
         '''
-        assert os.path.exists(source_path)
-        if not os.path.exists(target_path):
-            os.makedirs(target_path)
-        file_matches = find_files(
-            path=source_path,
-            match=MatchAnyPatternsAndTypes(
-                # Can also accept symlinks sources, not just files or dirs.
-                filetypes=[file_type, 'l'],
-                names=patterns,
-            ),
-            recursive=recursively,
-        )
-        if link_type == 'hardlink' and file_type == 'f':
-            make_link = os.link
-        elif link_type == 'symlink':
-            # make_link = os.symlink
-            make_link = relative_symlink
-        else:
-            raise IOError('Unsupported link type: %s' % link_type)
-        for source_file in file_matches:
-            link_path = os.path.join(target_path,
-                                     os.path.basename(source_file))
-            try:
-                print 'Linking "%s" -> "%s"' % (source_file, link_path)
-                make_link(source_file, link_path)
-            except (OSError, IOError) as error:
-                if 'File exists' in str(error):
-                    message = 'Skipping, since it looks like linking was '\
-                        'already done. Maybe you are trying to re-run project'\
-                        ' incorrectly. Make sure to clean previous results '\
-                        'before retrying.'
-                    print '%s\n(Error: %s)' % (message, str(error))
-                else:
-                    message = 'Unknown input-output error.'
-                    raise BrainyProcessError(warning=message,
-                                             output=str(error))
+        counts = LinkingEngine(source_path, target_path, file_patterns,
+                               file_type=file_type, recursively=recursively,
+                               workers=workers).run()
+        print 'Linking "%s" -> "%s": %d hardlink(s), %d symlink(s).' % (
+            source_path, target_path, counts['hardlink'], counts['symlink'])
+        if counts['existing']:
+            message = 'Skipped %d file(s), since it looks like linking was '\
+                'already done. Maybe you are trying to re-run project'\
+                ' incorrectly. Make sure to clean previous results '\
+                'before retrying.' % counts['existing']
+            print message
+        return counts
 
     @staticmethod
     def build_linking_args(source_location, target_location,
@@ -214,23 +404,30 @@ class LinkFiles(PythonCodeProcess):
         assert 'hardlink' in self.file_patterns \
             or 'symlink' in self.file_patterns
 
-        code = 'from brainy.pipes.Tools import LinkFiles\n'
-
-        for args in LinkFiles.build_linking_args(self.source_location,
-                                                 self.target_location,
-                                                 self.file_patterns,
-                                                 self.file_type,
-                                                 self.recursively):
-            code += '''LinkFiles.link(
+        file_patterns = dict(
+            (args['link_type'], args['file_patterns'])
+            for args in LinkFiles.build_linking_args(self.source_location,
+                                                     self.target_location,
+                                                     self.file_patterns,
+                                                     self.file_type,
+                                                     self.recursively))
+        return '''from brainy.pipes.FileTools import LinkFiles
+LinkFiles.link_all(
     '%(source_location)s',
     '%(target_location)s',
-    %(file_patterns)s,
-    link_type='%(link_type)s',
+    %(file_patterns)r,
     file_type='%(file_type)s',
     recursively=%(recursively)r,
+    workers=%(workers)d,
 )
-''' % args
-        return code
+''' % {
+            'source_location': self.source_location,
+            'target_location': self.target_location,
+            'file_patterns': file_patterns,
+            'file_type': self.file_type,
+            'recursively': self.recursively,
+            'workers': self.link_workers,
+        }
 
     def has_data(self):
         '''
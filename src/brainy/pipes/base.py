@@ -13,13 +13,58 @@ Copyright (c) 2014-2015 Pelkmans Lab
 from __future__ import with_statement
 import os
 import logging
-import pprint
 from pipette.pipes import Pipe as PipettePipe
 from brainy.errors import (BrainyProcessError, ProccessEndedIncomplete,
                            BrainyPipeFailure)
 from brainy.project.report import BrainyReporter
+from brainy.tracing import tracer, span
+from brainy.log import lazy_pformat
+from brainy import fs
 logger = logging.getLogger(__name__)
 
+# Resolved pipe and process classes. The cache is shared by all the projects
+# run by the same (daemon) process.
+resolved_classes = dict()
+
+
+def find_class(namespaces, type_name, kind='pipe'):
+    '''
+    Find a class called type_name by trying every namespace prefix in turn.
+    Successful lookups are memoized.
+    '''
+    key = (tuple(namespaces), type_name)
+    if key in resolved_classes:
+        return resolved_classes[key]
+    exceptions = list()
+    for namespace in namespaces:
+        module_name, class_name = (namespace + '.' + type_name).rsplit('.', 1)
+        try:
+            module = __import__(module_name, {}, {}, [class_name])
+        except ImportError as error:
+            # This may lead to hiding the nested imports like missing
+            # packages. So we report the list of errors if the search failed.
+            exceptions.append(error)
+            continue
+        if hasattr(module, class_name):
+            resolved_classes[key] = getattr(module, class_name)
+            return resolved_classes[key]
+    for exception in exceptions:
+        logger.warn(str(exception))
+    logger.info('Tip: check that module on PYTHON PATH!')
+    raise ImportError('Failed to find/import %s type: %s in %s' %
+                      (kind, type_name, namespaces))
+
+
+def get_process_name(process_description, default_type):
+    '''
+    Name of the process as pipette would give it, but without resolving and
+    instantiating its class: the type is expected to match the class name.
+    '''
+    if 'name' in process_description:
+        return process_description['name']
+    process_type = process_description.get('type', default_type)
+    return process_type.rsplit('.', 1)[-1].lower()
+
 
 class BrainyPipe(PipettePipe):
 
@@ -29,6 +74,8 @@ class BrainyPipe(PipettePipe):
         self.pipes_manager = pipes_manager
         self.has_failed = False
         self.previous_process_params = None
+        # Names of the only steps to run, see PipesManager.select_pipelines()
+        self.only_steps = None
 
     @property
     def pipe_extension(self):
@@ -38,6 +85,10 @@ class BrainyPipe(PipettePipe):
     def output_path(self):
         return os.path.join(self.pipes_manager.project_path, self.name)
 
+    def find_process_class(self, process_type):
+        return find_class(self.process_namespaces, process_type,
+                          kind='process')
+
     def instantiate_process(self, process_description,
                             default_type=None):
         default_process_type = self.pipes_manager.default_process_type
@@ -46,6 +97,40 @@ class BrainyPipe(PipettePipe):
         process.name_prefix = self.name
         return process
 
+    def bake_processes(self):
+        '''Bake processes of the chain, skipping unselected steps.'''
+        for process_description in self.definition['chain']:
+            if self.only_steps is not None and get_process_name(
+                    process_description,
+                    self.pipes_manager.default_process_type) \
+                    not in self.only_steps:
+                continue
+            process = self.instantiate_process(process_description)
+            process.parameters.update(
+                process_description.get('default_parameters', {}))
+            yield process
+
+    def list_step_names(self):
+        return [get_process_name(process_description,
+                                 self.pipes_manager.default_process_type)
+                for process_description in self.definition['chain']]
+
+    def is_step_complete(self, process_name):
+        return fs.exists(os.path.join(self.get_process_path(),
+                                      '%s.complete' % process_name))
+
+    @property
+    def are_previous_steps_complete(self):
+        '''Check flags of the steps that precede the first selected one.'''
+        if not self.only_steps:
+            return True
+        for process_name in self.list_step_names():
+            if process_name in self.only_steps:
+                break
+            if not self.is_step_complete(process_name):
+                return False
+        return True
+
     def get_step_name(self, process_name):
         return '%s-%s' % (self.name, process_name)
 
@@ -73,7 +158,7 @@ class BrainyPipe(PipettePipe):
         # Update them with project-wide parameters
         project = self.pipes_manager.project
         logger.info('Applying project-wide parameters.')
-        logger.debug(pprint.pformat(project.config['project_parameters']))
+        logger.debug('%s', lazy_pformat(project.config['project_parameters']))
         parameters.update(project.config['project_parameters'])
         return parameters
 
@@ -82,9 +167,16 @@ class BrainyPipe(PipettePipe):
         Execute process as a step in brainy pipeline. Add verbosity, e.g.
         report status using brainy project report scheme.
         '''
-        parameters = self.get_process_parameters()
         # Set step name.
         step_name = self.get_step_name(process.name)
+        with span(step_name, category='step', pipe=self.name,
+                  step=process.name):
+            self.execute_step(process, step_name)
+
+    def execute_step(self, process, step_name):
+        tracer.enter_step(self.name, process.name)
+        with span('get_parameters'):
+            parameters = self.get_process_parameters()
         logger.info('Executing step {%s}' % step_name)
         parameters['step_name'] = self.get_step_name(process.name)
         # Some modules are allowed to have limited dependency on previous
@@ -96,7 +188,8 @@ class BrainyPipe(PipettePipe):
         BrainyReporter.append_report_process(process.name)
 
         try:
-            super(BrainyPipe, self).execute_process(process, parameters)
+            with span('execute'):
+                super(BrainyPipe, self).execute_process(process, parameters)
         except BrainyProcessError as error:
             # See brainy.errors
             error_is_fatal = False
@@ -1,13 +1,17 @@
 import os
-import shutil
 import logging
 from pprint import pformat
 import brainy.config
 from brainy.flags import FlagManager
 from brainy.utils import Timer
+from brainy.trash import TrashBin
 from brainy.project.report import BrainyReporter, report_data
-from brainy.pipes.base import BrainyPipe
-from brainy.errors import BrainyPipeFailure, ProccessEndedIncomplete
+from brainy.tracing import tracer, span, dump_timings, dump_trace
+from brainy.fs import accounting as fs_accounting
+from brainy import fs
+from brainy.pipes.base import BrainyPipe, find_class
+from brainy.errors import (BrainyPipeFailure, ProccessEndedIncomplete,
+                           BrainyProjectError)
 logger = logging.getLogger(__name__)
 
 
@@ -17,7 +21,7 @@ class PipesManager(FlagManager):
         self.project = project
         self.pipes_folder_files = [
             os.path.join(self.project_path, filename)
-            for filename in os.listdir(self.project_path)
+            for filename in fs.listdir(self.project_path)
         ]
         self.__flag_prefix = self.project_path
         self.__pipelines = None
@@ -82,28 +86,7 @@ class PipesManager(FlagManager):
         return self.project.config['brainy']['default_process_type']
 
     def get_class(self, pipe_type):
-        module = None
-        exceptions = list()
-        for pipe_namespace in self.pipe_namespaces:
-            pipe_type_ = pipe_namespace + '.' + pipe_type
-            module_name, class_name = pipe_type_.rsplit('.', 1)
-            try:
-                # Uncomment to debug:
-                # logger.info('from %s import %s' %
-                #             (module_name, class_name))
-                module = __import__(module_name, {}, {}, [class_name])
-            except ImportError as error:
-                exceptions.append(error)
-                # This may lead to hiding the nested imports like
-                # missing packages. So we report the list of errors if the
-                # search failed.
-        if module is None:
-            for exception in exceptions:
-                logger.warn(str(exception))
-            logger.info('Tip: check that module on PYTHON PATH!')
-            raise ImportError('Failed to find/import pipe type: %s in %s' %
-                              (pipe_type, self.pipe_namespaces))
-        return getattr(module, class_name)
+        return find_class(self.pipe_namespaces, pipe_type)
 
     @property
     def pipelines(self):
@@ -114,16 +97,109 @@ class PipesManager(FlagManager):
             for definition_filename in self.pipes_folder_files:
                 if not definition_filename.endswith(self.pipe_extension):
                     continue
-                pipe = BrainyPipe(self)
-                pipe.parse_definition_file(definition_filename)
-                pipe_type = pipe.definition.get('type',
-                                                self.default_pipe_type)
-                cls = self.get_class(pipe_type)
-                # Note that we pass itself as a pipes_manager
-                pipes[pipe.definition['name']] = cls(self, pipe.definition)
+                pipeline = self.load_pipeline(definition_filename)
+                pipes[pipeline.name] = pipeline
             self.__pipelines = self.sort_pipelines(pipes)
         return self.__pipelines
 
+    def parse_pipe_definition(self, pipename):
+        '''Parse definition of the pipe without instantiating its type.'''
+        pipe = BrainyPipe(self)
+        pipe.parse_definition_file(os.path.join(
+            self.project_path, pipename + self.pipe_extension))
+        return pipe
+
+    def load_pipeline(self, definition_filename):
+        pipe = BrainyPipe(self)
+        pipe.parse_definition_file(definition_filename)
+        pipe_type = pipe.definition.get('type', self.default_pipe_type)
+        cls = self.get_class(pipe_type)
+        # Note that we pass itself as a pipes_manager
+        return cls(self, pipe.definition)
+
+    def get_pipeline(self, pipename):
+        '''Return the loaded pipeline or load just this one.'''
+        if self.__pipelines is not None:
+            for pipeline in self.__pipelines:
+                if pipeline.name == pipename:
+                    return pipeline
+        return self.load_pipeline(os.path.join(
+            self.project_path, pipename + self.pipe_extension))
+
+    def list_pipenames(self):
+        '''Names of pipes in order of execution, parsing none of them.'''
+        pipenames = [
+            os.path.basename(definition_filename)[:-len(self.pipe_extension)]
+            for definition_filename in self.pipes_folder_files
+            if definition_filename.endswith(self.pipe_extension)
+        ]
+        if len(pipenames) == 1:
+            return pipenames
+        if self.__no_dag is True:
+            return self.read_pipe_sequence()
+        # Order of DAG is known only after all the definitions are parsed.
+        return [pipeline.name for pipeline in self.pipelines]
+
+    def select_pipelines(self, only=None, from_pipe=None):
+        '''
+        Load only the pipelines selected by `pipe[:step]` specifications and
+        (or) every pipeline since `from_pipe` in order of execution. Other
+        pipes are neither instantiated nor run, but flags of pipes and steps
+        that selected ones depend on are checked (see
+        are_dependencies_complete()).
+        '''
+        pipenames = self.list_pipenames()
+        # Pipe name -> set of step names or None for the whole pipe.
+        selection = dict()
+        for specification in only or []:
+            pipename, _, step_name = specification.partition(':')
+            if pipename not in pipenames:
+                raise BrainyProjectError('Unknown pipe: %s' % pipename)
+            if not step_name:
+                selection[pipename] = None
+            elif selection.get(pipename, set()) is not None:
+                selection.setdefault(pipename, set()).add(step_name)
+        if from_pipe is not None:
+            if from_pipe not in pipenames:
+                raise BrainyProjectError('Unknown pipe: %s' % from_pipe)
+            for pipename in pipenames[pipenames.index(from_pipe):]:
+                selection[pipename] = None
+        pipelines = list()
+        previous_pipename = None
+        for pipename in pipenames:
+            if pipename in selection:
+                pipeline = self.get_pipeline(pipename)
+                pipeline.only_steps = selection[pipename]
+                if pipeline.only_steps:
+                    unknown_steps = pipeline.only_steps - \
+                        set(pipeline.list_step_names())
+                    if unknown_steps:
+                        raise BrainyProjectError(
+                            'Unknown step(s) of pipe %s: %s' %
+                            (pipename, ', '.join(sorted(unknown_steps))))
+                if self.__no_dag is True and previous_pipename is not None:
+                    # See sort_pipelines_by_sequence()
+                    pipeline.definition['after'] = previous_pipename
+                pipelines.append(pipeline)
+            previous_pipename = pipename
+        return pipelines
+
+    def is_pipe_complete(self, pipename):
+        '''Check flags of every step of the pipe.'''
+        pipe = self.parse_pipe_definition(pipename)
+        return all(pipe.is_step_complete(process_name)
+                   for process_name in pipe.list_step_names())
+
+    def are_dependencies_complete(self, pipeline):
+        '''
+        Selected pipeline can run only if the pipe it depends on is complete,
+        as well as the steps of its own that precede selected steps.
+        '''
+        if 'after' in pipeline.definition and \
+                not self.is_pipe_complete(pipeline.definition['after']):
+            return False
+        return pipeline.are_previous_steps_complete
+
     @property
     def pipe_sequence_filepath(self):
         '''
@@ -134,15 +210,24 @@ class PipesManager(FlagManager):
            'pipe_sequence_file', 'sequence')
         return os.path.join(self.project_path, pipe_sequence_filepath)
 
-    def sort_pipelines_by_sequence(self, pipes):
-        sorted_pipes = list()
-        for pipe_filename in open(self.pipe_sequence_filepath).readlines():
+    def read_pipe_sequence(self):
+        '''Return pipe names listed by the sequence file.'''
+        pipenames = list()
+        with fs.open_file(self.pipe_sequence_filepath) as sequence_file:
+            pipe_filenames = sequence_file.readlines()
+        for pipe_filename in pipe_filenames:
             pipe_filename = pipe_filename.strip()
             if pipe_filename.startswith('#') or len(pipe_filename) == 0:
                 # Skip empty lines or comments.
                 continue
             # Remove the extension part.
-            pipename = pipe_filename.replace(self.pipe_extension, '')
+            pipenames.append(pipe_filename.replace(self.pipe_extension, ''))
+        return pipenames
+
+    def sort_pipelines_by_sequence(self, pipes):
+        sorted_pipes = list()
+        for pipename in self.read_pipe_sequence():
+            pipe_filename = pipename + self.pipe_extension
             if pipename not in pipes:
                 raise KeyError('Missing pipename defined by the ' +
                                'sequence file: %s' % pipe_filename)
@@ -260,12 +345,39 @@ class PipesManager(FlagManager):
             logger.exception(failure)
             pipeline.has_failed = True
 
-    def process_pipelines(self):
-        BrainyReporter.start_report()
+    @property
+    def reports_config(self):
+        return self.config.get('reports', {})
+
+    def process_pipelines(self, pipelines=None):
+        '''
+        Run every pipeline or only the given ones, see select_pipelines().
+        '''
+        selective = pipelines is not None
+        if not selective:
+            pipelines = self.pipelines
+            for pipeline in pipelines:
+                pipeline.only_steps = None
+        BrainyReporter.start_report(
+            report_filepath=self.project.report_prefix_path,
+            backend=self.reports_config.get('backend', 'yaml'),
+            log_max_bytes=int(self.reports_config.get('log_max_mb', 32) *
+                              1024 * 1024))
+        timings = self.reports_config.get('timings', False)
+        trace = self.reports_config.get('trace', False)
+        if timings or trace:
+            tracer.start(timings=timings, events=trace)
+        else:
+            # Might be left on by a run that has crashed.
+            tracer.stop()
+            tracer.enter_step(None, None)
+        fs_accounting.start()
         previous_pipeline = None
-        for pipeline in self.pipelines:
+        for pipeline in pipelines:
             # Start by expecting failure free run.
             pipeline.has_failed = False
+            # Pipes are reused by watch mode, forget the previous run.
+            pipeline.previous_process_params = None
 
             # Check if current pipeline is dependent on previous one.
             depends_on_previous = False
@@ -288,8 +400,17 @@ class PipesManager(FlagManager):
                 previous_pipeline = pipeline
                 continue
 
+            if selective and not self.are_dependencies_complete(pipeline):
+                logger.warn(('%s is skipped. Pipes or steps that we depend on'
+                            ' are not complete.') % pipeline.name)
+                pipeline.has_failed = True
+                previous_pipeline = pipeline
+                continue
+
             # Execute current pipeline.
-            self.execute_pipeline(pipeline)
+            with span(pipeline.name, category='pipe') as pipe_span:
+                self.execute_pipeline(pipeline)
+                pipe_span.set(has_failed=pipeline.has_failed)
 
             # Remember as previous.
             previous_pipeline = pipeline
@@ -301,24 +422,83 @@ class PipesManager(FlagManager):
                             pipeline.name)
 
         # Finalize the report.
+        if tracer.enabled:
+            tracer.stop()
+        if tracer.timings_enabled:
+            report_data['timings'] = tracer.summarize()
+        report_data['fs_calls'] = fs_accounting.summarize()
+        fs_accounting.flush()
         BrainyReporter.finalize_report()
-        BrainyReporter.save_report(self.project.report_prefix_path)
+        report_filepath = BrainyReporter.save_report(
+            self.project.report_prefix_path,
+            materialize_yaml=self.reports_config.get('materialize_yaml', True))
+        timings_dump = self.reports_config.get('timings_dump')
+        if timings_dump and 'timings' in report_data:
+            dump_filepath = '%s.timings.%s' % (
+                os.path.splitext(report_filepath)[0], timings_dump)
+            dump_timings(report_data['timings'], dump_filepath,
+                         dump_format=timings_dump)
+        if trace and tracer.events is not None:
+            trace_filepath = dump_trace(
+                tracer.events,
+                os.path.splitext(report_filepath)[0] + '.trace.json',
+                process_name=self.project.name)
+            logger.info('Trace of the run is saved to: %s' % trace_filepath)
+        reports_folder_path = self.project.report_folder_path
+        BrainyReporter.register_report(reports_folder_path, report_filepath)
+        if self.reports_config.get('sqlite_index', True):
+            BrainyReporter.index_report(
+                reports_folder_path, report_filepath,
+                global_index=self.reports_config.get('global_index', False))
+        BrainyReporter.compact_reports(
+            reports_folder_path,
+            keep_last=self.reports_config.get('keep_last', 0),
+            global_index=self.reports_config.get('global_index', False))
         BrainyReporter.update_or_generate_static_html(
-            self.project.report_folder_path)
+            reports_folder_path,
+            deferred_interval=self.reports_config.get(
+                'index_update_interval', 0),
+            link_assets=self.reports_config.get('link_assets', True))
+
+    @property
+    def all_pipelines_complete(self):
+        '''Check if every process of every executed pipeline is complete.'''
+        for pipeline in self.pipelines:
+            chain = getattr(pipeline, 'chain', None)
+            if not chain:
+                # Pipeline was skipped or not run yet.
+                return False
+            try:
+                if not all(process.is_complete for process in chain):
+                    return False
+            except Exception as error:
+                logger.warn('Failed to check if pipeline {%s} is complete: '
+                            '%s' % (pipeline.name, error))
+                return False
+        return True
+
+    @property
+    def trash(self):
+        return TrashBin.for_project(self.project_path)
 
     def clean_pipelines_output(self):
+        '''
+        Move output of every pipe into trash. Actual deletion is done
+        separately by TrashBin.sweep()
+        '''
         for pipeline in self.pipelines:
             if os.path.exists(pipeline.output_path):
-                logger.warn('Recursively clean/remove subfolder: %s' %
+                logger.warn('Moving subfolder to trash: %s' %
                             pipeline.output_path)
-                shutil.rmtree(pipeline.output_path)
+                self.trash.discard(pipeline.output_path)
 
-    def run(self, command):
+    def run(self, command, **kwds):
         '''
         This wrapper helps execute a particular command of the pipe manager.
 
         Such command is just a method of the class.  This approach allows to
         report elapsed time of command execution and facilitate with logging.
+        Keyword arguments are passed to the method.
         '''
         if not hasattr(self, command):
             logger.error('Pipes manager does not know command called: %s' %
@@ -330,7 +510,7 @@ class PipesManager(FlagManager):
             # Time method execution.
             timer = Timer()
             with timer:
-                method()
+                method(**kwds)
             logger.info('Finished running <%s>. It took about %d (s)' % (
                         command, timer.duration_in_seconds()))
             report_data['duration_in_seconds'] = timer.duration_in_seconds()
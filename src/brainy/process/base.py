@@ -13,7 +13,6 @@ Copyright (c) 2014-2015 Pelkmans Lab
 import os
 import re
 import logging
-import pprint
 from datetime import datetime
 from pipette.pipes import Process as PipetteProcess
 from brainy.flags import FlagManager
@@ -21,6 +20,10 @@ from brainy.scheduler import SHORT_QUEUE, NORM_QUEUE
 from brainy.errors import (UnknownError, KnownError, TermRunLimitError,
                            check_report_file_for_errors, BrainyProcessError)
 from brainy.project.report import BrainyReporter
+from brainy.metrics import metrics
+from brainy.tracing import span
+from brainy import fs
+from brainy.log import lazy_pformat
 logger = logging.getLogger(__name__)
 
 
@@ -360,7 +363,7 @@ class BrainyProcess(PipetteProcess, FlagManager, CanSubmit):
             # Find result files only once.
             reports_regex = re.compile(self.job_report_exp)
             self.__reports = [filename for filename
-                              in os.listdir(self.reports_path)
+                              in fs.listdir(self.reports_path)
                               if reports_regex.search(filename)]
         return self.__reports
 
@@ -397,8 +400,14 @@ class BrainyProcess(PipetteProcess, FlagManager, CanSubmit):
             report_file = self.make_report_filename()
         elif not report_file.startswith('/'):
             report_file = os.path.join(self.reports_path, report_file)
-        assert os.path.exists(os.path.dirname(report_file))
-        return self.scheduler.submit_job(shell_command, queue, report_file)
+        assert fs.exists(os.path.dirname(report_file))
+        if is_resubmitting:
+            metrics.inc('brainy_jobs_resubmitted_total')
+        else:
+            metrics.inc('brainy_jobs_submitted_total')
+        with span('submit_job'):
+            return self.scheduler.submit_job(shell_command, queue,
+                                             report_file)
 
     def bake_bash_code(self, bash_code):
         return '''%(bash_call)s << BASH_CODE;
@@ -462,15 +471,16 @@ PYTHON_CODE''' % {
         if needle is None:
             # TODO: make jobs more specific. Process path is too general.
             needle = os.path.dirname(self.reports_path)
-        return self.scheduler.count_working_jobs(needle)
+        with span('working_jobs_count'):
+            return self.scheduler.count_working_jobs(needle)
 
     def put_on(self):
         super(BrainyProcess, self).put_on()
         # Create missing process folder path.
-        if not os.path.exists(self.process_path):
+        if not fs.exists(self.process_path):
             os.makedirs(self.process_path)
         # Create missing job reports folder path.
-        if not os.path.exists(self.reports_path):
+        if not fs.exists(self.reports_path):
             os.makedirs(self.reports_path)
         # Set status to
         self.results['step_status'] = 'submitting'
@@ -511,9 +521,17 @@ PYTHON_CODE''' % {
                 and self.has_runlimit() is False:
             # Independent of the fact if we have reports or not, not having any
             # data or jobs running is good enough to attempt resubmission.
-            return bool(self.has_data()) is False
+            with span('has_data'):
+                return bool(self.has_data()) is False
         return False
 
+    def decide(self, decision):
+        '''Evaluate a state decision, e.g. want_to_submit, as a span.'''
+        with span(decision, category='decision') as decision_span:
+            result = getattr(self, decision)()
+            decision_span.set(result=result)
+        return result
+
     def report(self, message, warning=''):
         if warning:
             logger.warn(warning)
@@ -526,7 +544,7 @@ PYTHON_CODE''' % {
         BrainyReporter.append_message(message)
 
     def has_runlimit(self):
-        return os.path.exists(self.get_flag('runlimit'))
+        return fs.exists(self.get_flag('runlimit'))
 
     def remove_job_report_file(self, report_filepath):
         '''Remove file from the disk as well as from the cache.'''
@@ -536,7 +554,7 @@ PYTHON_CODE''' % {
             item_index = self.__reports.index(report_filename)
             del self.__reports[item_index]
         # Remove from disk.
-        os.unlink(report_filepath)
+        fs.unlink(report_filepath)
 
     def check_logs_for_errors(self):
         for report_filename in list(self.get_job_reports()):
@@ -589,7 +607,9 @@ PYTHON_CODE''' % {
         "Check for errors" might have failed to detect the error, so we still
         need to make sure that our data was generated correctly.
         '''
-        if not self.has_data():
+        with span('has_data'):
+            has_data = self.has_data()
+        if not has_data:
             report_filepath = None
             if self.has_job_reports():
                 # Pick latest report
@@ -612,37 +632,41 @@ PYTHON_CODE''' % {
                                      job_report=report_filepath)
 
     def run(self):
-        logger.info('running process <%s> with the following parameters:' %
-                    self.name)
-        logger.info(pprint.pformat(self.parameters))
+        logger.info('running process <%s>' % self.name)
+        # Parameters are long, format them only if debugging.
+        logger.debug('parameters of <%s>:\n%s', self.name,
+                     lazy_pformat(self.parameters))
         # print self.get_job_reports()
         # print self.working_jobs_count()
         # Skip if ".complete" flag was found.
         if self.is_complete:
             self.results['step_status'] = 'completed'
         # Step is incomplete. Do we want to submit?
-        elif self.want_to_submit():
+        elif self.decide('want_to_submit'):
             if self.working_jobs_count() > 0:
                 logger.warn('Some jobs are still running, but we are '
                             'submitting everything a new!')
-            self.submit()
+            with span('submit'):
+                self.submit()
         # Submitted but no work has started yet?
-        elif self.no_work_is_happening():
+        elif self.decide('no_work_is_happening'):
             self.report('resetting', warning='No work is happening')
             self.reset_submitted()
         # Waiting.
-        elif self.still_working():
+        elif self.decide('still_working'):
             self.report('waiting')
         # Resubmit if no data output but job results found.
-        elif self.finished_work_but_has_no_data():
+        elif self.decide('finished_work_but_has_no_data'):
             # Hint: check if has_data() works correctly!
-            self.resubmit()
+            with span('resubmit'):
+                self.resubmit()
         # Check for known errors if both data output and job results are
         # present.
         else:
             logger.info('Checking logs for errors. Setting process state to '
                         'completed if none found.')
-            self.check_logs_for_errors()
+            with span('check_logs_for_errors'):
+                self.check_logs_for_errors()
             self.check_for_missed_errors()
             # At this point we have detected no errors and the data test
             # has passed -> mark process as 'completed'.
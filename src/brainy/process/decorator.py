@@ -1,5 +1,6 @@
 import logging
 from brainy.errors import BrainyProcessError
+from brainy.tracing import span
 
 logger = logging.getLogger(__name__)
 
@@ -71,8 +72,9 @@ def format_with_params(method):
         logger.info('Compiling template {%s}: %s' % (param_name,
                                                      method(self)))
         try:
-            return self.format_with_params(param_name,
-                                           method(self))
+            with span('compile_template'):
+                return self.format_with_params(param_name,
+                                               method(self))
         except Exception as error:
             raise BrainyProcessError(
                     'Compilation failed: %s' % str(error)
@@ -0,0 +1,118 @@
+'''
+brainy.profiling
+
+Record cProfile output of project runs, e.g. `brainy project run --profile`
+or sampled ticks of the daemon. Every profile is saved into
+`reports/profiles/` of the project as `.pstats` (for pstats, snakeviz, etc.)
+plus a short text summary. Only the last few profiles are kept.
+
+By default CPU time is measured, so waiting for the scheduler (`bjobs`,
+`bsub`) and for child processes is hardly visible. Including waits switches
+to wall-clock time and adds a section on the calls brainy was waiting in.
+Note that CPU time is per process, so in-process runs of the daemon also
+account the time of concurrent runs.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import pstats
+import cProfile
+import logging
+from datetime import datetime
+from StringIO import StringIO
+logger = logging.getLogger(__name__)
+
+PROFILES_FOLDER_NAME = 'profiles'
+PROFILE_EXTENSIONS = ('.pstats', '.txt')
+DEFAULT_KEEP_PROFILES = 20
+DEFAULT_STATS_LIMIT = 40
+# Calls in which brainy waits for the scheduler or child processes.
+WAIT_CALLS_EXP = r'subprocess|sh\.py|scheduler|invoke|select|poll|wait'
+
+
+class RunProfiler(object):
+
+    def __init__(self, profiles_path, include_waits=False,
+                 keep_last=DEFAULT_KEEP_PROFILES, limit=DEFAULT_STATS_LIMIT):
+        self.profiles_path = profiles_path
+        self.include_waits = include_waits
+        self.keep_last = keep_last
+        self.limit = limit
+
+    @classmethod
+    def for_project(cls, brainy_project, **kwds):
+        return cls(os.path.join(brainy_project.report_folder_path,
+                                PROFILES_FOLDER_NAME), **kwds)
+
+    @property
+    def timer(self):
+        return time.time if self.include_waits else time.clock
+
+    def profile(self, name, function, *args, **kwds):
+        '''Call function under cProfile, save the profile, return result.'''
+        profile = cProfile.Profile(self.timer)
+        started_at = time.time()
+        try:
+            return profile.runcall(function, *args, **kwds)
+        finally:
+            try:
+                self.save(name, profile, time.time() - started_at)
+                self.rotate()
+            except Exception as error:
+                # Profile is secondary to the run itself.
+                logger.error('Failed to save profile of: %s' % name)
+                logger.exception(error)
+
+    def summarize(self, name, stats, duration):
+        summary = StringIO()
+        stats.stream = summary
+        summary.write('Profile of %s\n' % name)
+        summary.write('Timer: %s\n' % ('wall-clock (includes waits)'
+                                       if self.include_waits else 'CPU'))
+        summary.write('Run took %.3f (s)\n\n' % duration)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        if self.include_waits:
+            summary.write('Waiting for the scheduler and subprocesses:\n')
+            stats.sort_stats('cumulative').print_stats(WAIT_CALLS_EXP,
+                                                       self.limit)
+        stats.sort_stats('tottime').print_stats(self.limit)
+        return summary.getvalue()
+
+    def save(self, name, profile, duration):
+        if not os.path.exists(self.profiles_path):
+            os.makedirs(self.profiles_path)
+        prefix = os.path.join(self.profiles_path, '%s-profile-%s' % (
+            name, datetime.now().strftime('%Y_%m_%d_%H%M%S_%f')))
+        profile.dump_stats(prefix + '.pstats')
+        stats = pstats.Stats(prefix + '.pstats')
+        with open(prefix + '.txt', 'w+') as stream:
+            stream.write(self.summarize(name, stats, duration))
+        logger.info('Profile of the run is saved to: %s.pstats' % prefix)
+        return prefix + '.pstats'
+
+    def list_profiles(self):
+        '''Return path prefixes of saved profiles, the oldest first.'''
+        if not os.path.exists(self.profiles_path):
+            return []
+        prefixes = set(
+            os.path.join(self.profiles_path, os.path.splitext(filename)[0])
+            for filename in os.listdir(self.profiles_path)
+            if filename.endswith(PROFILE_EXTENSIONS))
+        # Sort by the timestamp that follows the name.
+        return sorted(prefixes,
+                      key=lambda prefix: prefix.rsplit('-profile-', 1)[-1])
+
+    def rotate(self):
+        '''Delete all but keep_last profiles (zero keeps all).'''
+        if not self.keep_last:
+            return 0
+        prefixes = self.list_profiles()[:-self.keep_last]
+        for prefix in prefixes:
+            for extension in PROFILE_EXTENSIONS:
+                if os.path.exists(prefix + extension):
+                    os.unlink(prefix + extension)
+        return len(prefixes)
@@ -12,17 +12,21 @@ Copyright (c) 2014-2015 Pelkmans Lab
 
 import os
 import sys
-import shutil
 import logging
 from glob import glob
 from brainy.version import brainy_version
 from brainy.utils import merge_dicts
 from brainy.config import (write_project_config, load_project_config,
-                           project_has_config)
+                           load_merged_project_config, project_has_config)
 from brainy.scheduler import BrainyScheduler
 from brainy.pipes.manager import PipesManager
 from brainy.errors import BrainyProjectError
+from brainy.trash import TrashBin, DEFAULT_SWEEP_WORKERS
 from brainy.project.report import report_data
+from brainy.project.fingerprint import (ProjectFingerprint,
+                                        get_project_fingerprint,
+                                        get_project_state)
+from brainy.metrics import metrics
 logger = logging.getLogger(__name__)
 
 
@@ -38,6 +42,9 @@ class BrainyProject(object):
             self.path = path
         self.config = None
         self.scheduler = None
+        # Jobs listing taken by the daemon, see brainy.scheduler.snapshot
+        self.scheduler_snapshot = None
+        self.pipes = None
         self.workflow_locations = workflow_locations
 
     @property
@@ -51,6 +58,7 @@ class BrainyProject(object):
     def seed_report_data(self):
         '''Put meta data about this project into report'''
         logger.info('Seeding report data.')
+        report_data.clear()
         report_data['project'] = {
             'brainy_version': brainy_version,
             'name': self.name,
@@ -123,37 +131,65 @@ class BrainyProject(object):
             return
         prepend_path = self.config['languages']['python']['path']
         assert type(prepend_path) == list
+        # Daemon runs many projects in the same process. Never extend twice.
+        prepend_path = [path for path in prepend_path if path not in sys.path]
         if len(prepend_path) > 0:
             logger.info('Extending sys.path with: %s' % prepend_path)
             sys.path = prepend_path + sys.path
 
-    def load_config(self, brainy_config):
+    def load_config(self, brainy_config=None):
         '''
         Pass global merged brainy config to be overridden by project config.
+        If brainy_config is None, the (cached) merge of user, framework and
+        project configs is loaded.
         '''
+        if brainy_config is None:
+            self.config = load_merged_project_config(self.path)
+            self.extend_python_path()
+            return
         # In brainy.config.py, load the project's workflow.
         project_config = load_project_config(self.path)
         logger.info('Overwriting global configuration with project specific.')
         self.config = merge_dicts(brainy_config, project_config)
         self.extend_python_path()
 
-    def clean(self, brainy_config, manager_cls=PipesManager):
-        '''Clean the project house.'''
+    @property
+    def trash(self):
+        return TrashBin.for_project(self.path)
+
+    def clean(self, brainy_config=None, manager_cls=PipesManager,
+              sweep_in_background=True, workers=DEFAULT_SWEEP_WORKERS):
+        '''
+        Clean the project house. Output folders are moved into trash, which
+        is swept either by a detached background process (default) or right
+        away in the foreground.
+        '''
         logger.info('<brainy rolls over the project to clean the house>')
         logger.info('Loading configuration')
         # Pass global merged brainy config to be overridden by project config.
         self.load_config(brainy_config)
         self.pipes = manager_cls(self)
-        logger.info('Removing all the output data of every pipeline.')
+        logger.info('Moving the output data of every pipeline to trash.')
         self.pipes.run('clean_pipelines_output')
         if os.path.exists(self.report_folder_path):
-            logger.info('Removing all the reports in: %s' %
+            logger.info('Moving all the reports to trash: %s' %
                         self.report_folder_path)
-            shutil.rmtree(self.report_folder_path)
+            self.trash.discard(self.report_folder_path)
+        if sweep_in_background:
+            self.trash.sweep_in_background(workers=workers)
+        else:
+            self.sweep(workers=workers)
         logger.info('<Done>')
 
-    def run(self, brainy_config, manager_cls=PipesManager,
-            command='process_pipelines'):
+    def sweep(self, workers=DEFAULT_SWEEP_WORKERS):
+        '''Delete (or resume deleting) everything left in project trash.'''
+        logger.info('Sweeping project trash: %s' % self.trash.path)
+        removed = self.trash.sweep(workers=workers)
+        logger.info('Removed %d entries from trash.' % removed)
+
+    def run(self, brainy_config=None, manager_cls=PipesManager,
+            command='process_pipelines', reuse_pipes=False, only=None,
+            from_pipe=None):
         '''
         This function is the core of `brainy`, looks at the workflow made of
         loaded YAML files and executes the tasks according to the YAML encoded
@@ -161,16 +197,66 @@ class BrainyProject(object):
 
         Load project configuration. Discover and process pipelines using the
         specified scheduler.
+
+        Return False if processing was skipped, since project state has not
+        changed since the last run that did nothing (see
+        brainy.project.fingerprint).
+
+        With reuse_pipes, pipes parsed by the previous run are kept (see
+        brainy.project.watch).
+
+        Pipelines can be limited to the `only` list of `pipe[:step]`
+        specifications and (or) to those starting `from_pipe` (see
+        PipesManager.select_pipelines()).
         '''
+        selective = bool(only) or from_pipe is not None
+        if selective and command != 'process_pipelines':
+            raise BrainyProjectError('Only processing of pipelines can be '
+                                     'limited to selected pipes.')
         logger.info('<brainy rolls over the project to {%s}>' % command)
         logger.info('Loading configuration')
         # Pass global merged brainy config to be overridden by project config.
         self.load_config(brainy_config)
-        self.seed_report_data()
         logger.info('Initializing "%s" as a scheduling engine.' %
                     self.config['scheduling']['engine'])
         self.scheduler = BrainyScheduler.build_scheduler(
-            self.config['scheduling']['engine'])
-        self.pipes = manager_cls(self)
-        self.pipes.run(command)
+            self.config['scheduling']['engine'],
+            snapshot=self.scheduler_snapshot,
+            snapshot_ttl=self.config['scheduling'].get('snapshot_ttl', 60))
+        fingerprint = None
+        # A selective run proves nothing about the other pipes.
+        if command == 'process_pipelines' and not selective and \
+                self.config['brainy'].get('skip_unchanged_runs', False):
+            state = get_project_state(self.path)
+            fingerprint = get_project_fingerprint(self.path, self.scheduler,
+                                                  state=state)
+            last_fingerprint = ProjectFingerprint(self.report_folder_path)
+            if last_fingerprint.matches(
+                    fingerprint,
+                    max_age=self.config['brainy'].get(
+                        'unchanged_run_max_age', 3600)):
+                logger.info('Nothing has changed since the last run. '
+                            'Skipping.')
+                metrics.inc('brainy_project_runs_skipped_total')
+                return False
+        self.seed_report_data()
+        if not reuse_pipes or not isinstance(self.pipes, manager_cls):
+            self.pipes = manager_cls(self)
+        run_params = dict()
+        if selective:
+            run_params['pipelines'] = self.pipes.select_pipelines(
+                only=only, from_pipe=from_pipe)
+        with metrics.timer('brainy_project_run_seconds', project=self.path):
+            self.pipes.run(command, **run_params)
+        metrics.inc('brainy_project_runs_total')
+        if fingerprint is not None:
+            # Only a run that has changed nothing proves that running on the
+            # same state again is pointless. Jobs are not queried again: the
+            # scheduler still holds its listing from before the run, while
+            # every submission of the run leaves a flag anyway.
+            if get_project_state(self.path) == state:
+                last_fingerprint.store(fingerprint)
+            else:
+                last_fingerprint.reset()
         logger.info('<Done>')
+        return True
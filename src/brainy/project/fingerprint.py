@@ -0,0 +1,99 @@
+'''
+brainy.project.fingerprint
+
+Cheap fingerprint of the project state: flag files, mtimes of job report
+folders and workflow files (see brainy.watcher) and states of the project's
+jobs as known to the scheduler. A run that leaves the fingerprint unchanged
+is a no-op, so the next run on the same fingerprint can be skipped.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import hashlib
+import logging
+from brainy import fs
+from brainy.watcher import (PollingWatcher, list_pipe_folders,
+                            listing_cache)
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_NAME = '.fingerprint'
+FLAG_EXTENSIONS = ('.submitted', '.resubmitted', '.complete', '.runlimit')
+
+
+def list_flags(project_path):
+    '''
+    List flags of the pipe output folders. Folders are listed only if they
+    have changed (see brainy.watcher.ListingCache).
+    '''
+    flags = list()
+    for pipe_path, pipe_stat in list_pipe_folders(project_path):
+        try:
+            names = listing_cache.listdir(pipe_path, pipe_stat)
+        except OSError:
+            continue
+        flags.extend(os.path.join(pipe_path, name) for name in names
+                     if name.endswith(FLAG_EXTENSIONS))
+    return sorted(flags)
+
+
+def get_project_state(project_path):
+    '''Describe flags, job report folders and workflow files.'''
+    snapshot = PollingWatcher.take_snapshot(project_path)
+    return repr(sorted(snapshot.items())) + repr(list_flags(project_path))
+
+
+def get_project_fingerprint(project_path, scheduler=None, state=None):
+    '''
+    Hash the state of the project (see get_project_state()) and, if the
+    scheduler is given, states of the project jobs.
+    '''
+    if state is None:
+        state = get_project_state(project_path)
+    digest = hashlib.sha1()
+    digest.update(state)
+    if scheduler is not None:
+        digest.update(repr(scheduler.get_job_states(key=project_path)))
+    return digest.hexdigest()
+
+
+class ProjectFingerprint(object):
+    '''
+    Fingerprint of the last no-op run, stored inside the reports folder of
+    the project (which is not a part of the fingerprint).
+    '''
+
+    def __init__(self, reports_folder_path):
+        self.path = os.path.join(reports_folder_path, FINGERPRINT_NAME)
+
+    def load(self):
+        if not fs.exists(self.path):
+            return None
+        with fs.open_file(self.path) as stream:
+            return stream.read().strip()
+
+    def matches(self, fingerprint, max_age=0):
+        '''
+        Check if fingerprint equals the one of the last no-op run. Stored
+        fingerprint expires after max_age seconds (zero never expires).
+        '''
+        if fingerprint != self.load():
+            return False
+        if max_age and time.time() - fs.stat(self.path).st_mtime > max_age:
+            logger.info('Project fingerprint has expired.')
+            return False
+        return True
+
+    def store(self, fingerprint):
+        folder = os.path.dirname(self.path)
+        if not fs.exists(folder):
+            fs.makedirs(folder)
+        with fs.open_file(self.path, 'w+') as stream:
+            stream.write(fingerprint)
+
+    def reset(self):
+        if fs.exists(self.path):
+            fs.unlink(self.path)
@@ -12,13 +12,72 @@ Project manager. Part of brainy daemon.
 Copyright (c) 2014-2015 Pelkmans Lab
 '''
 import os
+import json
+import time
 import logging
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from brainy.log import json_handler
+from brainy.config import load_brainy_config
+from brainy.scheduler import BrainyScheduler
+from brainy.scheduler.snapshot import SCHEDULER_SNAPSHOT_ENV
 from brainy.utils import load_yaml, dump_yaml
-# Import everything from a command line interface.
-from sh import brainy as brainy_shell
+from brainy.trash import TrashBin, DEFAULT_SWEEP_WORKERS
+from brainy.project.report import BrainyReporter
+from brainy.metrics import metrics
+from brainy.profiling import RunProfiler
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_PROJECT_WORKERS = 4
+# How often (in seconds) the daemon checks on projects being run in-process.
+POLLING_INTERVAL = 0.2
+# The daemon never waits for an in-process run longer than that (in seconds),
+# even if no timeout was given.
+MAX_PROJECT_WAIT = 3600
+# Subprocess runs leave their results (e.g. metrics) for the daemon in the
+# file named by this environment variable, see save_run_result().
+RUN_RESULT_ENV = 'BRAINY_RUN_RESULT'
+
+
+def get_brainy_shell():
+    '''
+    Import everything from a command line interface. This is deferred, so
+    that in-process runs do not need `brainy` to be on the PATH.
+    '''
+    from sh import brainy as brainy_shell
+    return brainy_shell
+
+
+def save_run_result(brainy_project, has_run):
+    '''
+    Called by `brainy project run` to pass counters of the run and
+    completeness of the project back to the daemon. Does nothing unless the
+    daemon has asked for the result.
+    '''
+    result_path = os.environ.get(RUN_RESULT_ENV)
+    if not result_path:
+        return
+    is_complete = None
+    if has_run and brainy_project.pipes is not None:
+        is_complete = brainy_project.pipes.all_pipelines_complete
+    with open(result_path, 'w+') as stream:
+        json.dump({
+            'has_run': has_run,
+            'is_complete': is_complete,
+            'counters': metrics.dump_counters(),
+        }, stream)
+
+
+def load_run_result(result_path):
+    '''Return result left by the subprocess run or None.'''
+    try:
+        with open(result_path) as stream:
+            return json.load(stream)
+    except (IOError, ValueError):
+        return None
+
 
 class FatalProjectError(object):
     '''Stop any further progress'''
@@ -26,11 +85,23 @@ class FatalProjectError(object):
 
 class ProjectManager(object):
 
-    def __init__(self, project_list_path, create_missing_project_folders=True):
+    def __init__(self, project_list_path, create_missing_project_folders=True,
+                 schedule=None):
         self.project_list_path = project_list_path
         self.create_missing_project_folders = create_missing_project_folders
+        # Optional brainy.project.schedule.ProjectSchedule. Without it every
+        # project is run on every call of run_projects().
+        self.schedule = schedule
         self._projects = []
         self.load_projects()
+        # Worker pool of in-process project runs. It outlives a single tick,
+        # because timed out runs can not be killed and keep their workers.
+        self._pool = None
+        self._pool_size = None
+        # Paths of projects which are queued or still being run (e.g. timed
+        # out), mapped to the time their run has actually started.
+        self._running = dict()
+        self._running_lock = threading.Lock()
 
     @property
     def projects(self):
@@ -101,9 +172,8 @@ class ProjectManager(object):
                 # Was project initialized?
                 if not project['is_initialized']:
                     logger.info('Initializing {%s}' % project['name'])
-                    output = brainy_shell.project('create',
-                                                  '-p', project['path'],
-                                                  project['name'])
+                    output = get_brainy_shell().project(
+                        'create', '-p', project['path'], project['name'])
                     if output.exit_code != 0:
                         self.log_shell_output(output, level=logging.ERROR)
                         logger.error('Failed to initialize project: %s' %
@@ -115,15 +185,215 @@ class ProjectManager(object):
         except Exception as error:
             logger.exception(error)
 
-    def run_projects(self):
+    def run_project_in_process(self, project, scheduler_snapshot=None,
+                               profile_waits=None):
+        '''
+        Run an initialized project inside the daemon process. This is called
+        by worker threads, see run_projects_in_process(). Unless
+        profile_waits is None, the run is profiled (see brainy.profiling).
+        '''
+        # Import here to avoid circular imports.
+        from brainy.project.base import BrainyProject
+        with self._running_lock:
+            self._running[project['path']] = time.time()
+        try:
+            brainy_project = BrainyProject(project['name'], project['path'])
+            if not brainy_project.is_a_valid_project_folder():
+                logger.error('Path is not a valid brainy project: %s' %
+                             brainy_project.path)
+                return False
+            if scheduler_snapshot is not None:
+                brainy_project.scheduler_snapshot = \
+                    scheduler_snapshot.for_project(project['path'])
+            # Every run starts with a fresh log of its own thread.
+            json_handler.reset_output()
+            if profile_waits is None:
+                has_run = brainy_project.run()
+            else:
+                profiling_config = load_brainy_config().get('profiling', {})
+                profiler = RunProfiler.for_project(
+                    brainy_project, include_waits=profile_waits,
+                    keep_last=profiling_config.get('keep_last', 20),
+                    limit=profiling_config.get('limit', 40))
+                has_run = profiler.profile(brainy_project.name,
+                                           brainy_project.run)
+            if self.schedule is not None:
+                # Skipped run keeps completeness known from before.
+                self.schedule.record_run(
+                    project['path'],
+                    is_complete=brainy_project.pipes.all_pipelines_complete
+                    if has_run else None)
+            return True
+        except BaseException as error:
+            # E.g. SystemExit of load_user_config() must not kill the worker
+            # thread, or the result of the run would never be ready.
+            logger.error('Failed to run project: %s' % project['name'])
+            logger.exception(error)
+            if self.schedule is not None:
+                self.schedule.record_run(project['path'])
+            return False
+        finally:
+            with self._running_lock:
+                del self._running[project['path']]
+
+    def get_pool(self, workers):
+        if self._pool is None or self._pool_size != workers:
+            if self._pool is not None:
+                # Let the old workers finish what they have been running.
+                self._pool.close()
+            self._pool = ThreadPool(workers)
+            self._pool_size = workers
+        return self._pool
+
+    def run_projects_in_process(self, workers=DEFAULT_PROJECT_WORKERS,
+                                timeout=None, only_paths=None,
+                                scheduler_snapshot=None, profile_waits=None):
+        '''
+        Run initialized projects in-process on a bounded pool of worker
+        threads. Reporter state and logs are isolated per thread, while
+        caches (config, pipe and process classes) are shared. A project that
+        takes longer than `timeout` seconds (at most MAX_PROJECT_WAIT) is
+        reported and left running; it is skipped by the next ticks until it
+        finishes.
+        '''
+        logger.info('Run brainy projects in-process (%d workers)' % workers)
+        if json_handler not in logging.root.handlers:
+            # Logs of every run end up in its report.
+            logging.root.addHandler(json_handler)
+        pool = self.get_pool(max(1, workers))
+        pending = dict()
+        try:
+            for project in self.projects:
+                if not project['is_initialized'] or (
+                        only_paths is not None and
+                        project['path'] not in only_paths):
+                    continue
+                with self._running_lock:
+                    if project['path'] in self._running:
+                        logger.warn('Project {%s} is still running. '
+                                    'Skipping.' % project['name'])
+                        continue
+                    # Not started yet.
+                    self._running[project['path']] = None
+                logger.info('Running {%s}' % project['name'])
+                pending[project['path']] = (
+                    project['name'],
+                    pool.apply_async(self.run_project_in_process,
+                                     (project, scheduler_snapshot,
+                                      profile_waits)))
+        except Exception as error:
+            logger.exception(error)
+        # Wait for the results, giving up on runs that time out.
+        max_wait = min(timeout or MAX_PROJECT_WAIT, MAX_PROJECT_WAIT)
+        waiting_since = time.time()
+        while pending:
+            time.sleep(POLLING_INTERVAL)
+            for path, (name, result) in pending.items():
+                if result.ready():
+                    del pending[path]
+                    continue
+                # Runs queued behind others are waited for since the start.
+                started_at = self._running.get(path) or waiting_since
+                if time.time() - started_at > max_wait:
+                    del pending[path]
+                    logger.error('Project {%s} did not finish in %d (s). '
+                                 'Leaving it running in background.' %
+                                 (name, max_wait))
+
+    def select_due_projects(self):
+        '''Ask the schedule which of the initialized projects are due.'''
+        project_paths = [project['path'] for project in self.projects
+                         if project['is_initialized']]
+        self.schedule.forget(project_paths)
+        return self.schedule.select_due(project_paths)
+
+    def take_scheduler_snapshot(self, only_paths=None):
+        '''
+        Query the default scheduling engine for all the jobs once and index
+        them by project. Return None if the engine does not support
+        snapshots.
+        '''
+        engine = load_brainy_config()['scheduling']['engine']
+        scheduler = BrainyScheduler.build_scheduler(engine)
+        if not scheduler.accepts_snapshots:
+            return None
+        project_paths = [project['path'] for project in self.projects
+                         if only_paths is None or
+                         project['path'] in only_paths]
+        if not project_paths:
+            return None
+        snapshot = scheduler.take_snapshot()
+        snapshot.index_projects(project_paths)
+        logger.info('Took a snapshot of %d %s job(s).' %
+                    (len(snapshot.lines), engine))
+        self.count_scheduler_jobs(engine, snapshot)
+        return snapshot
+
+    def count_scheduler_jobs(self, engine, snapshot):
+        '''Update gauges of jobs by state from the snapshot.'''
+        scheduler = BrainyScheduler.build_scheduler(engine, snapshot=snapshot)
+        counts = dict((state, 0) for state in ('PEND', 'RUN'))
+        for job_id, state in scheduler.get_job_states():
+            counts[state] = counts.get(state, 0) + 1
+        for state, count in counts.items():
+            metrics.set('brainy_scheduler_jobs', count, state=state)
+
+    def run_projects(self, in_process=False,
+                     workers=DEFAULT_PROJECT_WORKERS, timeout=None,
+                     only_paths=None, share_scheduler_snapshot=True,
+                     profile_waits=None):
+        '''
+        Run initialized projects. If only_paths is given, other projects are
+        skipped (see brainy.watcher). Otherwise, if there is a schedule, only
+        the due projects are run. All the runs share a single snapshot of
+        scheduler jobs, unless share_scheduler_snapshot is False. Runs are
+        profiled unless profile_waits is None.
+        '''
+        try:
+            if only_paths is None and self.schedule is not None:
+                only_paths = self.select_due_projects()
+        except Exception as error:
+            logger.exception(error)
+        scheduler_snapshot = None
+        if share_scheduler_snapshot:
+            try:
+                scheduler_snapshot = self.take_scheduler_snapshot(only_paths)
+            except Exception as error:
+                logger.warn('Failed to take a scheduler snapshot: %s' % error)
+        if in_process:
+            self.run_projects_in_process(
+                workers=workers, timeout=timeout, only_paths=only_paths,
+                scheduler_snapshot=scheduler_snapshot,
+                profile_waits=profile_waits)
+        else:
+            self.run_projects_in_subprocesses(
+                only_paths=only_paths, scheduler_snapshot=scheduler_snapshot,
+                profile_waits=profile_waits)
+        if self.schedule is not None:
+            self.schedule.save()
+
+    def run_projects_in_subprocesses(self, only_paths=None,
+                                     scheduler_snapshot=None,
+                                     profile_waits=None):
         logger.info('Run brainy projects')
+        env = dict(os.environ)
+        if scheduler_snapshot is not None:
+            env[SCHEDULER_SNAPSHOT_ENV] = scheduler_snapshot.save()
+        profile_args = list()
+        if profile_waits is not None:
+            profile_args.append('--profile')
+            if profile_waits:
+                profile_args.append('--profile-waits')
         try:
             for project in self.projects:
+                if only_paths is not None and \
+                        project['path'] not in only_paths:
+                    continue
                 # Was project initialized?
                 if project['is_initialized']:
                     logger.info('Running {%s}' % project['name'])
-                    output = brainy_shell.project('run',
-                                                  '-p', project['path'])
+                    output = self.run_project_in_subprocess(
+                        project, env, profile_args)
                     if output.exit_code != 0:
                         self.log_shell_output(output, level=logging.ERROR)
                         logger.error('Failed to run project: %s' %
@@ -134,3 +404,65 @@ class ProjectManager(object):
         except Exception as error:
             logger.exception(error)
 
+    def run_project_in_subprocess(self, project, env, args=()):
+        '''
+        Run `brainy project run` and add the counters of the run to the
+        metrics of the daemon. The run is timed here, including the start of
+        the subprocess. Then reschedule the project, if there is a schedule.
+        '''
+        handle, result_path = tempfile.mkstemp(prefix='brainy-run-',
+                                               suffix='.json')
+        os.close(handle)
+        env = dict(env)
+        env[RUN_RESULT_ENV] = result_path
+        started_at = time.time()
+        try:
+            return get_brainy_shell().project('run', '-p', project['path'],
+                                              *args, _env=env)
+        finally:
+            result = load_run_result(result_path)
+            os.unlink(result_path)
+            if result is not None:
+                metrics.add_counters(result['counters'])
+            if self.schedule is not None:
+                # Failed run is never complete, skipped one (None) keeps
+                # completeness known from before.
+                is_complete = False
+                if result is not None and result['has_run'] is not None:
+                    is_complete = result['is_complete']
+                self.schedule.record_run(project['path'],
+                                         is_complete=is_complete)
+            # Skipped runs are not timed, like in-process ones.
+            if result is None or result['has_run'] is not False:
+                metrics.observe('brainy_project_run_seconds',
+                                time.time() - started_at,
+                                project=project['path'])
+
+    def sweep_trash(self, workers=DEFAULT_SWEEP_WORKERS):
+        '''
+        Make sure trash of every project is being swept. Sweepers are detached
+        so that a huge trash never stalls the daemon.
+        '''
+        try:
+            for project in self.projects:
+                trash = TrashBin.for_project(project['path'])
+                if trash.sweep_in_background(workers=workers):
+                    logger.info('Sweeping trash of {%s}' % project['name'])
+        except Exception as error:
+            logger.exception(error)
+
+    def flush_report_indexes(self, deferred_interval=0):
+        '''
+        Regenerate report listings of the web UI that were deferred by
+        project runs. Listings are regenerated in a batch, at most once in
+        `deferred_interval` seconds per project.
+        '''
+        try:
+            for project in self.projects:
+                reports_folder_path = os.path.join(project['path'], 'reports')
+                if not BrainyReporter.index_is_dirty(reports_folder_path):
+                    continue
+                BrainyReporter.update_or_generate_static_html(
+                    reports_folder_path, deferred_interval=deferred_interval)
+        except Exception as error:
+            logger.exception(error)
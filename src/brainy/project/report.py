@@ -1,18 +1,160 @@
 import os
+import re
+import json
+import time
 import yaml
 import shutil
+import zipfile
+import threading
+from collections import MutableMapping
+from contextlib import closing
 from glob import glob
 from datetime import datetime
-from brainy.log import json_handler
+from brainy.log import json_handler, LOG_SPILL_EXTENSION
+from brainy.utils import Dumper, SafeDumper
+from brainy.trash import ignore_missing
+from brainy.metrics import metrics
 import logging
 logger = logging.getLogger(__name__)
 
+
+class ReportState(threading.local):
+    '''
+    Report of the project being run by the current thread. The daemon runs
+    several projects in-process at once, each in its own worker thread.
+    '''
+
+    def __init__(self):
+        self.data = {}
+        # Set by BrainyReporter.start_report() if report events are streamed.
+        self.stream = None
+        # Path of the YAML report, chosen when the report is started.
+        self.filepath = None
+
+
+report_state = ReportState()
+
+
+class ReportData(MutableMapping):
+    '''Dictionary-like view of the report data of the current thread.'''
+
+    def __getitem__(self, key):
+        return report_state.data[key]
+
+    def __setitem__(self, key, value):
+        report_state.data[key] = value
+
+    def __delitem__(self, key):
+        del report_state.data[key]
+
+    def __iter__(self):
+        return iter(report_state.data)
+
+    def __len__(self):
+        return len(report_state.data)
+
+    def clear(self):
+        report_state.data = {}
+
+    def to_dict(self):
+        return report_state.data
+
+
 # This is a global namespace variable containing a DOM-like structure of
 # project report. It is mainly modified during `brainy run project` call.
-report_data = {}
+report_data = ReportData()
+
+# Report backends: 'yaml' keeps the whole report in report_data and dumps it
+# at the end of the run, 'jsonl' streams report events to disk as they happen.
+REPORT_BACKENDS = ('yaml', 'jsonl')
+# Message types that are streamed as 'error' events.
+ERROR_MESSAGE_TYPES = ('known_error', 'unknown_error')
+# With the 'jsonl' backend, at most that much of the run log is kept in
+# memory. Older records are streamed as 'log' events.
+STREAMED_LOG_MAX_BYTES = 64 * 1024
+
+
+class ReportStream(object):
+    '''
+    Append-only writer of report events as JSON lines. Every event is
+    flushed right away, so a crash loses at most the event being written.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.stream = open(filepath, 'a')
+        # Reuse a single encoder, which is C-accelerated for compact output.
+        self.encoder = json.JSONEncoder(separators=(',', ':'), default=str)
+
+    def write_event(self, event, **fields):
+        fields['event'] = event
+        self.stream.write(self.encoder.encode(fields) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        if not self.stream.closed:
+            self.stream.close()
+
+
+def iter_report_events(filepath):
+    '''Iterate events of a JSON lines report one by one.'''
+    with open(filepath) as stream:
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Last line of a crashed run can be truncated.
+                logger.warn('Skipping broken report event in: %s' % filepath)
+
+
+def materialize_report(jsonl_filepath, yaml_filepath):
+    '''
+    Rebuild the usual YAML report layout (as consumed by the web UI) out of
+    the streamed JSON lines events.
+    '''
+    data = {}
+    pipes = []
+    log = []
+    for event in iter_report_events(jsonl_filepath):
+        kind = event.pop('event')
+        if kind == 'start':
+            data.update(event)
+            data.setdefault('project', {})['pipes'] = pipes
+        elif kind == 'log':
+            log.append(event['record'])
+        elif kind == 'finish':
+            # Streamed records are older than the ones left in memory.
+            log.extend(event.pop('log', []))
+            data.update(event)
+            data['log'] = log
+        elif kind == 'pipe':
+            event['processes'] = []
+            pipes.append(event)
+        elif kind == 'process':
+            if not pipes:
+                continue
+            pipes[-1]['processes'].append(event)
+        elif kind in ('message', 'error'):
+            if not pipes or not pipes[-1]['processes']:
+                continue
+            process = pipes[-1]['processes'][-1]
+            process.setdefault('messages', []).append(event)
+    # Events hold only JSON types, so no python specific tags are needed.
+    with open(yaml_filepath, 'w+') as yaml_reportfile:
+        yaml.dump(data, yaml_reportfile, Dumper=SafeDumper,
+                  default_flow_style=False)
+    return yaml_filepath
 
 UI_WEB_PATH = os.path.join(os.path.expanduser('~/.brainy'), 'ui', 'web')
 
+# Append-only list of saved reports, from the oldest to the newest.
+REPORTS_INDEX_NAME = 'reports.index'
+# Reports are archived by day of the timestamp in their filename.
+REPORT_DAY_EXP = re.compile(r'-report-(\d{4}_\d{2}_\d{2})_\d{6}\.')
+
 
 class BrainyReporter(object):
 
@@ -21,57 +163,328 @@ class BrainyReporter(object):
         return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     @classmethod
-    def start_report(cls):
+    def make_report_filepath(cls, report_filepath, extension='yaml'):
+        reports_folder = os.path.dirname(report_filepath)
+        if not os.path.exists(reports_folder):
+            logger.info('Creating missing reports folder: %s' % reports_folder)
+            os.makedirs(reports_folder)
+        now_str = datetime.now().strftime('%Y_%m_%d_%H%M%S')
+        return '%s-report-%s.%s' % (report_filepath, now_str, extension)
+
+    @classmethod
+    def start_report(cls, report_filepath=None, backend='yaml',
+                     log_max_bytes=0):
+        '''
+        Start a new report. With the 'jsonl' backend report events are
+        streamed into a file next to report_filepath instead of being
+        accumulated in report_data. If log_max_bytes is given, at most that
+        much of the run log is kept in memory, older records are spilled
+        into a gzipped file next to the report. A streamed report keeps at
+        most STREAMED_LOG_MAX_BYTES of the log in memory and streams older
+        records as 'log' events.
+        '''
+        if backend not in REPORT_BACKENDS:
+            raise Exception('Unknown report backend: %s' % backend)
         report_data['started_at'] = cls.get_now_str()
+        report_state.stream = None
+        report_state.filepath = None
+        if report_filepath is not None:
+            report_state.filepath = cls.make_report_filepath(report_filepath)
+        if backend == 'jsonl':
+            stream_filepath = os.path.splitext(report_state.filepath)[0] + \
+                '.jsonl'
+            logger.info('Streaming report events into: %s' % stream_filepath)
+            report_state.stream = ReportStream(stream_filepath)
+            report_state.stream.write_event(
+                'start', started_at=report_data['started_at'],
+                project=report_data.get('project', {}))
+            stream = report_state.stream
+            json_handler.capture(
+                min(log_max_bytes or STREAMED_LOG_MAX_BYTES,
+                    STREAMED_LOG_MAX_BYTES),
+                spill_writer=lambda record: stream.write_event(
+                    'log', record=record))
+        elif log_max_bytes and report_state.filepath is not None:
+            json_handler.capture(
+                log_max_bytes,
+                os.path.splitext(report_state.filepath)[0] +
+                LOG_SPILL_EXTENSION)
 
     @classmethod
     def finalize_report(cls):
         '''Produce final report structure as JSON'''
         report_data['finished_at'] = cls.get_now_str()
-        report_data['log'] = json_handler.houtput.root  # points to dictionary
+        houtput = json_handler.houtput
+        report_data['log'] = houtput.root  # points to dictionary
+        if getattr(houtput, 'spilled', 0) and houtput.spill_filepath:
+            houtput.close_spill()
+            # Older records of the log are in a file next to the report.
+            report_data['log_spill'] = {
+                'filepath': os.path.basename(houtput.spill_filepath),
+                'records': houtput.spilled,
+            }
+        if report_state.stream is not None:
+            extra = dict()
+            for key in ('timings', 'fs_calls', 'log_spill'):
+                if key in report_data:
+                    extra[key] = report_data[key]
+            report_state.stream.write_event(
+                'finish', finished_at=report_data['finished_at'],
+                log=report_data['log'], **extra)
+            # Stream is about to be closed, keep later records in memory.
+            json_handler.capture(0)
 
     @classmethod
-    def save_report(cls, report_filepath):
-        reports_folder = os.path.dirname(report_filepath)
-        if not os.path.exists(reports_folder):
-            logger.info('Creating missing reports folder: %s' % reports_folder)
-            os.makedirs(reports_folder)
-        now_str = datetime.now().strftime('%Y_%m_%d_%H%M%S')
+    def save_report(cls, report_filepath, materialize_yaml=True):
+        '''
+        Save the report and return its path. Streamed report is closed and,
+        optionally, materialized into the usual YAML layout.
+        '''
+        if report_state.stream is not None:
+            stream_filepath = report_state.stream.filepath
+            report_state.stream.close()
+            report_state.stream = None
+            if not materialize_yaml:
+                return stream_filepath
+            yaml_report_filepath = stream_filepath[:-len('jsonl')] + 'yaml'
+            return materialize_report(stream_filepath, yaml_report_filepath)
         # Output a human readable YAML file.
-        yaml_report_filepath = '%s-report-%s.yaml' % (report_filepath, now_str)
+        yaml_report_filepath = report_state.filepath or \
+            cls.make_report_filepath(report_filepath)
+        report_state.filepath = None
         with open(yaml_report_filepath, 'w+') as yaml_reportfile:
-            yaml_reportfile.write(yaml.dump(report_data,
-                                  default_flow_style=False))
+            yaml.dump(report_data.to_dict(), yaml_reportfile, Dumper=Dumper,
+                      default_flow_style=False)
+        return yaml_report_filepath
+
+    @classmethod
+    def index_report(cls, reports_folder_path, report_filepath,
+                     global_index=False):
+        '''
+        Index the saved report and its messages into the SQLite database of
+        the project and, optionally, into the global one.
+        '''
+        from brainy.project.reportdb import (
+            ReportDatabase, GLOBAL_REPORTS_DB_PATH, iter_messages_of_report,
+            iter_messages_of_stream)
+        databases = [ReportDatabase.for_reports_folder(reports_folder_path)]
+        if global_index:
+            databases.append(ReportDatabase(GLOBAL_REPORTS_DB_PATH))
+        stream_filepath = os.path.splitext(report_filepath)[0] + '.jsonl'
+        for database in databases:
+            if os.path.exists(stream_filepath):
+                # Streamed events were not accumulated in report_data.
+                messages = iter_messages_of_stream(stream_filepath)
+            else:
+                messages = iter_messages_of_report(report_data)
+            try:
+                database.index_report(
+                    project=report_data.get('project', {}).get('name'),
+                    report_path=report_filepath,
+                    messages=messages,
+                    started_at=report_data.get('started_at'),
+                    finished_at=report_data.get('finished_at'))
+            except Exception as error:
+                # Index is secondary to the report itself.
+                logger.error('Failed to index report into: %s' %
+                             database.db_path)
+                logger.exception(error)
+
+    @classmethod
+    def move_indexed_reports(cls, reports_folder_path, moves,
+                             global_index=False):
+        '''
+        Update report paths in the SQLite databases that exist, see
+        ReportDatabase.move_reports().
+        '''
+        from brainy.project.reportdb import (ReportDatabase,
+                                             GLOBAL_REPORTS_DB_PATH)
+        databases = [ReportDatabase.for_reports_folder(reports_folder_path)]
+        if global_index:
+            databases.append(ReportDatabase(GLOBAL_REPORTS_DB_PATH))
+        for database in databases:
+            if not os.path.exists(database.db_path):
+                continue
+            try:
+                database.move_reports(moves)
+            except Exception as error:
+                logger.error('Failed to update report index: %s' %
+                             database.db_path)
+                logger.exception(error)
+
+    @classmethod
+    def get_index_path(cls, reports_folder_path):
+        return os.path.join(reports_folder_path, REPORTS_INDEX_NAME)
+
+    @classmethod
+    def get_dirty_flag_path(cls, reports_folder_path):
+        return os.path.join(reports_folder_path, '.reports_dirty')
+
+    @classmethod
+    def list_reports(cls, reports_folder_path):
+        '''
+        Return report pathnames from the oldest to the newest. The list is
+        kept in an append-only index file, so that reports are globbed only
+        once (for projects predating the index).
+        '''
+        index_path = cls.get_index_path(reports_folder_path)
+        if not os.path.exists(index_path):
+            report_list = glob(os.path.join(reports_folder_path,
+                                            '*-report-*.yaml'))
+            # Streamed reports that were not materialized into YAML.
+            report_list.extend(
+                filepath for filepath in glob(os.path.join(
+                    reports_folder_path, '*-report-*.jsonl'))
+                if not os.path.exists(filepath[:-len('jsonl')] + 'yaml'))
+            report_list.sort()
+            cls.write_index(reports_folder_path, report_list)
+            return report_list
+        with open(index_path) as index_file:
+            return [line.strip() for line in index_file if line.strip()]
+
+    @classmethod
+    def write_index(cls, reports_folder_path, report_list):
+        index_path = cls.get_index_path(reports_folder_path)
+        with open(index_path + '.tmp', 'w+') as index_file:
+            index_file.writelines(path + '\n' for path in report_list)
+        os.rename(index_path + '.tmp', index_path)
+        cls.mark_index_dirty(reports_folder_path)
+
+    @classmethod
+    def mark_index_dirty(cls, reports_folder_path):
+        open(cls.get_dirty_flag_path(reports_folder_path), 'a').close()
 
     @classmethod
-    def update_or_generate_static_html(cls, reports_folder_path):
+    def index_is_dirty(cls, reports_folder_path):
+        return os.path.exists(cls.get_dirty_flag_path(reports_folder_path))
+
+    @classmethod
+    def register_report(cls, reports_folder_path, report_filepath):
+        '''Append a freshly saved report to the index.'''
+        if not os.path.exists(cls.get_index_path(reports_folder_path)):
+            # Bootstrap index. It will already include the new report.
+            cls.list_reports(reports_folder_path)
+            return
+        with open(cls.get_index_path(reports_folder_path), 'a') as index_file:
+            index_file.write(report_filepath + '\n')
+        cls.mark_index_dirty(reports_folder_path)
+
+    @classmethod
+    def compact_reports(cls, reports_folder_path, keep_last,
+                        global_index=False):
         '''
-        Put a copy of static html to browse project reports inside
-        'reports/html'.
+        Keep only the last `keep_last` reports. Older reports (and their
+        streamed events) are moved into daily zip archives inside
+        'reports/archive'. Indexed runs then point to the reports inside of
+        the archives, e.g. `reports/archive/reports-<day>.zip/<report>`.
+        Return the number of archived reports.
+        '''
+        if not keep_last:
+            return 0
+        report_list = cls.list_reports(reports_folder_path)
+        if len(report_list) <= keep_last:
+            return 0
+        outdated = report_list[:-keep_last]
+        archive_folder = os.path.join(reports_folder_path, 'archive')
+        if not os.path.exists(archive_folder):
+            os.makedirs(archive_folder)
+        reports_by_day = dict()
+        moves = dict()
+        for report_filepath in outdated:
+            match = REPORT_DAY_EXP.search(os.path.basename(report_filepath))
+            day = match.group(1) if match else 'undated'
+            reports_by_day.setdefault(day, []).append(report_filepath)
+        for day in sorted(reports_by_day):
+            archive_path = os.path.join(archive_folder,
+                                        'reports-%s.zip' % day)
+            with closing(zipfile.ZipFile(archive_path, 'a',
+                                         zipfile.ZIP_DEFLATED)) as archive:
+                for report_filepath in reports_by_day[day]:
+                    moves[report_filepath] = os.path.join(
+                        archive_path, os.path.basename(report_filepath))
+                    prefix = os.path.splitext(report_filepath)[0]
+                    for filepath in (report_filepath, prefix + '.jsonl',
+                                     prefix + LOG_SPILL_EXTENSION):
+                        if not os.path.exists(filepath):
+                            continue
+                        archive.write(filepath, os.path.basename(filepath))
+                        os.unlink(filepath)
+        logger.info('Archived %d outdated report(s) into: %s' %
+                    (len(outdated), archive_folder))
+        cls.move_indexed_reports(reports_folder_path, moves,
+                                 global_index=global_index)
+        cls.write_index(reports_folder_path, report_list[-keep_last:])
+        return len(outdated)
+
+    @classmethod
+    def link_static_html(cls, html_path, link_assets=True):
+        '''
+        Link (or copy) shared web UI files into 'reports/html'. Assets are
+        linked by default, so that they are not duplicated in every project.
+        '''
+        os.makedirs(html_path)
+        for name in ('assets', 'index.html'):
+            source = os.path.join(UI_WEB_PATH, name)
+            destination = os.path.join(html_path, name)
+            if not os.path.exists(source):
+                logger.warn('Missing web UI files: %s' % source)
+                continue
+            if link_assets:
+                try:
+                    os.symlink(source, destination)
+                    continue
+                except OSError as error:
+                    logger.warn('Failed to link %s (%s). Copying instead.' %
+                                (source, error))
+            if os.path.isdir(source):
+                shutil.copytree(source, destination)
+            else:
+                shutil.copy(source, destination)
+
+    @classmethod
+    def update_or_generate_static_html(cls, reports_folder_path,
+                                       deferred_interval=0, link_assets=True):
+        '''
+        Put static html to browse project reports inside 'reports/html'.
+
+        The report listing is regenerated only if new reports were
+        registered. With a non-zero `deferred_interval` it is regenerated at
+        most once in that many seconds, so that frequent runs are batched.
         '''
         # logger.info('web ui path: %s' % UI_WEB_PATH)
         html_path = os.path.join(reports_folder_path, 'html')
         if not os.path.exists(html_path):
             logger.info('Creating static html to browse reports.')
-            # os.makedirs(html_path)
-            shutil.copytree(os.path.join(UI_WEB_PATH, 'assets'),
-                            os.path.join(html_path, 'assets'))
-            shutil.copy(os.path.join(UI_WEB_PATH, 'index.html'),
-                        os.path.join(html_path, 'index.html'))
-        else:
-            logger.info('Updating static html to browse reports.')
-        # Generated/update reports.json
-        report_list = glob(os.path.join(reports_folder_path,
-                           '*-report-*.yaml'))
-        report_list = sorted(report_list, reverse=True)
-        reports = {
-            'modified_at': cls.get_now_str(),
-            'reports_list': report_list,
-        }
-        with open(os.path.join(html_path, 'reports.yaml'), 'w+') \
-                as reportsfile:
-            reportsfile.write(yaml.dump(reports,
-                              default_flow_style=False))
+            cls.link_static_html(html_path, link_assets=link_assets)
+            cls.mark_index_dirty(reports_folder_path)
+        elif not cls.index_is_dirty(reports_folder_path):
+            return
+        listing_path = os.path.join(html_path, 'reports.yaml')
+        if deferred_interval and os.path.exists(listing_path) and \
+                time.time() - os.path.getmtime(listing_path) \
+                < deferred_interval:
+            logger.info('Deferring update of static html to browse reports.')
+            return
+        logger.info('Updating static html to browse reports.')
+        # Clear the flag before reading the index, so that a report
+        # registered meanwhile marks the listing dirty again.
+        ignore_missing(os.unlink, cls.get_dirty_flag_path(reports_folder_path))
+        try:
+            # Generated/update reports.json
+            report_list = cls.list_reports(reports_folder_path)
+            reports = {
+                'modified_at': cls.get_now_str(),
+                # Web UI can browse only YAML reports.
+                'reports_list': [filepath for filepath
+                                 in reversed(report_list)
+                                 if filepath.endswith('.yaml')],
+            }
+            with open(listing_path, 'w+') as reportsfile:
+                yaml.dump(reports, reportsfile, Dumper=Dumper,
+                          default_flow_style=False)
+        except Exception:
+            cls.mark_index_dirty(reports_folder_path)
+            raise
 
     @classmethod
     def get_current_report_pipe(cls):
@@ -86,6 +499,9 @@ class BrainyReporter(object):
 
     @classmethod
     def append_report_pipe(cls, name, **extra):
+        if report_state.stream is not None:
+            report_state.stream.write_event('pipe', name=name, **extra)
+            return
         pipe = {
             'name': name,
             'processes': [],
@@ -97,6 +513,9 @@ class BrainyReporter(object):
 
     @classmethod
     def append_report_process(cls, name, **extra):
+        if report_state.stream is not None:
+            report_state.stream.write_event('process', name=name, **extra)
+            return
         process = {
             'name': name,
         }
@@ -114,6 +533,12 @@ class BrainyReporter(object):
 
     @classmethod
     def append_message(cls, message, message_type='info', **kwds):
+        if report_state.stream is not None:
+            event = 'error' if message_type in ERROR_MESSAGE_TYPES \
+                else 'message'
+            report_state.stream.write_event(event, message=message,
+                                            type=message_type, **kwds)
+            return
         process = cls.get_current_report_step()
         if 'messages' not in process:
             process['messages'] = []
@@ -132,9 +557,13 @@ class BrainyReporter(object):
     @classmethod
     def append_unknown_error(cls, message, **kwds):
         '''Unknown error is fatal and should break any further progress'''
+        metrics.inc('brainy_errors_total', kind='unknown',
+                    error_type=kwds.get('error_type', 'unknown'))
         cls.append_message(message, message_type='unknown_error', **kwds)
 
     @classmethod
     def append_known_error(cls, message, **kwds):
         '''Known error is typical and causes a series of retries'''
+        metrics.inc('brainy_errors_total', kind='known',
+                    error_type=kwds.get('error_type', 'unknown'))
         cls.append_message(message, message_type='known_error', **kwds)
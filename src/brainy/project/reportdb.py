@@ -0,0 +1,205 @@
+'''
+brainy.project.reportdb
+
+Index run reports and their messages into SQLite, so that questions like
+"which steps failed with out_of_memory in the last week" do not require
+parsing of every report YAML. Each project has its own database inside the
+reports folder. Optionally, the same rows are indexed into a global (user
+wide) database.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import re
+import sqlite3
+import logging
+from contextlib import closing
+from datetime import datetime, timedelta
+from brainy.project.report import iter_report_events
+logger = logging.getLogger(__name__)
+
+REPORTS_DB_NAME = 'reports.sqlite'
+GLOBAL_REPORTS_DB_PATH = os.path.expanduser('~/.brainy/reports.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    project TEXT NOT NULL,
+    report_path TEXT NOT NULL UNIQUE,
+    started_at TEXT,
+    finished_at TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    project TEXT NOT NULL,
+    started_at TEXT,
+    pipe TEXT,
+    step TEXT,
+    type TEXT,
+    error_type TEXT,
+    message TEXT,
+    job_report TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_project ON runs (project, started_at);
+CREATE INDEX IF NOT EXISTS messages_project ON messages (project, started_at);
+CREATE INDEX IF NOT EXISTS messages_step ON messages (pipe, step);
+CREATE INDEX IF NOT EXISTS messages_type ON messages (type, started_at);
+CREATE INDEX IF NOT EXISTS messages_error_type
+    ON messages (error_type, started_at);
+'''
+
+# Message fields which can be used for filtering by query().
+QUERY_FIELDS = ('project', 'pipe', 'step', 'type', 'error_type')
+MESSAGE_COLUMNS = ('project', 'started_at', 'pipe', 'step', 'type',
+                   'error_type', 'message', 'job_report')
+
+SINCE_EXP = re.compile(r'^(\d+)([mhdw])$')
+SINCE_UNITS = {
+    'm': 'minutes',
+    'h': 'hours',
+    'd': 'days',
+    'w': 'weeks',
+}
+
+
+def parse_since(value):
+    '''
+    Turn relative ('30m', '12h', '7d', '2w') or absolute ('2015-01-31')
+    time into a timestamp string comparable with the indexed ones.
+    '''
+    match = SINCE_EXP.match(value.strip())
+    if match:
+        delta = timedelta(**{SINCE_UNITS[match.group(2)]:
+                             int(match.group(1))})
+        since = datetime.now() - delta
+    else:
+        try:
+            since = datetime.strptime(value.strip(), '%Y-%m-%d')
+        except ValueError:
+            raise ValueError('Failed to parse time: %s (try 7d or '
+                             'YYYY-MM-DD)' % value)
+    return since.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def to_text(value):
+    '''SQLite refuses 8-bit byte strings.'''
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def iter_messages_of_report(report):
+    '''Yield (pipe, step, message) out of the report_data layout.'''
+    for pipe in report.get('project', {}).get('pipes', []):
+        for process in pipe.get('processes', []):
+            for message in process.get('messages', []):
+                yield (pipe.get('name'), process.get('name'), message)
+
+
+def iter_messages_of_stream(stream_filepath):
+    '''Yield (pipe, step, message) out of the streamed report events.'''
+    pipe = None
+    step = None
+    for event in iter_report_events(stream_filepath):
+        kind = event.pop('event')
+        if kind == 'pipe':
+            pipe = event.get('name')
+        elif kind == 'process':
+            step = event.get('name')
+        elif kind in ('message', 'error'):
+            yield (pipe, step, event)
+
+
+class ReportDatabase(object):
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.__has_schema = False
+
+    @classmethod
+    def for_reports_folder(cls, reports_folder_path):
+        return cls(os.path.join(reports_folder_path, REPORTS_DB_NAME))
+
+    def connect(self):
+        # Several projects can be indexed into the global database at once.
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        if not self.__has_schema:
+            connection.executescript(SCHEMA)
+            self.__has_schema = True
+        return connection
+
+    def index_report(self, project, report_path, messages, started_at=None,
+                     finished_at=None):
+        '''
+        Index a run. `messages` is an iterable of (pipe, step, message)
+        tuples, e.g. produced by iter_messages_of_report(). Return the number
+        of indexed messages.
+        '''
+        rows = (
+            (project, started_at, pipe, step, message.get('type'),
+             message.get('error_type'), to_text(message.get('message')),
+             to_text(message.get('job_report')))
+            for (pipe, step, message) in messages
+        )
+        with closing(self.connect()) as connection:
+            with connection:
+                # Re-indexing of the same report replaces its rows.
+                connection.execute(
+                    'DELETE FROM messages WHERE run_id IN '
+                    '(SELECT id FROM runs WHERE report_path = ?)',
+                    (report_path,))
+                connection.execute('DELETE FROM runs WHERE report_path = ?',
+                                   (report_path,))
+                cursor = connection.execute(
+                    'INSERT INTO runs (project, report_path, started_at, '
+                    'finished_at) VALUES (?, ?, ?, ?)',
+                    (project, report_path, started_at, finished_at))
+                run_id = cursor.lastrowid
+                cursor = connection.executemany(
+                    'INSERT INTO messages (run_id, %s) VALUES (?, %s)' % (
+                        ', '.join(MESSAGE_COLUMNS),
+                        ', '.join('?' * len(MESSAGE_COLUMNS))),
+                    ((run_id,) + row for row in rows))
+                return cursor.rowcount
+
+    def move_reports(self, moves):
+        '''
+        Point indexed runs to the new paths of their reports, e.g. after
+        archiving. `moves` maps old report paths to new ones. Return the
+        number of updated runs.
+        '''
+        with closing(self.connect()) as connection:
+            with connection:
+                cursor = connection.executemany(
+                    'UPDATE runs SET report_path = ? WHERE report_path = ?',
+                    ((new_path, old_path)
+                     for old_path, new_path in moves.items()))
+                return cursor.rowcount
+
+    def query(self, since=None, limit=100, **filters):
+        '''
+        Return indexed messages (newest first) matching all the filters. Keys
+        of filters must be in QUERY_FIELDS.
+        '''
+        conditions = list()
+        values = list()
+        for field in filters:
+            if field not in QUERY_FIELDS:
+                raise KeyError('Unknown query field: %s (expected one of %s)'
+                               % (field, ', '.join(QUERY_FIELDS)))
+            conditions.append('%s = ?' % field)
+            values.append(filters[field])
+        if since is not None:
+            conditions.append('started_at >= ?')
+            values.append(parse_since(since))
+        sql = 'SELECT %s FROM messages' % ', '.join(MESSAGE_COLUMNS)
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY started_at DESC LIMIT ?'
+        values.append(limit)
+        with closing(self.connect()) as connection:
+            return [dict(row) for row in connection.execute(sql, values)]
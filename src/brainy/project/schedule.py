@@ -0,0 +1,136 @@
+'''
+brainy.project.schedule
+
+Adaptive per-project polling of the daemon. A project whose state (flags,
+job reports, workflow files) does not change between runs is polled less and
+less often, up to a maximal interval. As soon as the state changes, polling
+snaps back to the minimal interval. Complete projects are not run at all
+until their state changes. The schedule survives daemon restarts.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import hashlib
+import logging
+import threading
+from brainy.utils import load_yaml, dump_yaml
+from brainy.watcher import PollingWatcher
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 10
+DEFAULT_MAX_INTERVAL = 3600
+DEFAULT_BACKOFF_FACTOR = 2
+
+
+def get_project_signature(project_path):
+    '''
+    Cheap hash of the project state, built out of mtimes of flags, job
+    reports and workflow files (see brainy.watcher).
+    '''
+    snapshot = PollingWatcher.take_snapshot(project_path)
+    return hashlib.sha1(repr(sorted(snapshot.items()))).hexdigest()
+
+
+class ProjectSchedule(object):
+    '''
+    Per-project polling schedule, persisted as YAML. Every entry looks like:
+
+        /path/to/project:
+          signature: <hash of the state after the last run>
+          interval: <seconds>
+          next_run_at: <unix time>
+          is_complete: false
+    '''
+
+    def __init__(self, schedule_path, min_interval=DEFAULT_MIN_INTERVAL,
+                 max_interval=DEFAULT_MAX_INTERVAL,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        self.schedule_path = schedule_path
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.entries = dict()
+        self.__lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.schedule_path):
+            return
+        try:
+            self.entries = load_yaml(open(self.schedule_path).read()) or {}
+        except Exception as error:
+            logger.warn('Ignoring broken project schedule %s: %s' %
+                        (self.schedule_path, error))
+            self.entries = dict()
+
+    def save(self):
+        with self.__lock:
+            content = dump_yaml(self.entries)
+        # Write atomically, so that a killed daemon never leaves a broken
+        # schedule behind.
+        with open(self.schedule_path + '.tmp', 'w+') as stream:
+            stream.write(content)
+        os.rename(self.schedule_path + '.tmp', self.schedule_path)
+
+    def is_due(self, project_path, now=None):
+        '''
+        Project is due if it was never run, its state has changed since the
+        last run or its polling interval has passed. Complete projects are
+        due only when their state changes.
+        '''
+        entry = self.entries.get(project_path)
+        if entry is None:
+            return True
+        if get_project_signature(project_path) != entry['signature']:
+            return True
+        if entry.get('is_complete'):
+            return False
+        if now is None:
+            now = time.time()
+        return now >= entry['next_run_at']
+
+    def select_due(self, project_paths):
+        now = time.time()
+        due = set(project_path for project_path in project_paths
+                  if self.is_due(project_path, now))
+        logger.info('%d of %d project(s) are due to run.' %
+                    (len(due), len(project_paths)))
+        return due
+
+    def record_run(self, project_path, is_complete=False):
+        '''
+        Reschedule the project after a run: back off if the run left its
+        state as it was after the previous run, otherwise snap back. Pass
+        is_complete=None to keep the known completeness.
+        '''
+        signature = get_project_signature(project_path)
+        with self.__lock:
+            entry = self.entries.get(project_path)
+            if entry is not None and entry['signature'] == signature:
+                interval = min(self.max_interval,
+                               entry['interval'] * self.backoff_factor)
+                if is_complete is None:
+                    is_complete = entry.get('is_complete')
+            else:
+                interval = self.min_interval
+            self.entries[project_path] = {
+                'signature': signature,
+                'interval': interval,
+                'next_run_at': time.time() + interval,
+                'is_complete': bool(is_complete),
+            }
+        if is_complete:
+            logger.info('Project is complete. It will not run until it '
+                        'changes: %s' % project_path)
+        else:
+            logger.info('Next run of %s in %d (s).' % (project_path, interval))
+
+    def forget(self, project_paths):
+        '''Drop entries of projects that are no longer registered.'''
+        with self.__lock:
+            for project_path in set(self.entries) - set(project_paths):
+                del self.entries[project_path]
@@ -0,0 +1,100 @@
+'''
+brainy.project.watch
+
+Keep a single project resident and re-run it whenever something changes
+inside of it, e.g.
+
+    brainy project run --watch
+
+Unlike the daemon, the project is run in the same process on every tick, so
+interpreter, imports, merged config (see brainy.config.ConfigCache) and
+resolved classes stay warm. Parsed pipe definitions are kept between runs as
+long as none of the workflow files (`.br`, `sequence` and the project config)
+has changed.
+
+Flags and scheduler jobs are never cached between ticks: both are changed by
+the very jobs that brainy has submitted, so a stale view of them would submit
+the same jobs again.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import logging
+from brainy import fs
+from brainy.watcher import list_workflow_files
+from brainy.log import json_handler
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IDLE_INTERVAL = 300
+
+
+def get_workflow_signature(project_path):
+    signature = list()
+    for pathname in sorted(list_workflow_files(project_path)):
+        try:
+            stat = fs.stat(pathname)
+        except OSError:
+            continue
+        signature.append((pathname, stat.st_mtime, stat.st_size))
+    return signature
+
+
+class ProjectWatch(object):
+    '''
+    Event-driven loop of a single project. The project is run once on start,
+    then on every change noticed by the watcher (see brainy.watcher) and at
+    least once in max_idle_interval seconds.
+    '''
+
+    def __init__(self, project, watcher,
+                 max_idle_interval=DEFAULT_MAX_IDLE_INTERVAL, **run_params):
+        self.project = project
+        # Passed to every BrainyProject.run(), e.g. selection of pipes.
+        self.run_params = run_params
+        self.watcher = watcher
+        self.max_idle_interval = max_idle_interval
+        self.workflow_signature = None
+        self.ticks = 0
+
+    def invalidate(self):
+        '''Forget parsed pipe definitions if workflow files have changed.'''
+        signature = get_workflow_signature(self.project.path)
+        if signature == self.workflow_signature:
+            return False
+        if self.workflow_signature is not None:
+            logger.info('Workflow files have changed. Reloading pipes.')
+        self.workflow_signature = signature
+        self.project.pipes = None
+        return True
+
+    def tick(self):
+        self.ticks += 1
+        self.invalidate()
+        try:
+            self.project.run(reuse_pipes=True, **self.run_params)
+        except Exception as error:
+            # Keep watching, the user is likely to fix the project.
+            logger.exception(error)
+            self.project.pipes = None
+        # Logs are saved by the reports, do not keep them.
+        json_handler.reset_output()
+
+    def run(self, max_ticks=None):
+        self.watcher.watch([self.project.path])
+        last_tick = 0
+        while max_ticks is None or self.ticks < max_ticks:
+            idle = time.time() - last_tick
+            if idle < self.max_idle_interval:
+                changed = self.watcher.wait(self.max_idle_interval - idle)
+                if not changed:
+                    continue
+                logger.info('Project has changed: %s' % self.project.path)
+            # Changes made during the run, by the jobs or by brainy itself,
+            # are noticed by the next wait.
+            self.watcher.rebase([self.project.path])
+            self.tick()
+            last_tick = time.time()
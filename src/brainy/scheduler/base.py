@@ -1,4 +1,8 @@
+import os
 import logging
+from brainy.scheduler.snapshot import (SchedulerSnapshot,
+                                       SCHEDULER_SNAPSHOT_ENV,
+                                       DEFAULT_SNAPSHOT_TTL)
 logger = logging.getLogger(__name__)
 
 
@@ -22,15 +26,43 @@ class BrainyScheduler(object):
     operations.
     '''
 
+    # Engines that can be queried for all their jobs at once (see
+    # take_snapshot) accept snapshots.
+    accepts_snapshots = False
+
     @staticmethod
-    def build_scheduler(name):
-        '''Factory for scheduling engines.'''
+    def build_scheduler(name, snapshot=None,
+                        snapshot_ttl=DEFAULT_SNAPSHOT_TTL):
+        '''
+        Factory for scheduling engines. The scheduler answers questions about
+        jobs out of the snapshot, if it was passed or pointed to by the
+        environment of the daemon (see brainy.scheduler.snapshot).
+        '''
         name = name.lower()
+        if snapshot is None and SCHEDULER_SNAPSHOT_ENV in os.environ:
+            snapshot = SchedulerSnapshot.load(
+                os.environ[SCHEDULER_SNAPSHOT_ENV], ttl=snapshot_ttl)
+        if snapshot is not None and snapshot.engine != name:
+            snapshot = None
         if name == 'lsf':
             from brainy.scheduler.lsf import Lsf
-            return Lsf()
+            return Lsf(snapshot=snapshot)
         elif name == 'shellcmd':
             from brainy.scheduler.shellcmd import ShellCommand
             return ShellCommand()
         raise Exception('Unknown scheduler type: %s' % name)
 
+    def get_job_states(self, key=None):
+        '''
+        Return a sorted list of (job id, state) tuples of jobs known to the
+        scheduler. Require job description to contain the **key** substring.
+        Engines that run jobs synchronously have no jobs to report.
+        '''
+        return list()
+
+    def take_snapshot(self):
+        '''
+        Query the scheduler for all the jobs at once. Return None if engine
+        does not support snapshots.
+        '''
+        return None
@@ -0,0 +1,551 @@
+'''
+brainy.scheduler.fakelsf
+
+A fake LSF for load testing brainy.scheduler.lsf.Lsf on a single Linux box.
+Stub `bsub`, `bjobs` and `bkill` executables keep jobs in a local state
+folder. Every job is run by a detached worker process, which writes an
+LSF-formatted report into the `-o` file when the job ends.
+
+Settings (see DEFAULT_SETTINGS):
+
+ - slots: number of jobs running at the same time
+ - pending_delay: seconds a job stays pending at least
+ - cli_latency: seconds every bsub/bjobs/bkill call takes at least
+ - runlimit_scale: seconds per minute of the `-W` run limit, e.g. 0.1 makes
+   `-W 1:00` kill the job with TERM_RUNLIMIT after 6 seconds
+ - finished_ttl: seconds finished jobs are listed by `bjobs -a`
+
+There is no scheduler daemon: pending jobs are started whenever a slot is
+freed by a worker or any of the fake commands is called.
+
+    fake_lsf = FakeLsf('/tmp/fake_lsf', slots=2, runlimit_scale=0.1)
+    fake_lsf.install()  # Prepends fake commands to the PATH.
+
+or, for a shell and the daemon:
+
+    python -m brainy.scheduler.fakelsf install /tmp/fake_lsf --slots 2
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import sys
+import time
+import json
+import fcntl
+import getpass
+import argparse
+import subprocess
+from datetime import datetime
+from contextlib import contextmanager
+
+FAKE_LSF_STATE_ENV = 'BRAINY_FAKE_LSF'
+FAKE_LSF_COMMANDS = ('bsub', 'bjobs', 'bkill')
+DEFAULT_SETTINGS = {
+    'slots': 4,
+    'pending_delay': 0.0,
+    'cli_latency': 0.0,
+    'runlimit_scale': 60.0,
+    'finished_ttl': 3600,
+    'queue': 'normal',
+    'host': 'fakelsf',
+}
+# How often workers look at the run limit and kill requests.
+WORKER_POLL_INTERVAL = 0.05
+BSUB_VALUE_OPTIONS = ('-W', '-o', '-e', '-q', '-J', '-R', '-n', '-M', '-w',
+                      '-cwd')
+RUNLIMIT_EXIT_CODE = 140
+OWNER_KILL_EXIT_CODE = 130
+TERM_REASONS = {
+    'TERM_RUNLIMIT': 'TERM_RUNLIMIT: job killed after reaching LSF run time '
+                     'limit.',
+    'TERM_OWNER': 'TERM_OWNER: job killed by owner.',
+}
+WRAPPER_SCRIPT = '''#!/bin/bash
+# Fake LSF %(command)s, see brainy.scheduler.fakelsf
+export %(state_env)s="%(state_path)s"
+export PYTHONPATH="%(python_path)s${PYTHONPATH:+:$PYTHONPATH}"
+exec "%(python)s" -m brainy.scheduler.fakelsf %(command)s "$@"
+'''
+REPORT_TPL = '''Sender: LSF System <lsfadmin@%(host)s>
+Subject: Job %(id)d: <%(job_name)s> in cluster <fakelsf> %(subject)s
+
+Job <%(job_name)s> was submitted from host <%(host)s> by user <%(user)s> \
+in cluster <fakelsf>.
+Job was executed on host(s) <%(host)s>, in queue <%(queue)s>, as user \
+<%(user)s> in cluster <fakelsf>.
+<%(home)s> was used as the home directory.
+<%(cwd)s> was used as the working directory.
+Started at %(started_at)s
+Results reported at %(finished_at)s
+
+Your job looked like:
+
+------------------------------------------------------------
+# LSBATCH: User input
+%(command)s
+------------------------------------------------------------
+
+%(status)s
+
+Resource usage summary:
+
+    CPU time   :   %(cpu_time)10.2f sec.
+    Run time   :   %(run_time)10d sec.
+
+The output (if any) follows:
+
+%(output)s
+'''
+
+
+class FakeLsfError(Exception):
+    '''Misuse of the fake LSF commands.'''
+
+
+def parse_runlimit(value):
+    '''Return run limit of `-W [hours:]minutes` in minutes.'''
+    if ':' in value:
+        hours, minutes = value.split(':', 1)
+        return int(hours) * 60 + int(minutes)
+    return int(value)
+
+
+def format_lsf_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime('%a %b %d %H:%M:%S %Y')
+
+
+class FakeLsfState(object):
+    '''Jobs of the fake LSF, kept as JSON files under the state folder.'''
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.jobs_path = os.path.join(state_path, 'jobs')
+        self.output_path = os.path.join(state_path, 'output')
+        self._settings = None
+
+    @classmethod
+    def from_environ(cls):
+        if FAKE_LSF_STATE_ENV not in os.environ:
+            raise FakeLsfError('%s is not set.' % FAKE_LSF_STATE_ENV)
+        return cls(os.environ[FAKE_LSF_STATE_ENV])
+
+    def init(self, settings):
+        for path in (self.jobs_path, self.output_path):
+            if not os.path.exists(path):
+                os.makedirs(path)
+        self.write_json(os.path.join(self.state_path, 'settings.json'),
+                        settings)
+        self._settings = None
+
+    @property
+    def settings(self):
+        if self._settings is None:
+            self._settings = dict(DEFAULT_SETTINGS)
+            with open(os.path.join(self.state_path, 'settings.json')) \
+                    as stream:
+                self._settings.update(json.load(stream))
+        return self._settings
+
+    @contextmanager
+    def lock(self):
+        with open(os.path.join(self.state_path, 'lock'), 'a+') as stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(stream, fcntl.LOCK_UN)
+
+    @staticmethod
+    def write_json(filepath, data):
+        # Write atomically, since bjobs may be reading it.
+        with open(filepath + '.tmp', 'w+') as stream:
+            json.dump(data, stream)
+        os.rename(filepath + '.tmp', filepath)
+
+    def get_job_path(self, job_id):
+        return os.path.join(self.jobs_path, '%d.json' % job_id)
+
+    def load_job(self, job_id):
+        job_path = self.get_job_path(job_id)
+        if not os.path.exists(job_path):
+            return None
+        with open(job_path) as stream:
+            return json.load(stream)
+
+    def save_job(self, job):
+        self.write_json(self.get_job_path(job['id']), job)
+
+    def list_jobs(self):
+        jobs = list()
+        for filename in os.listdir(self.jobs_path):
+            if not filename.endswith('.json'):
+                continue
+            job = self.load_job(int(filename[:-len('.json')]))
+            if job is not None:
+                jobs.append(job)
+        return sorted(jobs, key=lambda job: job['id'])
+
+    def next_job_id(self):
+        counter_path = os.path.join(self.state_path, 'last_job_id')
+        job_id = 1
+        if os.path.exists(counter_path):
+            with open(counter_path) as stream:
+                job_id = int(stream.read().strip() or 0) + 1
+        with open(counter_path, 'w+') as stream:
+            stream.write(str(job_id))
+        return job_id
+
+    def submit(self, command, runlimit=None, report_file=None, queue=None,
+               job_name=None, cwd=None):
+        with self.lock():
+            job = {
+                'id': self.next_job_id(),
+                'user': getpass.getuser(),
+                'stat': 'PEND',
+                'queue': queue or self.settings['queue'],
+                'runlimit': runlimit,
+                'report_file': report_file,
+                'command': command,
+                'job_name': job_name or command,
+                'cwd': cwd or os.getcwd(),
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'pid': None,
+                'exit_code': None,
+                'term_reason': None,
+                'kill_requested': False,
+            }
+            self.save_job(job)
+        return job
+
+    def reset(self):
+        '''Forget all the jobs. Running jobs are not killed.'''
+        if not os.path.exists(self.jobs_path):
+            return
+        with self.lock():
+            for filename in os.listdir(self.jobs_path):
+                os.unlink(os.path.join(self.jobs_path, filename))
+            counter_path = os.path.join(self.state_path, 'last_job_id')
+            if os.path.exists(counter_path):
+                os.unlink(counter_path)
+
+    def request_kill(self, job_id):
+        '''Return False if no such unfinished job is found.'''
+        with self.lock():
+            job = self.load_job(job_id)
+            if job is None or job['stat'] not in ('PEND', 'RUN'):
+                return False
+            if job['stat'] == 'PEND':
+                job['stat'] = 'EXIT'
+                job['term_reason'] = 'TERM_OWNER'
+                job['exit_code'] = OWNER_KILL_EXIT_CODE
+                job['finished_at'] = time.time()
+            else:
+                # The worker kills the job and writes the report.
+                job['kill_requested'] = True
+            self.save_job(job)
+        return True
+
+    def dispatch(self):
+        '''Start pending jobs on free slots. Return number of started jobs.'''
+        started = 0
+        with self.lock():
+            now = time.time()
+            jobs = self.list_jobs()
+            running = 0
+            for job in jobs:
+                if job['stat'] != 'RUN':
+                    continue
+                if is_alive(job['pid']):
+                    running += 1
+                    continue
+                # Worker has died without a word.
+                job['stat'] = 'EXIT'
+                job['finished_at'] = now
+                self.save_job(job)
+            for job in jobs:
+                if running >= self.settings['slots']:
+                    break
+                if job['stat'] != 'PEND' or now < job['submitted_at'] + \
+                        self.settings['pending_delay']:
+                    continue
+                job['stat'] = 'RUN'
+                job['started_at'] = now
+                job['pid'] = self.spawn_worker(job['id'])
+                self.save_job(job)
+                running += 1
+                started += 1
+        return started
+
+    def spawn_worker(self, job_id):
+        env = dict(os.environ)
+        env[FAKE_LSF_STATE_ENV] = self.state_path
+        with open(os.devnull, 'r+') as devnull:
+            # Detach, so that the calling command does not wait for it.
+            worker = subprocess.Popen(
+                [sys.executable, '-m', 'brainy.scheduler.fakelsf', 'worker',
+                 str(job_id)],
+                stdin=devnull, stdout=devnull, stderr=devnull,
+                close_fds=True, preexec_fn=os.setsid, env=env)
+        return worker.pid
+
+    def run_job(self, job_id):
+        '''Body of the worker: run the job, enforce limits, report.'''
+        job = self.load_job(job_id)
+        output_path = os.path.join(self.output_path, '%d.out' % job_id)
+        runlimit = None
+        if job['runlimit'] is not None:
+            runlimit = job['runlimit'] * self.settings['runlimit_scale']
+        started_at = time.time()
+        with open(output_path, 'w+') as output, \
+                open(os.devnull) as devnull:
+            process = subprocess.Popen(
+                ['/bin/bash', '-c', job['command']], stdin=devnull,
+                stdout=output, stderr=subprocess.STDOUT, cwd=job['cwd'],
+                close_fds=True, preexec_fn=os.setsid)
+            term_reason = None
+            while process.poll() is None:
+                time.sleep(WORKER_POLL_INTERVAL)
+                if runlimit is not None and \
+                        time.time() - started_at > runlimit:
+                    term_reason = 'TERM_RUNLIMIT'
+                elif self.load_job(job_id)['kill_requested']:
+                    term_reason = 'TERM_OWNER'
+                if term_reason is not None:
+                    os.killpg(process.pid, 15)
+                    process.wait()
+                    break
+        cpu_time = sum(os.times()[2:4])
+        with open(output_path) as stream:
+            output = stream.read()
+        with self.lock():
+            job = self.load_job(job_id)
+            job['finished_at'] = time.time()
+            job['term_reason'] = term_reason
+            if term_reason == 'TERM_RUNLIMIT':
+                job['exit_code'] = RUNLIMIT_EXIT_CODE
+            elif term_reason == 'TERM_OWNER':
+                job['exit_code'] = OWNER_KILL_EXIT_CODE
+            else:
+                job['exit_code'] = process.returncode
+            job['stat'] = 'DONE' if job['exit_code'] == 0 else 'EXIT'
+            self.save_job(job)
+        self.write_report(job, output, cpu_time)
+        os.unlink(output_path)
+        # Slot is free now.
+        self.dispatch()
+
+    def write_report(self, job, output, cpu_time=0.0):
+        if job['exit_code'] == 0:
+            subject = 'Done'
+            status = 'Successfully completed.'
+        else:
+            subject = 'Exited'
+            status = 'Exited with exit code %d.' % job['exit_code']
+            if job['term_reason']:
+                status = TERM_REASONS[job['term_reason']] + '\n' + status
+        report_file = job['report_file'] or os.path.join(
+            self.output_path, '%d.job_report' % job['id'])
+        with open(report_file, 'w+') as stream:
+            stream.write(REPORT_TPL % {
+                'id': job['id'],
+                'job_name': job['job_name'],
+                'subject': subject,
+                'host': self.settings['host'],
+                'user': job['user'],
+                'queue': job['queue'],
+                'home': os.path.expanduser('~'),
+                'cwd': job['cwd'],
+                'started_at': format_lsf_time(job['started_at']),
+                'finished_at': format_lsf_time(job['finished_at']),
+                'command': job['command'],
+                'status': status,
+                'cpu_time': cpu_time,
+                'run_time': int(job['finished_at'] - job['started_at']),
+                'output': output,
+            })
+        return report_file
+
+
+def is_alive(pid):
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def format_job_line(job, settings, wide=True):
+    job_name = job['job_name'].replace('\n', ';')
+    if not wide and len(job_name) > 10:
+        job_name = '*' + job_name[-9:]
+    exec_host = settings['host'] if job['started_at'] else '-'
+    return '%-7d %-7s %-5s %-10s %-11s %-11s %s %s' % (
+        job['id'], job['user'], job['stat'], job['queue'], settings['host'],
+        exec_host, job_name,
+        datetime.fromtimestamp(job['submitted_at']).strftime('%b %d %H:%M'))
+
+
+def bsub(state, args):
+    options = dict()
+    index = 0
+    while index < len(args) and args[index].startswith('-'):
+        if args[index] in BSUB_VALUE_OPTIONS and index + 1 < len(args):
+            options[args[index]] = args[index + 1]
+            index += 2
+        else:
+            index += 1
+    command = ' '.join(args[index:])
+    if not command:
+        # Like bsub, read the job script from the standard input.
+        command = sys.stdin.read()
+    if not command.strip():
+        sys.stderr.write('No command is specified. Job not submitted.\n')
+        return 255
+    runlimit = parse_runlimit(options['-W']) if '-W' in options else None
+    job = state.submit(command, runlimit=runlimit,
+                       report_file=options.get('-o'),
+                       queue=options.get('-q'),
+                       job_name=options.get('-J'),
+                       cwd=options.get('-cwd'))
+    print 'Job <%d> is submitted to queue <%s>.' % (job['id'], job['queue'])
+    state.dispatch()
+    return 0
+
+
+def bjobs(state, args):
+    state.dispatch()
+    show_finished = any(arg.startswith('-') and 'a' in arg for arg in args)
+    wide = any(arg.startswith('-') and 'w' in arg for arg in args)
+    job_ids = [int(arg) for arg in args if arg.isdigit()]
+    now = time.time()
+    lines = list()
+    for job in state.list_jobs():
+        if job_ids and job['id'] not in job_ids:
+            continue
+        if job['stat'] in ('DONE', 'EXIT') and (not show_finished or
+                now - job['finished_at'] > state.settings['finished_ttl']):
+            continue
+        lines.append(format_job_line(job, state.settings, wide))
+    if not lines:
+        sys.stderr.write('No job found\n' if show_finished
+                         else 'No unfinished job found\n')
+        return 0
+    print 'JOBID   USER    STAT  QUEUE      FROM_HOST   EXEC_HOST   ' \
+        'JOB_NAME   SUBMIT_TIME'
+    print '\n'.join(lines)
+    return 0
+
+
+def bkill(state, args):
+    job_ids = [int(arg) for arg in args if arg.isdigit()]
+    if job_ids == [0]:
+        # Kill all the jobs.
+        job_ids = [job['id'] for job in state.list_jobs()
+                   if job['stat'] in ('PEND', 'RUN')]
+    exit_code = 0
+    for job_id in job_ids:
+        if state.request_kill(job_id):
+            print 'Job <%d> is being terminated' % job_id
+        else:
+            sys.stderr.write('Job <%d>: No matching job found\n' % job_id)
+            exit_code = 255
+    return exit_code
+
+
+class FakeLsf(object):
+    '''
+    Installs the fake LSF commands into root_path/bin and prepends them to
+    the PATH of this process (and its children).
+    '''
+
+    def __init__(self, root_path, **settings):
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise FakeLsfError('Unknown settings: %s' % ', '.join(unknown))
+        self.root_path = root_path
+        self.bin_path = os.path.join(root_path, 'bin')
+        self.state = FakeLsfState(os.path.join(root_path, 'state'))
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.settings.update(settings)
+        self.old_path = None
+
+    def write_commands(self):
+        if not os.path.exists(self.bin_path):
+            os.makedirs(self.bin_path)
+        self.state.init(self.settings)
+        python_path = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        for command in FAKE_LSF_COMMANDS:
+            command_path = os.path.join(self.bin_path, command)
+            with open(command_path, 'w+') as stream:
+                stream.write(WRAPPER_SCRIPT % {
+                    'command': command,
+                    'state_env': FAKE_LSF_STATE_ENV,
+                    'state_path': self.state.state_path,
+                    'python_path': python_path,
+                    'python': sys.executable,
+                })
+            os.chmod(command_path, 0755)
+        return self.bin_path
+
+    def install(self):
+        self.write_commands()
+        self.old_path = os.environ.get('PATH', '')
+        os.environ['PATH'] = self.bin_path + os.pathsep + self.old_path
+
+    def uninstall(self):
+        if self.old_path is not None:
+            os.environ['PATH'] = self.old_path
+            self.old_path = None
+
+    def list_jobs(self):
+        return self.state.list_jobs()
+
+    def reset(self):
+        self.state.reset()
+
+    def wait(self, timeout=60, interval=0.1):
+        '''Wait until all the jobs are finished. Return False on timeout.'''
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            # Dispatch jobs which have been pending for long enough.
+            self.state.dispatch()
+            if not any(job['stat'] in ('PEND', 'RUN')
+                       for job in self.list_jobs()):
+                return True
+            time.sleep(interval)
+        return False
+
+
+def main(argv):
+    if argv and argv[0] in FAKE_LSF_COMMANDS + ('worker',):
+        state = FakeLsfState.from_environ()
+        if argv[0] == 'worker':
+            state.run_job(int(argv[1]))
+            return 0
+        time.sleep(state.settings['cli_latency'])
+        return globals()[argv[0]](state, argv[1:])
+    parser = argparse.ArgumentParser(
+        prog='python -m brainy.scheduler.fakelsf',
+        description='Install fake LSF commands for load testing.')
+    parser.add_argument('action', choices=['install'])
+    parser.add_argument('root_path')
+    for name, value in sorted(DEFAULT_SETTINGS.items()):
+        parser.add_argument('--' + name.replace('_', '-'), dest=name,
+                            type=type(value), default=value)
+    args = parser.parse_args(argv)
+    settings = dict((name, getattr(args, name)) for name in DEFAULT_SETTINGS)
+    fake_lsf = FakeLsf(os.path.abspath(args.root_path), **settings)
+    print 'export PATH="%s:$PATH"' % fake_lsf.write_commands()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,10 @@
 from brainy.scheduler.base import (SHORT_QUEUE, NORM_QUEUE, LONG_QUEUE,
                                    PENDING_STATE, RUNNING_STATE, DONE_STATE,
                                    JOB_STATES, BrainyScheduler)
+from brainy.scheduler.snapshot import SchedulerSnapshot
+from brainy.metrics import metrics
+from brainy.tracing import span
+from brainy import fs
 import logging
 logger = logging.getLogger(__name__)
 
@@ -11,11 +15,15 @@ class NoLsfSchedulerFound(Exception):
 
 class Lsf(BrainyScheduler):
 
-    def __init__(self):
+    accepts_snapshots = True
+
+    def __init__(self, snapshot=None):
         self.bsub = None
-        self.bjobs = None
+        self._bjobs = None
         self.__bjobs_cache = None
         self.bkill = None
+        # Jobs listing shared by all the steps of the project run.
+        self.snapshot = snapshot
         self.init_scheduling()
         self.states_map = {
             PENDING_STATE: 'PEND',
@@ -27,7 +35,7 @@ class Lsf(BrainyScheduler):
         try:
             from sh import bjobs as _bjobs, bsub as _bsub, bkill as _bkill
             self.bsub = _bsub
-            self.bjobs = _bjobs
+            self._bjobs = _bjobs
             self.bkill = _bkill
         except ImportError:
             exception = NoLsfSchedulerFound('Failed to locate LSF commands '
@@ -36,18 +44,37 @@ class Lsf(BrainyScheduler):
             logger.warn(exception)
 
     def bjobs(self, *args, **kwds):
+        if self._bjobs is None:
+            raise NoLsfSchedulerFound('Failed to locate bjobs.')
         if not self.__bjobs_cache:
-            self.__bjobs_cache = self._bjobs(*args, **kwds)
+            fs.count_spawn('bjobs')
+            with metrics.timer('brainy_scheduler_call_seconds',
+                               call='bjobs'), \
+                    span('bjobs', category='scheduler', args=list(args)):
+                self.__bjobs_cache = str(self._bjobs(*args, **kwds))
         return self.__bjobs_cache
 
+    def take_snapshot(self):
+        '''Query `bjobs -aw` once. Parsing is left to the consumers.'''
+        return SchedulerSnapshot('lsf', self.bjobs('-aw').split('\n'))
+
+    def list_job_lines(self):
+        if self.snapshot is None:
+            self.snapshot = self.take_snapshot()
+        return self.snapshot.lines
+
     def submit_job(self, shell_command, queue, report_file):
         '''Submit job using *bsub* command.'''
         try:
-            self.bsub(
-                '-W', queue,
-                '-o', report_file,
-                shell_command,
-            )
+            fs.count_spawn('bsub')
+            with metrics.timer('brainy_scheduler_call_seconds', call='bsub'), \
+                    span('bsub', category='scheduler', queue=queue,
+                         report_file=report_file):
+                self.bsub(
+                    '-W', queue,
+                    '-o', report_file,
+                    shell_command,
+                )
         except Exception as error:
             logger.exception(error)
             return 'Failed to submit new job: %s' % shell_command
@@ -64,10 +91,11 @@ class Lsf(BrainyScheduler):
         description to contain the **key** substring. If key is None,
         then no filtering is done.
         '''
-        jobs_list = self.bjobs('-aw').split('\n')
+        jobs_list = self.list_job_lines()
         if len(jobs_list) == 0:
-            raise Exception('Failed to run bjobs')
-        elif len(jobs_list) == 1 and 'No job found' in jobs_list:
+            # Snapshot of the project has no jobs.
+            return 0
+        elif len(jobs_list) == 1 and 'No job found' in jobs_list[0]:
             return 0
         working_jobs = [job_info for job_info in jobs_list
                         if ' RUN ' in job_info or ' PEND ' in job_info]
@@ -85,4 +113,15 @@ class Lsf(BrainyScheduler):
     def list_jobs(self, states):
         assert all([(state in JOB_STATES) for state in states])
         # TODO: make pure python implementation for state filtering.
-        return self.bjobs('-aw').split('\n')
+        return self.list_job_lines()
+
+    def get_job_states(self, key=None):
+        job_states = list()
+        # Columns: JOBID USER STAT QUEUE FROM_HOST EXEC_HOST JOB_NAME ..
+        for job_info in self.list_jobs(JOB_STATES):
+            fields = job_info.split()
+            if len(fields) < 3 or fields[0] == 'JOBID' or \
+                    (key is not None and key not in job_info):
+                continue
+            job_states.append((fields[0], fields[2]))
+        return sorted(job_states)
@@ -2,6 +2,7 @@ import logging
 from brainy.utils import invoke
 from brainy.scheduler.base import BrainyScheduler
 from brainy.errors import BrainyProcessError
+from brainy.metrics import metrics
 logger = logging.getLogger(__name__)
 
 
@@ -13,7 +14,8 @@ class ShellCommand(BrainyScheduler):
 
     def submit_job(self, shell_command, queue, report_file):
         # Invoke the shell command.
-        (stdoutdata, stderrdata) = invoke(shell_command)
+        with metrics.timer('brainy_scheduler_call_seconds', call='invoke'):
+            (stdoutdata, stderrdata) = invoke(shell_command)
         # Produce a report output.
         with open(report_file, 'w+') as report:
             report.write('--CMD---' + '-' * 80 + '\n')
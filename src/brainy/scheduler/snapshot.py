@@ -0,0 +1,139 @@
+'''
+brainy.scheduler.snapshot
+
+A snapshot of all the jobs known to the scheduler, e.g. the output of
+`bjobs -aw`. The daemon takes a single snapshot per tick, indexes it by
+project and injects it into every project run, instead of letting each of
+them query the whole cluster. Projects run as subprocesses read the same
+snapshot from a cache file, as long as it is fresh enough.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import re
+import time
+import json
+import logging
+from brainy import fs
+logger = logging.getLogger(__name__)
+
+SCHEDULER_SNAPSHOT_PATH = os.path.expanduser(
+    '~/.brainy/cache/scheduler/%(engine)s.snapshot')
+# Daemon points subprocess runs to the snapshot file it has taken.
+SCHEDULER_SNAPSHOT_ENV = 'BRAINY_SCHEDULER_SNAPSHOT'
+DEFAULT_SNAPSHOT_TTL = 60
+# Absolute paths inside of job descriptions.
+PATH_EXP = re.compile(r'/[^\s\'";:,()<>]+')
+
+
+class SchedulerSnapshot(object):
+
+    def __init__(self, engine, lines, taken_at=None):
+        self.engine = engine
+        self.lines = [line for line in lines if line.strip()]
+        self.taken_at = time.time() if taken_at is None else taken_at
+        # Project path -> lines, see index_projects().
+        self.index = None
+        # Normalized and resolved project paths -> project path.
+        self.aliases = dict()
+
+    @staticmethod
+    def match_project(path, aliases):
+        '''Walk up the path until it is one of the (aliased) projects.'''
+        path = os.path.normpath(path)
+        while len(path) > 1:
+            if path in aliases:
+                return aliases[path]
+            path = os.path.dirname(path)
+        return None
+
+    def index_projects(self, project_paths):
+        '''
+        Sort job lines by the projects they belong to. Every path found in
+        the job description is matched against project paths by walking up
+        its parents, so the snapshot is scanned only once. Paths are
+        normalized, and resolved if they do not match otherwise, e.g. when
+        jobs were submitted through another symlink of the project.
+        '''
+        self.index = dict((project_path, list())
+                          for project_path in project_paths)
+        self.aliases = dict()
+        for project_path in project_paths:
+            for alias in (os.path.normpath(project_path),
+                          os.path.realpath(project_path)):
+                self.aliases.setdefault(alias, project_path)
+        resolved_paths = dict()
+        for line in self.lines:
+            matched = set()
+            for path in PATH_EXP.findall(line):
+                project_path = self.match_project(path, self.aliases)
+                if project_path is None:
+                    if path not in resolved_paths:
+                        resolved_paths[path] = self.match_project(
+                            os.path.realpath(path), self.aliases)
+                    project_path = resolved_paths[path]
+                if project_path is not None:
+                    matched.add(project_path)
+            for project_path in matched:
+                self.index[project_path].append(line)
+        return self.index
+
+    def for_project(self, project_path):
+        '''
+        Return a (smaller) snapshot of jobs of a single project. Return None
+        if the project was not indexed, so that its scheduler queries jobs
+        by itself.
+        '''
+        if self.index is None:
+            lines = [line for line in self.lines if project_path in line]
+            return SchedulerSnapshot(self.engine, lines,
+                                     taken_at=self.taken_at)
+        if project_path not in self.index:
+            project_path = self.aliases.get(os.path.normpath(project_path)) \
+                or self.aliases.get(os.path.realpath(project_path))
+            if project_path is None:
+                return None
+        return SchedulerSnapshot(self.engine, self.index[project_path],
+                                 taken_at=self.taken_at)
+
+    @property
+    def age(self):
+        return time.time() - self.taken_at
+
+    def save(self, snapshot_path=None):
+        if snapshot_path is None:
+            snapshot_path = SCHEDULER_SNAPSHOT_PATH % {'engine': self.engine}
+        folder = os.path.dirname(snapshot_path)
+        if not fs.exists(folder):
+            fs.makedirs(folder)
+        # Write atomically, since project runs may be reading it.
+        with fs.open_file(snapshot_path + '.tmp', 'w+') as stream:
+            json.dump({
+                'engine': self.engine,
+                'taken_at': self.taken_at,
+                'lines': self.lines,
+            }, stream)
+        fs.rename(snapshot_path + '.tmp', snapshot_path)
+        return snapshot_path
+
+    @classmethod
+    def load(cls, snapshot_path, ttl=DEFAULT_SNAPSHOT_TTL):
+        '''Return a snapshot or None if it is missing or older than ttl.'''
+        if not fs.exists(snapshot_path):
+            return None
+        try:
+            with fs.open_file(snapshot_path) as stream:
+                data = json.load(stream)
+        except ValueError:
+            logger.warn('Ignoring broken scheduler snapshot: %s' %
+                        snapshot_path)
+            return None
+        snapshot = cls(data['engine'], data['lines'],
+                       taken_at=data['taken_at'])
+        if snapshot.age > ttl:
+            logger.info('Scheduler snapshot is too old: %s' % snapshot_path)
+            return None
+        return snapshot
@@ -0,0 +1,208 @@
+'''
+brainy.tracing
+
+Lightweight timing spans around phases of step evaluation, e.g.
+
+    with span('working_jobs_count'):
+        ...
+
+Durations of 'phase' spans are aggregated per (pipe, step, phase) for the
+current thread, so that projects run in-process by the daemon do not mix up
+their timings. Optionally, every span (pipes, steps, state decisions,
+scheduler calls, subprocesses) is also recorded as an event and exported in
+the Chrome trace-event format, which is viewed by chrome://tracing or
+Perfetto. When tracing is disabled, span() returns a shared no-op context
+manager.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import csv
+import json
+import time
+import thread
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+TIMINGS_DUMP_FORMATS = ('csv', 'json')
+TIMINGS_FIELDS = ('pipe', 'step', 'phase', 'count', 'total_seconds',
+                  'max_seconds')
+# Category of spans that are aggregated into timings.
+PHASE = 'phase'
+
+
+class Tracer(threading.local):
+
+    def __init__(self):
+        self.enabled = False
+        self.timings_enabled = False
+        self.pipe = None
+        self.step = None
+        # (pipe, step, phase) -> [count, total, max]
+        self.timings = dict()
+        # Recorded trace events or None.
+        self.events = None
+
+    def start(self, timings=True, events=False):
+        self.enabled = timings or events
+        self.timings_enabled = timings
+        self.pipe = None
+        self.step = None
+        self.timings = dict()
+        self.events = list() if events else None
+
+    def stop(self):
+        self.enabled = False
+
+    def enter_step(self, pipe, step):
+        self.pipe = pipe
+        self.step = step
+
+    def add_event(self, name, category, started_at, duration, args):
+        self.events.append({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(started_at * 1e6),
+            'dur': int(duration * 1e6),
+            'pid': os.getpid(),
+            'tid': thread.get_ident(),
+            'args': args,
+        })
+
+    def record(self, phase, duration):
+        if not self.timings_enabled:
+            return
+        key = (self.pipe, self.step, phase)
+        timing = self.timings.get(key)
+        if timing is None:
+            self.timings[key] = [1, duration, duration]
+            return
+        timing[0] += 1
+        timing[1] += duration
+        if duration > timing[2]:
+            timing[2] = duration
+
+    def summarize(self):
+        '''
+        Return timings aggregated per step and per pipe, sorted by names, as
+        plain dicts for the report.
+        '''
+        steps = list()
+        pipes = dict()
+        for (pipe, step, phase), (count, total, maximum) in \
+                sorted(self.timings.items(), key=lambda item: item[0]):
+            steps.append({
+                'pipe': pipe,
+                'step': step,
+                'phase': phase,
+                'count': count,
+                'total_seconds': round(total, 6),
+                'max_seconds': round(maximum, 6),
+            })
+            pipe_timing = pipes.setdefault((pipe, phase), [0, 0.0])
+            pipe_timing[0] += count
+            pipe_timing[1] += total
+        return {
+            'steps': steps,
+            'pipes': [{
+                'pipe': pipe,
+                'phase': phase,
+                'count': count,
+                'total_seconds': round(total, 6),
+            } for (pipe, phase), (count, total) in sorted(pipes.items())],
+        }
+
+
+tracer = Tracer()
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def set(self, **args):
+        pass
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+
+    __slots__ = ('name', 'category', 'args', 'started_at')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def set(self, **args):
+        '''Attach more attributes to the trace event.'''
+        self.args.update(args)
+
+    def __enter__(self):
+        self.started_at = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        duration = time.time() - self.started_at
+        if self.category == PHASE:
+            tracer.record(self.name, duration)
+        if tracer.events is not None:
+            if type is not None:
+                self.args['error'] = type.__name__
+            tracer.add_event(self.name, self.category, self.started_at,
+                             duration, self.args)
+        return False
+
+
+def span(name, category=PHASE, **args):
+    '''
+    Time the block, if tracing is on. Spans of the 'phase' category are
+    phases of the current step. Keyword arguments become attributes of the
+    trace event.
+    '''
+    if not tracer.enabled:
+        return NULL_SPAN
+    return Span(name, category, args)
+
+
+def dump_timings(timings, dump_filepath, dump_format='csv'):
+    '''Write step timings (see Tracer.summarize()) as CSV or JSON.'''
+    if dump_format not in TIMINGS_DUMP_FORMATS:
+        raise Exception('Unknown timings dump format: %s' % dump_format)
+    with open(dump_filepath, 'wb') as stream:
+        if dump_format == 'json':
+            json.dump(timings, stream, indent=2)
+            return dump_filepath
+        writer = csv.DictWriter(stream, fieldnames=TIMINGS_FIELDS)
+        writer.writeheader()
+        for row in timings['steps']:
+            writer.writerow(row)
+    return dump_filepath
+
+
+def dump_trace(events, trace_filepath, process_name='brainy'):
+    '''Write events in the Chrome trace-event JSON format.'''
+    metadata = [{
+        'name': 'process_name',
+        'ph': 'M',
+        'pid': os.getpid(),
+        'tid': 0,
+        'args': {'name': process_name},
+    }]
+    with open(trace_filepath, 'w+') as stream:
+        json.dump({
+            'traceEvents': metadata + events,
+            'displayTimeUnit': 'ms',
+        }, stream)
+    return trace_filepath
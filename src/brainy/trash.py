@@ -0,0 +1,307 @@
+'''
+brainy.trash
+
+Cleaning of project output without blocking on `shutil.rmtree`. Folders are
+atomically renamed into a trash area inside the project, so that the project
+becomes reusable right away. Actual deletion is done by a resumable sweeper,
+which runs in parallel and can be started in background (by the CLI or the
+daemon) or in foreground (`brainy project clean --sweep`).
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import logging
+import tempfile
+import threading
+from subprocess import Popen
+from multiprocessing.pool import ThreadPool
+from brainy.utils import get_timestamp_str
+logger = logging.getLogger(__name__)
+
+TRASH_FOLDER_NAME = '.trash'
+SWEEPER_PID_NAME = '.sweeper.pid'
+# Output of background sweepers, started over once it grows that large.
+SWEEPER_LOG_NAME = '.sweeper.log'
+SWEEPER_LOG_MAX_BYTES = 1024 * 1024
+DEFAULT_SWEEP_WORKERS = 4
+# How often (in seconds) the sweeper reports its progress.
+PROGRESS_INTERVAL = 10
+
+
+def ignore_missing(func, *args):
+    '''
+    Call os-level function ignoring errors about missing entries. This makes
+    sweeping resumable and tolerant to concurrent sweepers.
+    '''
+    try:
+        func(*args)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def remove_tree(path, progress=None):
+    '''
+    Remove a file or a folder bottom-up. Return the number of removed
+    entries. Symlinks are removed, but never followed.
+    '''
+    if os.path.islink(path) or not os.path.isdir(path):
+        removed = int(ignore_missing(os.unlink, path))
+        if progress is not None:
+            progress.add(removed)
+        return removed
+    removed = 0
+    for root, dirs, files in os.walk(path, topdown=False):
+        count = 0
+        for name in files:
+            count += ignore_missing(os.unlink, os.path.join(root, name))
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            if os.path.islink(dir_path):
+                count += ignore_missing(os.unlink, dir_path)
+            else:
+                count += ignore_missing(os.rmdir, dir_path)
+        if progress is not None:
+            progress.add(count)
+        removed += count
+    count = int(ignore_missing(os.rmdir, path))
+    if progress is not None:
+        progress.add(count)
+    return removed + count
+
+
+class SweepProgress(object):
+    '''Thread-safe counter of removed entries that logs every few seconds.'''
+
+    def __init__(self, interval=PROGRESS_INTERVAL):
+        self.interval = interval
+        self.removed = 0
+        self.started_at = time.time()
+        self.__reported_at = self.started_at
+        self.__lock = threading.Lock()
+
+    def add(self, count):
+        with self.__lock:
+            self.removed += count
+            now = time.time()
+            if now - self.__reported_at < self.interval:
+                return
+            self.__reported_at = now
+        self.report()
+
+    def report(self):
+        elapsed = time.time() - self.started_at
+        logger.info('Swept %d entries in %d (s), %.1f entries/s' % (
+                    self.removed, elapsed,
+                    self.removed / elapsed if elapsed > 0 else 0))
+
+
+class TrashBin(object):
+    '''
+    A trash folder located inside the project. Pipe outputs are moved here by
+    rename, which is atomic as long as trash and outputs share the file
+    system.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_project(cls, project_path):
+        return cls(os.path.join(project_path, TRASH_FOLDER_NAME))
+
+    @property
+    def pid_path(self):
+        return os.path.join(self.path, SWEEPER_PID_NAME)
+
+    @property
+    def log_path(self):
+        return os.path.join(self.path, SWEEPER_LOG_NAME)
+
+    def discard(self, pathname):
+        '''
+        Atomically move pathname into trash. Return the new location or None
+        if pathname had to be removed synchronously (trash is on a different
+        device).
+        '''
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        # Every discarded item gets its own unique bucket, so that repeated
+        # cleaning of the same pipe never collides.
+        bucket = tempfile.mkdtemp(prefix=get_timestamp_str() + '-',
+                                  dir=self.path)
+        trashed_path = os.path.join(bucket, os.path.basename(pathname))
+        try:
+            os.rename(pathname, trashed_path)
+        except OSError as error:
+            os.rmdir(bucket)
+            if error.errno != errno.EXDEV:
+                raise
+            logger.warn('Trash is on another device. Removing in place: %s' %
+                        pathname)
+            shutil.rmtree(pathname)
+            return None
+        logger.info('Moved to trash: %s -> %s' % (pathname, trashed_path))
+        return trashed_path
+
+    def list_items(self):
+        '''List top-level trash entries, i.e. buckets of discarded items.'''
+        if not os.path.exists(self.path):
+            return []
+        return [os.path.join(self.path, name)
+                for name in sorted(os.listdir(self.path))
+                if name not in (SWEEPER_PID_NAME, SWEEPER_LOG_NAME)]
+
+    def has_items(self):
+        return len(self.list_items()) > 0
+
+    def is_being_swept(self):
+        '''Check if a live sweeper process holds the trash.'''
+        if not os.path.exists(self.pid_path):
+            return False
+        try:
+            pid = int(open(self.pid_path).read().strip())
+            os.kill(pid, 0)
+        except (ValueError, IOError, OSError):
+            # Stale pid file of an interrupted sweeper.
+            return False
+        return pid != os.getpid()
+
+    def lock(self):
+        '''
+        Take an exclusive lock of the trash by flock on the pid file. Return
+        the open pid file, which holds the lock until closed, or None if
+        another sweeper holds it. The lock is released by the kernel when the
+        sweeper dies, so a stale pid file never blocks sweeping.
+        '''
+        while True:
+            pid_file = open(self.pid_path, 'a+')
+            try:
+                fcntl.flock(pid_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as error:
+                pid_file.close()
+                if error.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            # The holder unlinks the pid file before releasing the lock, so
+            # we may have locked a file that is gone. Then try again.
+            try:
+                is_current = os.fstat(pid_file.fileno()).st_ino == \
+                    os.stat(self.pid_path).st_ino
+            except OSError as error:
+                if error.errno != errno.ENOENT:
+                    raise
+                is_current = False
+            if is_current:
+                break
+            pid_file.close()
+        pid_file.seek(0)
+        pid_file.truncate()
+        pid_file.write(str(os.getpid()))
+        pid_file.flush()
+        return pid_file
+
+    def list_sweep_tasks(self):
+        '''
+        Split trash content into independent subtrees. We go two levels deep
+        (bucket -> discarded folder -> its children), so that a single huge
+        pipe output is still deleted in parallel.
+        '''
+        tasks = list()
+        for bucket in self.list_items():
+            if os.path.islink(bucket) or not os.path.isdir(bucket):
+                tasks.append(bucket)
+                continue
+            for name in os.listdir(bucket):
+                item = os.path.join(bucket, name)
+                if os.path.islink(item) or not os.path.isdir(item):
+                    tasks.append(item)
+                    continue
+                tasks.extend(os.path.join(item, child)
+                             for child in os.listdir(item))
+        return tasks
+
+    def sweep(self, workers=DEFAULT_SWEEP_WORKERS):
+        '''
+        Delete everything in trash using a pool of workers. Return the number
+        of removed entries. Interrupted sweeping is resumed by the next call.
+        '''
+        if not os.path.exists(self.path):
+            return 0
+        pid_file = self.lock()
+        if pid_file is None:
+            logger.info('Trash is already being swept: %s' % self.path)
+            return 0
+        progress = SweepProgress()
+        try:
+            tasks = self.list_sweep_tasks()
+            logger.info('Sweeping %d item(s) from trash: %s' %
+                        (len(tasks), self.path))
+            pool = ThreadPool(max(1, workers))
+            try:
+                pool.map(lambda task: remove_tree(task, progress), tasks)
+            finally:
+                pool.close()
+                pool.join()
+            # Remove the now empty buckets.
+            for bucket in self.list_items():
+                remove_tree(bucket, progress)
+        finally:
+            # Unlink before releasing the lock, see lock().
+            ignore_missing(os.unlink, self.pid_path)
+            pid_file.close()
+        progress.report()
+        return progress.removed
+
+    def sweep_in_background(self, workers=DEFAULT_SWEEP_WORKERS):
+        '''
+        Detach a sweeper process, unless another one is already running.
+        Its progress and errors are logged into the trash, see log_path.
+        Return True if a new sweeper was started.
+        '''
+        if not self.has_items() or self.is_being_swept():
+            return False
+        brainy_src_path = os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [brainy_src_path] + env.get('PYTHONPATH', '').split(os.pathsep))
+        mode = 'a'
+        if os.path.exists(self.log_path) and \
+                os.path.getsize(self.log_path) > SWEEPER_LOG_MAX_BYTES:
+            mode = 'w'
+        with open(os.devnull) as devnull, \
+                open(self.log_path, mode) as log_file:
+            Popen([sys.executable, '-m', 'brainy.trash', self.path,
+                   '--workers', str(workers)],
+                  stdin=devnull, stdout=log_file, stderr=log_file,
+                  close_fds=True, preexec_fn=os.setsid, env=env)
+        logger.info('Started background sweeping of: %s (logging into %s)' %
+                    (self.path, self.log_path))
+        return True
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Sweep brainy trash.')
+    parser.add_argument('path', help='Full path to the trash folder.')
+    parser.add_argument('--workers', type=int,
+                        default=DEFAULT_SWEEP_WORKERS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    TrashBin(args.path).sweep(workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
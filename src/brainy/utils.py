@@ -4,10 +4,13 @@ from xml.sax.saxutils import escape as escape_xml_special_chars
 from subprocess import (PIPE, Popen)
 from datetime import datetime
 import yaml
+from brainy.tracing import span
+from brainy import fs
 try:
-    from yaml import CLoader as Loader, CDumper as Dumper
+    from yaml import (CLoader as Loader, CDumper as Dumper,
+                      CSafeDumper as SafeDumper)
 except ImportError:
-    from yaml import Loader, Dumper
+    from yaml import Loader, Dumper, SafeDumper
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -21,13 +24,17 @@ def invoke(command, _in=None):
     '''
     Invoke command as a new system process and return its output.
     '''
-    process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE, shell=True,
-                    executable='/bin/bash')
-    if _in is not None:
-        return process.communicate(input=_in)
-    stdoutdata = process.stdout.read()
-    stderrdata = process.stderr.read()
-    return (stdoutdata, stderrdata)
+    fs.count_spawn('invoke')
+    with span('invoke', category='subprocess',
+              command=command[:200]) as invoke_span:
+        process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE,
+                        shell=True, executable='/bin/bash')
+        invoke_span.set(pid=process.pid)
+        if _in is not None:
+            return process.communicate(input=_in)
+        stdoutdata = process.stdout.read()
+        stderrdata = process.stderr.read()
+        return (stdoutdata, stderrdata)
 
 
 def escape_xml(raw_value):
@@ -94,7 +101,7 @@ def load_yaml(value):
         - is a YAML parser/emitter that supports roundtrip preservation
           of comments, seq/map flow style, and map key order.
     '''
-    return yaml.load(value)
+    return yaml.load(value, Loader=Loader)
 
 
 def dump_yaml(value):
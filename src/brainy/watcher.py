@@ -0,0 +1,416 @@
+'''
+brainy.watcher
+
+Wake the daemon up when something happens inside a project instead of
+re-evaluating every project after a fixed pause. Watched are project folders,
+pipe output folders (which hold flag files), `job_reports_of_*` folders and
+the workflow files (`.br`, `sequence` and the project config).
+
+Only folders of pipes that have a `.br` file are watched, since other folders
+of the project (e.g. images) can hold millions of entries. Folders are listed
+again only when their mtime changes (see ListingCache), so a poll costs a
+stat per watched folder and workflow file.
+
+Two implementations share the same interface: InotifyWatcher (requires
+pyinotify) and PollingWatcher, which compares mtimes and works on NFS too.
+Mode `auto` picks inotify only if all the projects are on local filesystems,
+since inotify never sees files written by other (e.g. LSF) hosts.
+
+@license: The MIT License (MIT). Read a copy of LICENSE distributed with
+          this code.
+
+Copyright (c) 2014-2015 Pelkmans Lab
+'''
+import os
+import time
+import stat as stat_module
+import logging
+from brainy import fs
+from brainy.config import BRAINY_PROJECT_CONFIG_NAME
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+logger = logging.getLogger(__name__)
+
+WATCH_MODES = ('auto', 'inotify', 'polling')
+DEFAULT_POLL_INTERVAL = 2
+# Folders of the project that are changed by brainy itself and never hint at
+# progress of the jobs.
+IGNORED_FOLDERS = ('reports', '.trash')
+WORKFLOW_FILES = ('sequence', BRAINY_PROJECT_CONFIG_NAME)
+PIPE_EXTENSION = '.br'
+JOB_REPORTS_PREFIX = 'job_reports_of_'
+# Listings of folders modified less than that many seconds before listing are
+# not trusted, since mtimes of some (network) file systems are that coarse.
+MTIME_RESOLUTION = 1
+MOUNTS_PATH = '/proc/mounts'
+# Filesystems that are written by this host only, so that inotify sees every
+# change. Anything else (e.g. nfs, gpfs, lustre) is polled.
+LOCAL_FILESYSTEMS = ('ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'zfs', 'tmpfs',
+                     'reiserfs', 'jfs', 'f2fs')
+
+
+def is_watched_folder(name):
+    return name not in IGNORED_FOLDERS
+
+
+def is_workflow_file(name):
+    return name in WORKFLOW_FILES or name.endswith(PIPE_EXTENSION)
+
+
+def get_filesystem_type(path, mounts_path=MOUNTS_PATH):
+    '''Return type of the filesystem holding the path or None if unknown.'''
+    path = os.path.realpath(path)
+    try:
+        with open(mounts_path) as stream:
+            lines = stream.readlines()
+    except IOError:
+        return None
+    mount_point, filesystem_type = '', None
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 3:
+            continue
+        # Spaces and such are escaped as octal codes.
+        point = fields[1].decode('string_escape')
+        if path != point and not path.startswith(point.rstrip('/') + '/'):
+            continue
+        # The innermost mount wins, the last one if mounted over.
+        if len(point) >= len(mount_point):
+            mount_point, filesystem_type = point, fields[2]
+    return filesystem_type
+
+
+def is_local_filesystem(path, mounts_path=MOUNTS_PATH):
+    return get_filesystem_type(path, mounts_path) in LOCAL_FILESYSTEMS
+
+
+class ListingCache(object):
+    '''
+    Names of entries of folders, which are listed again only if the mtime of
+    the folder has changed.
+    '''
+
+    def __init__(self):
+        # Folder path -> (mtime, names)
+        self.listings = dict()
+
+    def listdir(self, path, stat=None):
+        '''
+        Return names of entries of the folder. If the stat of the folder is
+        known, the folder is not stat-ed again.
+        '''
+        if stat is None:
+            stat = fs.stat(path)
+        listing = self.listings.get(path)
+        if listing is not None and listing[0] == stat.st_mtime:
+            return listing[1]
+        names = fs.listdir(path)
+        if time.time() - stat.st_mtime > MTIME_RESOLUTION:
+            self.listings[path] = (stat.st_mtime, names)
+        else:
+            self.listings.pop(path, None)
+        return names
+
+    def clear(self):
+        self.listings.clear()
+
+
+listing_cache = ListingCache()
+
+
+def stat_or_none(path):
+    try:
+        return fs.stat(path)
+    except OSError:
+        return None
+
+
+def lstat_or_none(path):
+    try:
+        return fs.lstat(path)
+    except OSError:
+        return None
+
+
+def list_workflow_files(project_path, stat=None):
+    try:
+        names = listing_cache.listdir(project_path, stat)
+    except OSError:
+        return []
+    return [os.path.join(project_path, name) for name in names
+            if is_workflow_file(name)]
+
+
+def list_pipe_folders(project_path, stat=None):
+    '''
+    Return (path, stat) of existing output folders of the pipes, i.e.
+    folders named after `.br` files of the project.
+    '''
+    folders = list()
+    for pathname in list_workflow_files(project_path, stat):
+        if not pathname.endswith(PIPE_EXTENSION):
+            continue
+        pipe_path = pathname[:-len(PIPE_EXTENSION)]
+        if not is_watched_folder(os.path.basename(pipe_path)):
+            continue
+        # Symlinked folders are not followed.
+        pipe_stat = lstat_or_none(pipe_path)
+        if pipe_stat is not None and stat_module.S_ISDIR(pipe_stat.st_mode):
+            folders.append((pipe_path, pipe_stat))
+    return sorted(folders)
+
+
+def list_job_reports_folders(pipe_path, stat=None):
+    try:
+        names = listing_cache.listdir(pipe_path, stat)
+    except OSError:
+        return []
+    return [os.path.join(pipe_path, name) for name in names
+            if name.startswith(JOB_REPORTS_PREFIX)]
+
+
+def list_watched_folders(project_path):
+    '''
+    List folders of the project whose content changes when jobs progress:
+    the project itself, pipe output folders and `job_reports_of_*` folders.
+    '''
+    folders = [project_path]
+    for pipe_path, pipe_stat in list_pipe_folders(project_path):
+        folders.append(pipe_path)
+        folders.extend(list_job_reports_folders(pipe_path, pipe_stat))
+    return folders
+
+
+class ProjectWatcher(object):
+    '''
+    Interface of watchers. Typical loop:
+
+        watcher.watch(project_paths)
+        while True:
+            changed = watcher.wait(timeout)
+            watcher.rebase(changed)
+            run(changed)
+
+    Note that projects are rebased right before they are run. Changes made
+    during the run (e.g. by jobs finishing meanwhile, but also by brainy
+    itself) are reported by the next wait(). A run that changes nothing
+    settles the project.
+    '''
+
+    def __init__(self):
+        self.project_paths = list()
+
+    def watch(self, project_paths):
+        '''
+        Start watching given projects. Projects that were already watched
+        keep their pending changes.
+        '''
+        self.project_paths = list(project_paths)
+
+    def wait(self, timeout):
+        '''
+        Block for at most timeout seconds. Return a set of paths of projects
+        that have changed.
+        '''
+        raise NotImplementedError()
+
+    def rebase(self, project_paths):
+        '''
+        Forget changes of projects that are about to be run, since the run
+        will see them anyway.
+        '''
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class PollingWatcher(ProjectWatcher):
+    '''Compare mtimes of watched folders and files every few seconds.'''
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        super(PollingWatcher, self).__init__()
+        self.poll_interval = poll_interval
+        self.snapshots = dict()
+
+    @staticmethod
+    def take_snapshot(project_path):
+        '''
+        Return mtimes and sizes of the watched folders and workflow files.
+        Folders are listed only if they have changed.
+        '''
+        snapshot = dict()
+        project_stat = stat_or_none(project_path)
+        if project_stat is None:
+            return snapshot
+        snapshot[project_path] = (project_stat.st_mtime, project_stat.st_size)
+        for pathname in list_workflow_files(project_path, project_stat):
+            stat = stat_or_none(pathname)
+            if stat is not None:
+                snapshot[pathname] = (stat.st_mtime, stat.st_size)
+        for pipe_path, pipe_stat in list_pipe_folders(project_path,
+                                                      project_stat):
+            snapshot[pipe_path] = (pipe_stat.st_mtime, pipe_stat.st_size)
+            for folder in list_job_reports_folders(pipe_path, pipe_stat):
+                stat = stat_or_none(folder)
+                if stat is not None:
+                    snapshot[folder] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def watch(self, project_paths):
+        super(PollingWatcher, self).watch(project_paths)
+        self.snapshots = dict(
+            (project_path, self.snapshots.get(project_path) or
+             self.take_snapshot(project_path))
+            for project_path in self.project_paths)
+
+    def poll(self):
+        changed = set()
+        for project_path in self.project_paths:
+            snapshot = self.take_snapshot(project_path)
+            if snapshot != self.snapshots.get(project_path):
+                changed.add(project_path)
+        return changed
+
+    def wait(self, timeout):
+        deadline = time.time() + max(0, timeout)
+        while True:
+            changed = self.poll()
+            if changed:
+                return changed
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.poll_interval, remaining))
+
+    def rebase(self, project_paths):
+        for project_path in project_paths:
+            self.snapshots[project_path] = self.take_snapshot(project_path)
+
+
+class InotifyWatcher(ProjectWatcher):
+    '''
+    Receive change events from the kernel. Note that inotify does not see
+    changes made by other hosts on network file systems.
+    '''
+
+    MASK = 0
+    if pyinotify is not None:
+        MASK = pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM | \
+            pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB
+
+    def __init__(self):
+        if pyinotify is None:
+            raise ImportError('InotifyWatcher requires pyinotify.')
+        super(InotifyWatcher, self).__init__()
+        self.changed = set()
+        self.watch_manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.watch_manager,
+                                           default_proc_fun=self.process_event)
+        # Watched folder -> project path.
+        self.folders = dict()
+
+    def add_folder(self, folder, project_path):
+        if folder in self.folders:
+            return
+        self.watch_manager.add_watch(folder, self.MASK, quiet=True)
+        self.folders[folder] = project_path
+
+    def add_pipe_folder(self, pipe_path, project_path):
+        self.add_folder(pipe_path, project_path)
+        for folder in list_job_reports_folders(pipe_path):
+            self.add_folder(folder, project_path)
+
+    def watch(self, project_paths):
+        super(InotifyWatcher, self).watch(project_paths)
+        watched = set(self.project_paths)
+        for folder, project_path in self.folders.items():
+            if project_path in watched:
+                continue
+            watch_descriptor = self.watch_manager.get_wd(folder)
+            if watch_descriptor is not None:
+                self.watch_manager.rm_watch(watch_descriptor, quiet=True)
+            del self.folders[folder]
+        self.changed &= watched
+        for project_path in self.project_paths:
+            for folder in list_watched_folders(project_path):
+                self.add_folder(folder, project_path)
+
+    def process_event(self, event):
+        project_path = self.folders.get(event.path)
+        if project_path is None:
+            return
+        is_pipe_folder = event.path == project_path and event.dir and \
+            is_watched_folder(event.name) and fs.exists(
+                event.pathname + PIPE_EXTENSION)
+        if event.path == project_path and not is_pipe_folder and \
+                not (not event.dir and is_workflow_file(event.name)):
+            # Ignore unrelated files and folders in the project root.
+            return
+        if event.path == project_path and not event.dir and \
+                event.name.endswith(PIPE_EXTENSION):
+            # Output folder of a new pipe may predate its definition.
+            pipe_path = event.pathname[:-len(PIPE_EXTENSION)]
+            pipe_stat = lstat_or_none(pipe_path)
+            if pipe_stat is not None and \
+                    stat_module.S_ISDIR(pipe_stat.st_mode):
+                self.add_pipe_folder(pipe_path, project_path)
+        if event.dir and event.mask & (pyinotify.IN_CREATE |
+                                       pyinotify.IN_MOVED_TO):
+            # New pipe output or job reports folder.
+            if is_pipe_folder:
+                self.add_pipe_folder(event.pathname, project_path)
+            elif event.name.startswith(JOB_REPORTS_PREFIX):
+                self.add_folder(event.pathname, project_path)
+        self.changed.add(project_path)
+
+    def read_events(self, timeout):
+        if self.notifier.check_events(timeout=int(max(0, timeout) * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+
+    def wait(self, timeout):
+        deadline = time.time() + max(0, timeout)
+        while not self.changed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.read_events(remaining)
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def rebase(self, project_paths):
+        # Drain queued events, the runs will see these changes.
+        self.read_events(0)
+        self.changed -= set(project_paths)
+
+    def close(self):
+        self.notifier.stop()
+
+
+def build_watcher(mode='auto', poll_interval=DEFAULT_POLL_INTERVAL,
+                  project_paths=()):
+    '''
+    Mode `auto` uses inotify if pyinotify is available and all the (known)
+    project_paths are on local filesystems, otherwise it polls.
+    '''
+    if mode not in WATCH_MODES:
+        raise ValueError('Unknown watch mode: %s (expected one of %s)' %
+                         (mode, ', '.join(WATCH_MODES)))
+    if mode == 'auto':
+        remote_paths = [path for path in project_paths
+                        if not is_local_filesystem(path)]
+        if remote_paths:
+            logger.info('Not using inotify, since some projects are not on '
+                        'a local filesystem: %s' % ', '.join(remote_paths))
+        mode = 'inotify' if pyinotify is not None and project_paths and \
+            not remote_paths else 'polling'
+    if mode == 'inotify':
+        logger.info('Watching projects with inotify.')
+        return InotifyWatcher()
+    logger.info('Watching projects by polling every %d (s).' % poll_interval)
+    return PollingWatcher(poll_interval=poll_interval)
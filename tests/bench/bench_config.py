@@ -0,0 +1,35 @@
+'''
+Startup benchmark of config loading: cold (parse and merge every YAML) vs
+warm (cached merged config).
+
+Usage: python tests/bench/bench_config.py [repeat]
+'''
+import os
+import sys
+import time
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'src'))
+from brainy.config import (ConfigCache, build_brainy_config,
+                           load_brainy_config)
+
+
+def measure(func, repeat):
+    started_at = time.time()
+    for index in range(repeat):
+        func()
+    return (time.time() - started_at) / repeat * 1000
+
+
+if __name__ == '__main__':
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    cache = ConfigCache(tempfile.mkdtemp())
+    cold = measure(lambda: load_brainy_config(use_cache=False), repeat)
+    cache.load('brainy', build_brainy_config)
+    warm_memory = measure(lambda: cache.load('brainy', build_brainy_config),
+                          repeat)
+    warm_disk = measure(lambda: ConfigCache(cache.cache_path).load(
+        'brainy', build_brainy_config), repeat)
+    print 'cold:          %.3f ms' % cold
+    print 'warm (memory): %.3f ms' % warm_memory
+    print 'warm (disk):   %.3f ms' % warm_disk
@@ -0,0 +1,28 @@
+'''
+Micro-benchmarks of brainy primitives on seeded fixtures, see
+brainy.microbench. Prints median time per call and writes all the numbers as
+JSON.
+
+Usage: python tests/bench/bench_micro.py [output.json] [large_report_mb]
+'''
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'src'))
+from brainy.microbench import run_micro_benchmarks, DEFAULT_LARGE_REPORT_MB
+from brainy.log import setup_logging
+
+
+if __name__ == '__main__':
+    output_path = sys.argv[1] if len(sys.argv) > 1 else 'bench_micro.json'
+    large_report_mb = int(sys.argv[2]) if len(sys.argv) > 2 \
+        else DEFAULT_LARGE_REPORT_MB
+    setup_logging('silent')
+    results = run_micro_benchmarks(large_report_mb=large_report_mb)
+    for result in results['benchmarks']:
+        print '%-30s %-40s %12.6f ms' % (
+            result['name'], json.dumps(result['params'], sort_keys=True),
+            result['median_seconds'] * 1000)
+    with open(output_path, 'w+') as stream:
+        json.dump(results, stream, indent=2)
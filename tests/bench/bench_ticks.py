@@ -0,0 +1,35 @@
+'''
+End-to-end benchmark of project ticks on synthetic projects, see
+brainy.bench. Prints median latency per scenario and writes all the numbers
+as JSON.
+
+Usage: python tests/bench/bench_ticks.py [output.json]
+'''
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))), 'src'))
+from brainy.bench import run_benchmark
+from brainy.log import setup_logging
+
+MATRIX = {
+    'pipes': [1, 4],
+    'processes': [1, 8],
+    'foreach': [0, 100],
+    'job_reports': [0, 100],
+    'flags': ['fresh', 'submitted', 'complete'],
+    'engine': ['shellcmd', 'lsf'],
+}
+
+
+if __name__ == '__main__':
+    output_path = sys.argv[1] if len(sys.argv) > 1 else 'bench_ticks.json'
+    setup_logging('silent')
+    results = run_benchmark(MATRIX, ticks=3)
+    for result in results['scenarios']:
+        print '%-100s %8.3f ms' % (
+            json.dumps(result['scenario'], sort_keys=True),
+            result['summary']['latency_seconds']['median'] * 1000)
+    with open(output_path, 'w+') as stream:
+        json.dump(results, stream, indent=2)
@@ -0,0 +1,126 @@
+import os
+import time
+import shutil
+import tempfile
+from brainy_tests import BrainyTest
+from multiprocessing.pool import ThreadPool
+from brainy.backups import (make_snapshot, load_manifest, list_snapshots,
+                            select_snapshots_to_keep, hash_file, ObjectStore,
+                            PARTIAL_PREFIX)
+from brainy.pipes.FileTools import backup_batch_folder
+
+
+def write(path, content):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w+') as stream:
+        stream.write(content)
+
+
+class TestBackups(BrainyTest):
+
+    def test_incremental_snapshots(self):
+        '''Test backups: unchanged files are hardlinked to previous backup'''
+        parent = tempfile.mkdtemp()
+        data_path = os.path.join(parent, 'BATCH')
+        backups_path = os.path.join(parent, 'BACKUPS')
+        os.makedirs(backups_path)
+        write(os.path.join(data_path, 'same.mat'), 'same')
+        write(os.path.join(data_path, 'nested', 'changed.mat'), 'old')
+        os.makedirs(os.path.join(data_path, 'empty'))
+        first = backup_batch_folder(data_path, backups_path)
+        manifest = load_manifest(first)
+        assert manifest['summary']['copied'] == 2
+        assert os.path.isdir(os.path.join(first, 'empty'))
+        # Snapshots are named by seconds.
+        time.sleep(1.1)
+        write(os.path.join(data_path, 'nested', 'changed.mat'), 'new!')
+        # Simulate an interrupted backup.
+        partial_path = os.path.join(backups_path,
+                                    PARTIAL_PREFIX + 'BATCH_29990101000000')
+        shutil.copytree(first, partial_path)
+        second = make_snapshot(data_path, backups_path, checksum=True)
+        assert list_snapshots(backups_path) == [first, second]
+        summary = load_manifest(second)['summary']
+        assert summary['copied'] == 1
+        # Copies left by the interrupted backup are linked again.
+        assert summary['linked'] == 1
+        assert summary['resumed'] == 0
+        assert os.path.samefile(os.path.join(first, 'same.mat'),
+                                os.path.join(second, 'same.mat'))
+        # Old backup is intact.
+        with open(os.path.join(first, 'nested', 'changed.mat')) as stream:
+            assert stream.read() == 'old'
+        with open(os.path.join(second, 'nested', 'changed.mat')) as stream:
+            assert stream.read() == 'new!'
+        # Links made by the interrupted backup are kept.
+        partial_path = os.path.join(backups_path,
+                                    PARTIAL_PREFIX + 'BATCH_29990101000001')
+        os.makedirs(os.path.join(partial_path, 'nested'))
+        os.link(os.path.join(second, 'same.mat'),
+                os.path.join(partial_path, 'same.mat'))
+        third = make_snapshot(data_path, backups_path)
+        assert list_snapshots(backups_path) == [first, second, third]
+        summary = load_manifest(third)['summary']
+        assert summary['resumed'] == 1
+        assert summary['linked'] == 1
+        assert summary['copied'] == 0
+
+    def test_dedup_and_retention(self):
+        '''Test backups: same content is shared, old backups are pruned'''
+        parent = tempfile.mkdtemp()
+        data_path = os.path.join(parent, 'BATCH')
+        backups_path = os.path.join(parent, 'BACKUPS')
+        os.makedirs(backups_path)
+        write(os.path.join(data_path, 'a.mat'), 'same')
+        write(os.path.join(data_path, 'b.mat'), 'same')
+        first = backup_batch_folder(data_path, backups_path, dedup=True)
+        assert load_manifest(first)['summary']['deduplicated'] == 1
+        assert os.path.samefile(os.path.join(first, 'a.mat'),
+                                os.path.join(first, 'b.mat'))
+        time.sleep(1.1)
+        write(os.path.join(data_path, 'c.mat'), 'other')
+        second = backup_batch_folder(data_path, backups_path, dedup=True,
+                                     keep_last=1)
+        assert list_snapshots(backups_path) == [second]
+        assert not os.path.exists(first)
+        # Objects are still linked by the second backup.
+        objects_path = os.path.join(backups_path, '.objects')
+        assert sum(len(filenames) for root, dirnames, filenames
+                   in os.walk(objects_path)) == 2
+        with open(os.path.join(second, 'a.mat')) as stream:
+            assert stream.read() == 'same'
+
+    def test_concurrent_objects(self):
+        '''Test backups: an object added by many workers is copied once'''
+        parent = tempfile.mkdtemp()
+        source_path = os.path.join(parent, 'a.mat')
+        write(source_path, 'same' * 1024)
+        sha1 = hash_file(source_path)
+        store = ObjectStore(parent)
+        pool = ThreadPool(8)
+        try:
+            added = pool.map(lambda index: store.add(source_path, sha1),
+                             range(32))
+        finally:
+            pool.close()
+            pool.join()
+        assert added.count(True) == 1
+        # No temporary copies are left behind.
+        assert os.listdir(os.path.dirname(store.get_object_path(sha1))) == \
+            [sha1]
+        assert hash_file(store.get_object_path(sha1)) == sha1
+
+    def test_retention_policy(self):
+        '''Test backups: keep last, daily and weekly backups'''
+        names = ['BATCH_20150601120000', 'BATCH_20150601080000',
+                 'BATCH_20150531230000', 'BATCH_20150530120000',
+                 'BATCH_20150520120000', 'BATCH_20150510120000']
+        assert select_snapshots_to_keep(names, keep_last=2) == \
+            set(names[:2])
+        assert select_snapshots_to_keep(names, keep_daily=3) == \
+            set([names[0], names[2], names[3]])
+        # 2015-06-01 is Monday.
+        assert select_snapshots_to_keep(names, keep_weekly=3) == \
+            set([names[0], names[2], names[4]])
+        assert select_snapshots_to_keep(names) == set()
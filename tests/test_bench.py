@@ -0,0 +1,42 @@
+import json
+import shutil
+import tempfile
+from brainy_tests import BrainyTest
+from brainy.bench import run_scenario, iter_scenarios
+from brainy.microbench import (run_micro_benchmarks, MicroFixtures,
+                               MICRO_CASES)
+
+
+class TestBench(BrainyTest):
+
+    def test_run_scenario(self):
+        '''Test bench: ticks of a synthetic project are measured'''
+        scenarios = list(iter_scenarios({'engine': ['shellcmd', 'lsf'],
+                                         'flags': ['fresh']}))
+        assert len(scenarios) == 2
+        result = run_scenario(scenarios[1], ticks=2, warmup=0)
+        assert len(result['ticks']) == 2
+        # Fake bsub and bjobs are spawned on every tick.
+        assert result['summary']['subprocess_spawns']['min'] >= 2
+        assert result['summary']['latency_seconds']['max'] > 0
+        json.dumps(result)
+
+    def test_micro_benchmarks(self):
+        '''Test bench: primitives are measured on seeded fixtures'''
+        results = run_micro_benchmarks(repeat=1, large_report_mb=1,
+                                       linked_files=10, bjobs_lines=100)
+        names = set(result['name'] for result in results['benchmarks'])
+        assert names == set(MICRO_CASES)
+        assert all(result['min_seconds'] >= 0
+                   for result in results['benchmarks'])
+        json.dumps(results)
+        # Fixtures are reproducible.
+        root_path = tempfile.mkdtemp()
+        try:
+            fixtures = MicroFixtures(root_path, linked_files=10)
+            assert fixtures.make_code('bash') == fixtures.make_code('bash')
+            assert fixtures.make_config() == fixtures.make_config()
+            fixtures.create()
+            assert fixtures.processes['link_step'].has_data()
+        finally:
+            shutil.rmtree(root_path)
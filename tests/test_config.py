@@ -1,6 +1,8 @@
+import os
 import unittest
+import tempfile
 from brainy.utils import merge_dicts, load_yaml
-from brainy.config import merge_config
+from brainy.config import merge_config, ConfigCache
 from pprint import pprint
 
 
@@ -44,3 +46,46 @@ class BrainyConfigTest(unittest.TestCase):
         # pprint(result)
         assert result['sub_key']['points_to_list'] == ['foo', 'bar']
 
+
+    def test_config_cache(self):
+        '''
+        Test that merged config is built once and rebuilt only when one of
+        contributing files changes or appears.
+        '''
+        path = tempfile.mkdtemp()
+        foo_path = os.path.join(path, 'foo.yaml')
+        bar_path = os.path.join(path, 'bar.yaml')
+        with open(foo_path, 'w+') as stream:
+            stream.write(FOO)
+        builds = list()
+
+        def build():
+            builds.append(1)
+            config = load_yaml(open(foo_path).read())
+            if os.path.exists(bar_path):
+                config = merge_dicts(config, load_yaml(open(bar_path).read()))
+            return [foo_path, bar_path], config
+
+        cache = ConfigCache(os.path.join(path, 'cache'))
+        config = cache.load('foobar', build)
+        # Callers get their own copy.
+        config['a_key'] = 'changed'
+        assert cache.load('foobar', build)['a_key'] == 'value'
+        # Warm cache on disk is picked up by a fresh process.
+        assert ConfigCache(cache.cache_path).load('foobar', build)
+        assert len(builds) == 1
+        with open(bar_path, 'w+') as stream:
+            stream.write(BAR)
+        config = cache.load('foobar', build)
+        assert len(builds) == 2
+        assert config['some_key'] == 'value'
+        # Touched file is hashed once, since its content is the same.
+        stat = os.stat(bar_path)
+        os.utime(bar_path, (stat.st_atime, stat.st_mtime + 10))
+        hashed = list()
+        hash_file = cache.hash_file
+        cache.hash_file = lambda path: hashed.append(path) or hash_file(path)
+        cache.load('foobar', build)
+        cache.load('foobar', build)
+        assert len(builds) == 2
+        assert hashed == [bar_path]
@@ -0,0 +1,57 @@
+import os
+from brainy_tests import MockPipesManager, BrainyTest
+from brainy.metrics import metrics
+from brainy.utils import load_yaml, dump_yaml
+from brainy.project.base import BrainyProject
+from brainy.project.fingerprint import ProjectFingerprint, FINGERPRINT_NAME
+
+
+def bake_a_project():
+    return MockPipesManager('''
+{
+    "type": "CustomCode.CustomPipe",
+    "chain": [
+        {
+            "type": "CustomCode.BashCall",
+            "call": "echo 'I am a mock custom bash call'"
+        }
+    ]
+}
+    \n''').project
+
+
+class TestFingerprint(BrainyTest):
+
+    def test_skip_unchanged_runs(self):
+        '''Test fingerprint: runs on a state left by a no-op run are skipped'''
+        mock_project = bake_a_project()
+        project = BrainyProject(mock_project.name, mock_project.path)
+        # Runs are never skipped by default.
+        assert project.run()
+        assert project.run()
+        assert project.run()
+        assert project.run()
+        assert not os.path.exists(os.path.join(project.report_folder_path,
+                                               FINGERPRINT_NAME))
+        mock_project = bake_a_project()
+        config_path = os.path.join(mock_project.path, '.brainy')
+        config = load_yaml(open(config_path).read())
+        config['brainy']['skip_unchanged_runs'] = True
+        with open(config_path, 'w+') as stream:
+            stream.write(dump_yaml(config))
+        project = BrainyProject(mock_project.name, mock_project.path)
+        fingerprint = ProjectFingerprint(project.report_folder_path)
+        # Submit and complete the job. Both runs change the state.
+        assert project.run()
+        assert project.run()
+        assert fingerprint.load() is None
+        # Nothing left to do.
+        assert project.run()
+        assert fingerprint.load() is not None
+        skipped = metrics.get('brainy_project_runs_skipped_total')
+        assert project.run() is False
+        assert metrics.get('brainy_project_runs_skipped_total') == skipped + 1
+        # Any new flag makes the run worth doing again.
+        open(os.path.join(project.path, 'mock_test', 'other.submitted'),
+             'w+').close()
+        assert project.run()
@@ -0,0 +1,53 @@
+import os
+import tempfile
+from brainy_tests import BrainyTest
+from brainy.pipes.FileTools import LinkFiles, LinkMatcher
+
+
+def touch(*parts):
+    path = os.path.join(*parts)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w+').close()
+
+
+class TestLinking(BrainyTest):
+
+    def test_link_matcher(self):
+        '''Test linking: one matcher for fnmatch and regexp patterns'''
+        matcher = LinkMatcher({
+            'hardlink': ['/^.*_hard_linking$/', '*.mat'],
+            'symlink': ['test_sym_linking*', '*.mat'],
+        })
+        assert matcher.match('test_hard_linking') == 'hardlink'
+        assert matcher.match('test_sym_linking2') == 'symlink'
+        assert matcher.match('data.mat') == 'hardlink'
+        assert matcher.match('data.mat.old') is None
+        assert LinkMatcher({'symlink': ['*.png']}).match('a.mat') is None
+
+    def test_link_all(self):
+        '''Test linking: single walk links every type, then skips linked'''
+        parent = tempfile.mkdtemp()
+        # Sibling folders share a name prefix.
+        source_path = os.path.join(parent, 'data_of_linkfiles_old')
+        target_path = os.path.join(parent, 'data_of_linkfiles')
+        touch(source_path, 'test_hard_linking')
+        touch(source_path, 'test_sym_linking')
+        touch(source_path, 'nested', 'test_sym_linking2')
+        touch(source_path, 'unrelated')
+        file_patterns = {
+            'symlink': ['test_sym_linking*'],
+            'hardlink': ['/^.*_hard_linking$/'],
+        }
+        counts = LinkFiles.link_all(source_path, target_path, file_patterns,
+                                    recursively=True, workers=2)
+        assert counts == {'hardlink': 1, 'symlink': 2, 'existing': 0}
+        assert sorted(os.listdir(target_path)) == [
+            'test_hard_linking', 'test_sym_linking', 'test_sym_linking2']
+        for name in ('test_sym_linking', 'test_sym_linking2'):
+            link_path = os.path.join(target_path, name)
+            assert os.path.islink(link_path)
+            assert os.path.exists(link_path)
+        counts = LinkFiles.link_all(source_path, target_path, file_patterns,
+                                    recursively=True)
+        assert counts['existing'] == 3
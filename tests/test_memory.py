@@ -0,0 +1,25 @@
+from brainy_tests import BrainyTest
+from brainy.memory import MemoryMonitor, get_slope
+from brainy.metrics import metrics
+
+
+class LeakedObject(object):
+    pass
+
+
+class TestMemory(BrainyTest):
+
+    def test_memory_monitor(self):
+        '''Test memory: growth between ticks is found and warned about'''
+        monitor = MemoryMonitor(warn_rss_mb=1, use_tracemalloc=False)
+        monitor.check(1)
+        warnings = metrics.get('brainy_daemon_memory_warnings_total')
+        leaked = [LeakedObject() for index in range(10000)]
+        summary = monitor.check(2)
+        assert summary['growth'][0]['site'] == 'LeakedObject'
+        assert summary['growth'][0]['count_diff'] >= len(leaked)
+        assert metrics.get('brainy_daemon_rss_bytes') == summary['rss_bytes']
+        # Any daemon uses more than 1 MB.
+        assert metrics.get('brainy_daemon_memory_warnings_total') == \
+            warnings + 1
+        assert get_slope([(1, 10), (2, 20), (3, 30)]) == 10
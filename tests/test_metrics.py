@@ -0,0 +1,54 @@
+import urllib2
+from brainy_tests import MockPipesManager, BrainyTest
+from brainy.metrics import metrics, MetricsRegistry, MetricsServer
+from brainy.project.base import BrainyProject
+
+
+class TestMetrics(BrainyTest):
+
+    def test_render_histogram(self):
+        '''Test metrics: histograms are rendered with cumulative buckets'''
+        registry = MetricsRegistry()
+        registry.observe('brainy_project_run_seconds', 0.2, project='/a')
+        registry.observe('brainy_project_run_seconds', 2, project='/a')
+        registry.inc('brainy_errors_total', kind='known', error_type='oom')
+        text = registry.render()
+        assert '# TYPE brainy_project_run_seconds histogram' in text
+        assert 'brainy_project_run_seconds_bucket{project="/a",le="0.1"} 0' \
+            in text
+        assert 'brainy_project_run_seconds_bucket{project="/a",le="5"} 2' \
+            in text
+        assert 'brainy_project_run_seconds_bucket{project="/a",le="+Inf"} 2' \
+            in text
+        assert 'brainy_project_run_seconds_count{project="/a"} 2' in text
+        assert 'brainy_errors_total{error_type="oom",kind="known"} 1' in text
+
+    def test_scrape_metrics(self):
+        '''Test metrics: scrape counters of a project run over HTTP'''
+        mock_project = MockPipesManager('''
+{
+    "type": "CustomCode.CustomPipe",
+    "chain": [
+        {
+            "type": "CustomCode.BashCall",
+            "call": "echo 'I am a mock custom bash call'"
+        }
+    ]
+}
+    \n''').project
+        project = BrainyProject(mock_project.name, mock_project.path)
+        submitted = metrics.get('brainy_jobs_submitted_total')
+        project.run()
+        server = MetricsServer(0).start()
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%d/metrics' %
+                                       server.port)
+            assert response.info()['Content-Type'].startswith('text/plain')
+            text = response.read()
+        finally:
+            server.stop()
+        assert '# TYPE brainy_jobs_submitted_total counter' in text
+        assert 'brainy_jobs_submitted_total %d' % (submitted + 1) in text
+        assert 'brainy_project_run_seconds_count{project="%s"}' % \
+            project.path in text
+        assert 'brainy_scheduler_call_seconds_count{call="invoke"}' in text
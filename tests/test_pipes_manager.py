@@ -0,0 +1,68 @@
+import os
+import json
+from brainy_tests import BrainyTest
+from brainy.errors import BrainyProjectError
+from brainy.project.base import BrainyProject
+from test_fingerprint import bake_a_project
+
+
+def write_pipe(project_path, name, steps):
+    with open(os.path.join(project_path, name + '.br'), 'w+') as stream:
+        json.dump({
+            'type': 'CustomCode.CustomPipe',
+            'chain': [{
+                'type': 'CustomCode.BashCall',
+                'name': step,
+                'call': 'echo %s' % step,
+            } for step in steps],
+        }, stream)
+
+
+class TestPipesManager(BrainyTest):
+
+    def list_flags(self, project, pipename):
+        pipe_path = os.path.join(project.path, pipename)
+        if not os.path.exists(pipe_path):
+            return []
+        return sorted(name for name in os.listdir(pipe_path) if '.' in name)
+
+    def test_selective_run(self):
+        '''Test pipes manager: --only and --from respect dependencies'''
+        mock_project = bake_a_project()
+        os.unlink(os.path.join(mock_project.path, 'mock_test.br'))
+        write_pipe(mock_project.path, 'first', ['a', 'b'])
+        write_pipe(mock_project.path, 'second', ['c'])
+        with open(os.path.join(mock_project.path, 'sequence'), 'w+') as \
+                stream:
+            stream.write('first.br\nsecond.br\n')
+        project = BrainyProject(mock_project.name, mock_project.path)
+        self.assertRaises(BrainyProjectError, project.run, only=['third'])
+        self.assertRaises(BrainyProjectError, project.run, only=['first:d'])
+        # First pipe is not complete yet.
+        project.run(only=['second'])
+        assert self.list_flags(project, 'second') == []
+        # Unselected pipes are never loaded.
+        loaded = list()
+        load_pipeline = project.pipes.load_pipeline
+        project.pipes.load_pipeline = lambda filename: \
+            loaded.append(os.path.basename(filename)) or \
+            load_pipeline(filename)
+        project.pipes.select_pipelines(only=['second'])
+        assert loaded == ['second.br']
+        # Submit and complete a single step.
+        project.run(only=['first:a'])
+        project.run(only=['first:a'])
+        assert self.list_flags(project, 'first') == ['a.complete',
+                                                     'a.submitted']
+        project.run(from_pipe='first')
+        project.run(from_pipe='first')
+        assert self.list_flags(project, 'first') == [
+            'a.complete', 'a.submitted', 'b.complete', 'b.submitted']
+        assert self.list_flags(project, 'second') == ['c.submitted']
+        project.run(only=['second'])
+        assert self.list_flags(project, 'second') == ['c.complete',
+                                                      'c.submitted']
+        # Flag of the project is not completeness of the pipelines.
+        assert not project.pipes.is_complete
+        project.pipes.set_flag('complete')
+        assert project.pipes.is_complete
@@ -0,0 +1,183 @@
+import os
+import sys
+import tempfile
+from glob import glob
+from contextlib import contextmanager
+from brainy_tests import MockPipesManager, BrainyTest
+from brainy.utils import dump_yaml, load_yaml
+from brainy.project.manager import ProjectManager
+from brainy.project.schedule import ProjectSchedule
+from brainy.profiling import RunProfiler
+from brainy.metrics import metrics
+
+BRAINY_SHELL = '''#!/bin/bash
+# `brainy project run ...` of the source tree.
+exec "%(python)s" "%(program)s" -i "$2" -s "$1" "${@:3}"
+'''
+
+
+def bake_a_project():
+    return MockPipesManager('''
+{
+    "type": "CustomCode.CustomPipe",
+    "chain": [
+        {
+            "type": "CustomCode.BashCall",
+            "call": "echo 'I am a mock custom bash call'"
+        }
+    ]
+}
+    \n''').project
+
+
+def register_projects(projects):
+    project_list_path = os.path.join(tempfile.mkdtemp(), 'project_list.yaml')
+    with open(project_list_path, 'w+') as stream:
+        stream.write(dump_yaml({'registered_projects': [
+            {'path': project.path} for project in projects]}))
+    return project_list_path
+
+
+def count_reports(project):
+    return len(glob(os.path.join(project.report_folder_path,
+                                 '*-report-*.yaml')))
+
+
+@contextmanager
+def brainy_shell():
+    '''Put `brainy` of the source tree on the PATH of subprocess runs.'''
+    bin_path = tempfile.mkdtemp()
+    with open(os.path.join(bin_path, 'brainy'), 'w+') as stream:
+        stream.write(BRAINY_SHELL % {
+            'python': sys.executable,
+            'program': os.path.join(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))), 'bin', 'brainy-project'),
+        })
+    os.chmod(os.path.join(bin_path, 'brainy'), 0755)
+    old_path = os.environ['PATH']
+    os.environ['PATH'] = bin_path + os.pathsep + old_path
+    try:
+        yield
+    finally:
+        os.environ['PATH'] = old_path
+
+
+class TestProjectManager(BrainyTest):
+
+    def test_run_projects_in_process(self):
+        '''Test project manager: projects run concurrently in-process'''
+        projects = [bake_a_project() for index in range(3)]
+        manager = ProjectManager(register_projects(projects))
+        manager.run_projects(in_process=True, workers=2, timeout=60)
+        for project in projects:
+            reports = glob(os.path.join(project.report_folder_path,
+                                        '*-report-*.yaml'))
+            assert len(reports) == 1
+            report = load_yaml(open(reports[0]).read())
+            # Every run has its own report and log.
+            pipes = report['project']['pipes']
+            assert len(pipes) == 1
+            assert pipes[0]['processes'][0]['messages'][0]['message'] == \
+                'Submitting new job'
+            assert not [line for line in report['log']
+                        if isinstance(line, basestring) and
+                        any(other.path in line for other in projects
+                            if other is not project)]
+        assert manager._running == {}
+
+    def test_run_projects_in_subprocesses(self):
+        '''Test project manager: metrics of subprocess runs reach daemon'''
+        project = bake_a_project()
+        manager = ProjectManager(register_projects([project]))
+        runs = metrics.get('brainy_project_runs_total')
+        submitted = metrics.get('brainy_jobs_submitted_total')
+        with brainy_shell():
+            manager.run_projects(in_process=False)
+        assert count_reports(project) == 1
+        assert metrics.get('brainy_project_runs_total') == runs + 1
+        assert metrics.get('brainy_jobs_submitted_total') == submitted + 1
+        # Runs are timed by the daemon.
+        assert metrics.get('brainy_project_run_seconds',
+                           project=project.path) == 1
+        assert metrics.get('brainy_fs_calls_total', call='exists') > 0
+
+    def test_exiting_project_in_process(self):
+        '''Test project manager: project calling exit() does not hang'''
+        from brainy.project.base import BrainyProject
+        project = bake_a_project()
+        manager = ProjectManager(register_projects([project]))
+        run = BrainyProject.run
+        BrainyProject.run = lambda self, **kwds: exit()
+        try:
+            manager.run_projects(in_process=True, timeout=0)
+        finally:
+            BrainyProject.run = run
+        assert manager._running == {}
+        assert count_reports(project) == 0
+
+    def test_profiled_runs(self):
+        '''Test project manager: profiles of runs are saved and rotated'''
+        project = bake_a_project()
+        manager = ProjectManager(register_projects([project]))
+        manager.run_projects(in_process=True, profile_waits=True)
+        profiles_path = os.path.join(project.report_folder_path, 'profiles')
+        profiles = sorted(os.listdir(profiles_path))
+        assert [os.path.splitext(name)[1] for name in profiles] == \
+            ['.pstats', '.txt']
+        summary = open(os.path.join(profiles_path, profiles[1])).read()
+        assert 'Waiting for the scheduler and subprocesses' in summary
+        profiler = RunProfiler(profiles_path, keep_last=1)
+        assert profiler.profile('other', lambda: 42) == 42
+        assert len(os.listdir(profiles_path)) == 2
+        assert os.path.basename(profiler.list_profiles()[0]).startswith(
+            'other-profile-')
+
+    def test_adaptive_polling(self):
+        '''Test project manager: idle projects back off, changed snap back'''
+        project = bake_a_project()
+        schedule_path = os.path.join(tempfile.mkdtemp(), 'schedule.yaml')
+        schedule = ProjectSchedule(schedule_path, min_interval=60)
+        manager = ProjectManager(register_projects([project]),
+                                 schedule=schedule)
+        # The first run submits the job.
+        manager.run_projects(in_process=True)
+        assert count_reports(project) == 1
+        assert not schedule.entries[project.path]['is_complete']
+        # Nothing has changed and the interval has not passed yet.
+        assert schedule.select_due([project.path]) == set()
+        # Changed projects (see brainy.watcher) are run regardless.
+        manager.run_projects(in_process=True, only_paths=[project.path])
+        # Complete project is not run until it changes.
+        assert schedule.entries[project.path]['is_complete']
+        assert schedule.select_due([project.path]) == set()
+        # Idle runs back off exponentially.
+        schedule.record_run(project.path, is_complete=True)
+        assert schedule.entries[project.path]['interval'] == 120
+        schedule.save()
+        # Schedule survives restarts.
+        schedule = ProjectSchedule(schedule_path, min_interval=60)
+        assert schedule.entries[project.path]['interval'] == 120
+        manager.schedule = schedule
+        # A new flag snaps polling back.
+        output_path = os.path.join(project.path, 'mock_test')
+        open(os.path.join(output_path, 'other.submitted'), 'w+').close()
+        assert schedule.select_due([project.path]) == set([project.path])
+        manager.run_projects(in_process=True)
+        assert schedule.entries[project.path]['interval'] == 60
+
+    def test_adaptive_polling_in_subprocesses(self):
+        '''Test project manager: completeness of subprocess runs is known'''
+        project = bake_a_project()
+        schedule = ProjectSchedule(
+            os.path.join(tempfile.mkdtemp(), 'schedule.yaml'),
+            min_interval=60)
+        manager = ProjectManager(register_projects([project]),
+                                 schedule=schedule)
+        with brainy_shell():
+            manager.run_projects(in_process=False)
+            assert not schedule.entries[project.path]['is_complete']
+            manager.run_projects(in_process=False,
+                                 only_paths=[project.path])
+        # Complete project is not run until it changes.
+        assert schedule.entries[project.path]['is_complete']
+        assert schedule.select_due([project.path]) == set()
@@ -0,0 +1,244 @@
+import os
+import gzip
+import json
+import zipfile
+import tempfile
+from glob import glob
+from contextlib import closing
+from brainy_tests import MockPipesManager, BrainyTest
+from brainy.utils import load_yaml
+from brainy.project.report import BrainyReporter, iter_report_events
+from brainy.project.reportdb import ReportDatabase
+from brainy.metrics import metrics
+
+
+def bake_a_reporting_pipe():
+    return MockPipesManager('''
+{
+    "type": "CustomCode.CustomPipe",
+    "chain": [
+        {
+            "type": "CustomCode.BashCall",
+            "call": "echo 'I am a mock custom bash call'"
+        }
+    ]
+}
+    \n''')
+
+
+class TestReports(BrainyTest):
+
+    def test_streaming_report(self):
+        '''Test reports: events are streamed as JSON lines and materialized'''
+        pipes = bake_a_reporting_pipe()
+        pipes.config['reports']['backend'] = 'jsonl'
+        pipes.process_pipelines()
+        reports_path = pipes.project.report_folder_path
+        streamed = glob(os.path.join(reports_path, '*-report-*.jsonl'))
+        assert len(streamed) == 1
+        events = [event['event'] for event in iter_report_events(streamed[0])]
+        assert events == ['start', 'pipe', 'process', 'message', 'finish']
+        # YAML layout for the web UI is materialized next to the stream.
+        materialized = streamed[0].replace('.jsonl', '.yaml')
+        report = load_yaml(open(materialized).read())
+        pipe = report['project']['pipes'][0]
+        assert pipe['name'] == 'mock_test'
+        assert pipe['processes'][0]['name'] == 'bashcall'
+        assert pipe['processes'][0]['messages'][0]['message'] == \
+            'Submitting new job'
+        assert 'finished_at' in report
+
+    def test_streaming_log(self):
+        '''Test reports: older log records are streamed as events'''
+        pipes = bake_a_reporting_pipe()
+        pipes.config['reports']['backend'] = 'jsonl'
+        # Half a KB.
+        pipes.config['reports']['log_max_mb'] = 0.0005
+        pipes.process_pipelines()
+        reports_path = pipes.project.report_folder_path
+        stream_filepath = glob(os.path.join(reports_path,
+                                            '*-report-*.jsonl'))[0]
+        events = list(iter_report_events(stream_filepath))
+        streamed = [event['record'] for event in events
+                    if event['event'] == 'log']
+        finish = events[-1]
+        assert finish['event'] == 'finish'
+        assert streamed and finish['log']
+        assert sum(len(record) for record in finish['log']) <= 512
+        # Materialized report has the whole log in order.
+        report = load_yaml(open(stream_filepath.replace(
+            '.jsonl', '.yaml')).read())
+        assert report['log'] == streamed + finish['log']
+
+    def test_reports_compaction(self):
+        '''Test reports: only last reports are kept, others are archived'''
+        reports_path = tempfile.mkdtemp()
+        timestamps = ['2015_01_01_100000', '2015_01_01_110000',
+                      '2015_01_02_100000', '2015_01_02_110000']
+        database = ReportDatabase.for_reports_folder(reports_path)
+        for timestamp in timestamps:
+            report_filepath = os.path.join(
+                reports_path, 'demo-report-%s.yaml' % timestamp)
+            open(report_filepath, 'w+').close()
+            BrainyReporter.register_report(reports_path, report_filepath)
+            database.index_report('demo', report_filepath, [])
+        assert BrainyReporter.compact_reports(reports_path, keep_last=1) == 3
+        # Indexed runs point into the archives.
+        with closing(database.connect()) as connection:
+            indexed = sorted(row['report_path'] for row in connection.execute(
+                'SELECT report_path FROM runs'))
+        assert indexed == [
+            os.path.join(reports_path, 'archive', 'reports-2015_01_01.zip',
+                         'demo-report-2015_01_01_100000.yaml'),
+            os.path.join(reports_path, 'archive', 'reports-2015_01_01.zip',
+                         'demo-report-2015_01_01_110000.yaml'),
+            os.path.join(reports_path, 'archive', 'reports-2015_01_02.zip',
+                         'demo-report-2015_01_02_100000.yaml'),
+            os.path.join(reports_path, 'demo-report-2015_01_02_110000.yaml')]
+        report_list = BrainyReporter.list_reports(reports_path)
+        assert [os.path.basename(path) for path in report_list] == \
+            ['demo-report-2015_01_02_110000.yaml']
+        archives = sorted(os.listdir(os.path.join(reports_path, 'archive')))
+        assert archives == ['reports-2015_01_01.zip', 'reports-2015_01_02.zip']
+        archive = zipfile.ZipFile(
+            os.path.join(reports_path, 'archive', archives[0]))
+        assert len(archive.namelist()) == 2
+        # Listing for the web UI is regenerated once and then deferred.
+        BrainyReporter.update_or_generate_static_html(reports_path,
+                                                      deferred_interval=60)
+        listing = load_yaml(open(os.path.join(reports_path, 'html',
+                                              'reports.yaml')).read())
+        assert listing['reports_list'] == report_list
+        assert not BrainyReporter.index_is_dirty(reports_path)
+        assert os.path.islink(os.path.join(reports_path, 'html', 'assets'))
+        BrainyReporter.register_report(reports_path, report_list[0] + '.new')
+        BrainyReporter.update_or_generate_static_html(reports_path,
+                                                      deferred_interval=60)
+        assert BrainyReporter.index_is_dirty(reports_path)
+
+    def test_streamed_reports_listing(self):
+        '''Test reports: reports kept only as JSON lines are compacted'''
+        reports_path = tempfile.mkdtemp()
+        for name in ('demo-report-2015_01_01_100000.jsonl',
+                     'demo-report-2015_01_02_100000.jsonl',
+                     'demo-report-2015_01_02_100000.yaml',
+                     'demo-report-2015_01_03_100000.yaml'):
+            open(os.path.join(reports_path, name), 'w+').close()
+        # Index is bootstrapped by globbing.
+        report_list = BrainyReporter.list_reports(reports_path)
+        assert [os.path.basename(path) for path in report_list] == [
+            'demo-report-2015_01_01_100000.jsonl',
+            'demo-report-2015_01_02_100000.yaml',
+            'demo-report-2015_01_03_100000.yaml']
+        assert BrainyReporter.compact_reports(reports_path, keep_last=1) == 2
+        assert sorted(os.listdir(os.path.join(reports_path, 'archive'))) == \
+            ['reports-2015_01_01.zip', 'reports-2015_01_02.zip']
+        # A run that does not materialize YAML still registers its report.
+        pipes = bake_a_reporting_pipe()
+        pipes.config['reports']['backend'] = 'jsonl'
+        pipes.config['reports']['materialize_yaml'] = False
+        pipes.process_pipelines()
+        report_list = BrainyReporter.list_reports(
+            pipes.project.report_folder_path)
+        assert len(report_list) == 1
+        assert report_list[0].endswith('.jsonl')
+
+    def test_sqlite_index(self):
+        '''Test reports: messages are indexed into SQLite and queried'''
+        pipes = bake_a_reporting_pipe()
+        pipes.process_pipelines()
+        database = ReportDatabase.for_reports_folder(
+            pipes.project.report_folder_path)
+        messages = database.query(since='1d', type='info',
+                                  project='mock_project')
+        assert len(messages) == 1
+        assert messages[0]['pipe'] == 'mock_test'
+        assert messages[0]['step'] == 'bashcall'
+        assert messages[0]['message'] == 'Submitting new job'
+        assert database.query(error_type='out_of_memory') == []
+        self.assertRaises(KeyError, database.query, output='anything')
+
+    def test_step_timings(self):
+        '''Test reports: phases of steps are timed into report and CSV'''
+        pipes = bake_a_reporting_pipe()
+        pipes.config['reports']['timings'] = True
+        pipes.config['reports']['timings_dump'] = 'csv'
+        pipes.process_pipelines()
+        reports_path = pipes.project.report_folder_path
+        report_filepath = glob(os.path.join(reports_path,
+                                            '*-report-*.yaml'))[0]
+        report = load_yaml(open(report_filepath).read())
+        phases = dict((timing['phase'], timing)
+                      for timing in report['timings']['steps'])
+        assert phases['submit']['pipe'] == 'mock_test'
+        assert phases['submit']['step'] == 'bashcall'
+        assert phases['submit_job']['count'] == 1
+        assert 'working_jobs_count' in phases
+        assert [timing['pipe'] for timing in report['timings']['pipes']] == \
+            ['mock_test'] * len(report['timings']['pipes'])
+        dump_filepath = report_filepath.replace('.yaml', '.timings.csv')
+        lines = open(dump_filepath).read().splitlines()
+        assert lines[0] == 'pipe,step,phase,count,total_seconds,max_seconds'
+        assert len(lines) == len(phases) + 1
+
+    def test_fs_calls_accounting(self):
+        '''Test reports: filesystem calls and spawns are counted per step'''
+        pipes = bake_a_reporting_pipe()
+        spawns_before = metrics.get('brainy_subprocess_spawns_total',
+                                    command='invoke')
+        pipes.process_pipelines()
+        report_filepath = glob(os.path.join(pipes.project.report_folder_path,
+                                            '*-report-*.yaml'))[0]
+        fs_calls = load_yaml(open(report_filepath).read())['fs_calls']
+        assert fs_calls['totals']['fs']['exists'] > 0
+        assert fs_calls['totals']['spawn']['invoke'] == 1
+        counts = dict(((call['step'], call['name']), call['count'])
+                      for call in fs_calls['steps'])
+        assert counts[('bashcall', 'invoke')] == 1
+        # Flags are set by `touch`.
+        assert counts[('bashcall', 'touch')] == 1
+        assert counts[('bashcall', 'exists')] > 0
+        assert metrics.get('brainy_subprocess_spawns_total',
+                           command='invoke') == spawns_before + 1
+
+    def test_log_spill(self):
+        '''Test reports: log beyond the memory cap is spilled to disk'''
+        pipes = bake_a_reporting_pipe()
+        # Half a KB.
+        pipes.config['reports']['log_max_mb'] = 0.0005
+        pipes.process_pipelines()
+        reports_path = pipes.project.report_folder_path
+        report_filepath = glob(os.path.join(reports_path,
+                                            '*-report-*.yaml'))[0]
+        report = load_yaml(open(report_filepath).read())
+        assert sum(len(record) for record in report['log']) <= 512
+        spill_filepath = os.path.join(reports_path,
+                                      report['log_spill']['filepath'])
+        assert spill_filepath == report_filepath.replace('.yaml',
+                                                         '.log.jsonl.gz')
+        spilled = [json.loads(line) for line in gzip.open(spill_filepath)]
+        assert len(spilled) == report['log_spill']['records']
+        # The newest records are kept in memory.
+        assert spilled and report['log']
+
+    def test_trace_export(self):
+        '''Test reports: run is exported as Chrome trace events'''
+        pipes = bake_a_reporting_pipe()
+        pipes.config['reports']['trace'] = True
+        pipes.process_pipelines()
+        reports_path = pipes.project.report_folder_path
+        traces = glob(os.path.join(reports_path, '*-report-*.trace.json'))
+        assert len(traces) == 1
+        events = json.load(open(traces[0]))['traceEvents']
+        spans = dict((event['name'], event) for event in events
+                     if event['ph'] == 'X')
+        assert spans['mock_test']['cat'] == 'pipe'
+        assert spans['mock_test-bashcall']['args']['step'] == 'bashcall'
+        assert spans['want_to_submit']['args']['result'] is True
+        assert spans['invoke']['cat'] == 'subprocess'
+        # Step is nested in its pipe.
+        assert spans['mock_test']['ts'] <= spans['mock_test-bashcall']['ts']
+        # Timings were not asked for.
+        report = load_yaml(open(traces[0].replace('.trace.json',
+                                                  '.yaml')).read())
+        assert 'timings' not in report
@@ -1,8 +1,14 @@
 import os
 import re
+import shutil
+import tempfile
 from brainy_tests import BrainyTest
 from brainy.scheduler import BrainyScheduler
 from brainy.scheduler.lsf import NoLsfSchedulerFound, Lsf
+from brainy.scheduler.snapshot import (SchedulerSnapshot,
+                                       SCHEDULER_SNAPSHOT_ENV)
+from brainy.scheduler.fakelsf import FakeLsf
+from brainy.errors import check_report_file_for_errors, TermRunLimitError
 
 
 MOCK_BJOBS_FILEPATH = os.path.join(
@@ -16,7 +22,10 @@ class GrayBoxedLsf(Lsf):
     Modify Lsf() to suite the testing needs.
     '''
 
+    bjobs_calls = 0
+
     def mocked_bjobs(self, *args, **kwds):
+        GrayBoxedLsf.bjobs_calls += 1
         return open(MOCK_BJOBS_FILEPATH).read()
 
     def mocked_empty_bjobs(self, *args, **kwds):
@@ -35,3 +44,97 @@ class TestCustomCode(BrainyTest):
         assert scheduler.count_working_jobs(None) > 0
         key = 'Data__Users__Markus__AntioxScreen'
         assert scheduler.count_working_jobs(key) > 0
+
+    def test_lsf_snapshot(self):
+        '''Test scheduler: a single snapshot serves every project'''
+        project_path = '/BIOL/sonas/biol_uzh_pelkmans_s4/Data/Users/Markus/' \
+            'AntioxScreen'
+        other_path = '/BIOL/sonas/biol_uzh_pelkmans_s4/Data/Users/Nobody'
+        calls = GrayBoxedLsf.bjobs_calls
+        snapshot = GrayBoxedLsf().take_snapshot()
+        index = snapshot.index_projects([project_path, other_path])
+        assert len(index[project_path]) == 3
+        assert index[other_path] == []
+        # Schedulers of project runs never call bjobs themselves.
+        scheduler = GrayBoxedLsf(snapshot=snapshot.for_project(project_path))
+        assert scheduler.count_working_jobs(project_path) > 0
+        assert scheduler.get_job_states(project_path) == [
+            ('59458315', 'DONE'), ('59460810', 'PEND'), ('59460822', 'RUN')]
+        scheduler = GrayBoxedLsf(snapshot=snapshot.for_project(other_path))
+        assert scheduler.count_working_jobs(other_path) == 0
+        assert GrayBoxedLsf.bjobs_calls == calls + 1
+        # Subprocess runs read the snapshot from a file until it expires.
+        snapshot_path = snapshot.save(os.path.join(tempfile.mkdtemp(),
+                                                   'lsf.snapshot'))
+        assert SchedulerSnapshot.load(snapshot_path).lines == snapshot.lines
+        assert SchedulerSnapshot.load(snapshot_path, ttl=-1) is None
+        os.environ[SCHEDULER_SNAPSHOT_ENV] = snapshot_path
+        try:
+            scheduler = BrainyScheduler.build_scheduler('lsf')
+            assert scheduler.snapshot.lines == snapshot.lines
+            scheduler = BrainyScheduler.build_scheduler('shellcmd')
+            assert scheduler.list_jobs([]) == []
+        finally:
+            del os.environ[SCHEDULER_SNAPSHOT_ENV]
+
+    def test_snapshot_paths(self):
+        '''Test scheduler: snapshot matches normalized and resolved paths'''
+        root_path = tempfile.mkdtemp()
+        project_path = os.path.join(root_path, 'data', 'project')
+        os.makedirs(project_path)
+        link_path = os.path.join(root_path, 'link')
+        os.symlink(os.path.join(root_path, 'data'), link_path)
+        lines = [
+            '1 user RUN normal host host %s/job_reports_of_a/a.out' %
+            project_path,
+            '2 user PEND normal host host %s/project/b.job_report' %
+            link_path,
+            '3 user RUN normal host host /elsewhere/c.job_report',
+        ]
+        snapshot = SchedulerSnapshot('lsf', lines)
+        index = snapshot.index_projects([project_path + '/'])
+        assert index[project_path + '/'] == lines[:2]
+        # Project may be asked for by any of its paths.
+        for path in (project_path, project_path + '/',
+                     os.path.join(link_path, 'project')):
+            assert snapshot.for_project(path).lines == lines[:2]
+        # Unknown projects query the scheduler by themselves.
+        assert snapshot.for_project('/elsewhere') is None
+        shutil.rmtree(root_path)
+
+    def test_fake_lsf(self):
+        '''Test scheduler: Lsf runs jobs by the fake LSF toolchain'''
+        root_path = tempfile.mkdtemp()
+        # A minute of the run limit takes 10 ms.
+        fake_lsf = FakeLsf(root_path, slots=1, runlimit_scale=0.01)
+        fake_lsf.install()
+        try:
+            reports = [os.path.join(root_path, name + '.job_report')
+                       for name in ('done', 'runlimit', 'killed')]
+            Lsf().submit_job('echo hello', '8:00', reports[0])
+            Lsf().submit_job('sleep 30', '1:00', reports[1])
+            Lsf().submit_job('sleep 30', '8:00', reports[2])
+            scheduler = Lsf()
+            # A single slot is busy with the first two jobs in turn.
+            assert scheduler.count_working_jobs() >= 2
+            assert ('3', 'PEND') in scheduler.get_job_states()
+            scheduler.bkill('3')
+            assert fake_lsf.wait(timeout=10)
+            assert Lsf().get_job_states() == [
+                ('1', 'DONE'), ('2', 'EXIT'), ('3', 'EXIT')]
+            report = open(reports[0]).read()
+            assert 'Successfully completed.' in report
+            assert 'hello' in report
+            check_report_file_for_errors(reports[0])
+            self.assertRaises(TermRunLimitError,
+                              check_report_file_for_errors, reports[1])
+            assert not os.path.exists(reports[2])
+            # Reset fake LSF starts over.
+            fake_lsf.reset()
+            assert fake_lsf.list_jobs() == []
+            Lsf().submit_job('echo hello', '8:00', reports[0])
+            assert [job['id'] for job in fake_lsf.list_jobs()] == [1]
+            assert fake_lsf.wait(timeout=10)
+        finally:
+            fake_lsf.uninstall()
+            shutil.rmtree(root_path)
@@ -0,0 +1,85 @@
+import os
+import time
+import tempfile
+from brainy_tests import BrainyTest
+from brainy.trash import TrashBin
+
+
+def make_output_tree(path, folders=3, files=5):
+    for folder_index in range(folders):
+        folder_path = os.path.join(path, 'folder_%d' % folder_index)
+        os.makedirs(folder_path)
+        for file_index in range(files):
+            open(os.path.join(folder_path, 'file_%d' % file_index),
+                 'w+').close()
+    os.symlink(os.path.join(path, 'folder_0'), os.path.join(path, 'link'))
+
+
+class TestTrash(BrainyTest):
+
+    def test_discard_and_sweep(self):
+        '''Test trash: discarded output is gone at once and swept later'''
+        project_path = tempfile.mkdtemp()
+        output_path = os.path.join(project_path, 'pipe_output')
+        make_output_tree(output_path)
+        trash = TrashBin.for_project(project_path)
+        trashed_path = trash.discard(output_path)
+        # Project is immediately reusable.
+        assert not os.path.exists(output_path)
+        assert os.path.exists(trashed_path)
+        os.makedirs(output_path)
+        make_output_tree(output_path)
+        trash.discard(output_path)
+        assert len(trash.list_items()) == 2
+        # Sweeping removes 2 x (3 folders + 15 files + link + output folder)
+        # plus bucket folders.
+        removed = trash.sweep(workers=3)
+        assert removed == 2 * (3 + 15 + 1 + 1) + 2
+        assert not trash.has_items()
+        assert not os.path.exists(trash.pid_path)
+
+    def test_resume_sweeping(self):
+        '''Test trash: sweeping tolerates a stale pid of interrupted sweeper'''
+        project_path = tempfile.mkdtemp()
+        output_path = os.path.join(project_path, 'pipe_output')
+        make_output_tree(output_path)
+        trash = TrashBin.for_project(project_path)
+        trash.discard(output_path)
+        # Simulate a sweeper that was killed half way.
+        with open(trash.pid_path, 'w+') as pid_file:
+            pid_file.write('999999999')
+        assert not trash.is_being_swept()
+        trash.sweep()
+        assert not trash.has_items()
+
+    def test_exclusive_sweeping(self):
+        '''Test trash: only one sweeper can hold the lock'''
+        project_path = tempfile.mkdtemp()
+        output_path = os.path.join(project_path, 'pipe_output')
+        make_output_tree(output_path)
+        trash = TrashBin.for_project(project_path)
+        trash.discard(output_path)
+        pid_file = trash.lock()
+        assert pid_file is not None
+        assert trash.lock() is None
+        assert trash.sweep() == 0
+        assert trash.has_items()
+        pid_file.close()
+        assert trash.sweep() > 0
+        assert not trash.has_items()
+
+    def test_background_sweeping(self):
+        '''Test trash: background sweeper logs next to the trash'''
+        project_path = tempfile.mkdtemp()
+        output_path = os.path.join(project_path, 'pipe_output')
+        make_output_tree(output_path)
+        trash = TrashBin.for_project(project_path)
+        trash.discard(output_path)
+        assert trash.sweep_in_background(workers=2)
+        deadline = time.time() + 30
+        while (trash.has_items() or os.path.exists(trash.pid_path)) and \
+                time.time() < deadline:
+            time.sleep(0.1)
+        assert not trash.has_items()
+        # Log is never swept.
+        assert 'Sweeping 4 item(s) from trash' in open(trash.log_path).read()
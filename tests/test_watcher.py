@@ -0,0 +1,114 @@
+import os
+import tempfile
+from brainy_tests import BrainyTest
+from brainy.watcher import (PollingWatcher, InotifyWatcher, pyinotify,
+                            build_watcher, get_filesystem_type,
+                            is_local_filesystem)
+from brainy.fs import accounting as fs_accounting, FS_CALL
+from brainy.project.base import BrainyProject
+from brainy.project.watch import ProjectWatch
+from test_fingerprint import bake_a_project
+
+
+def make_project():
+    project_path = tempfile.mkdtemp()
+    open(os.path.join(project_path, 'demo.br'), 'w+').close()
+    os.makedirs(os.path.join(project_path, 'demo', 'job_reports_of_step'))
+    os.makedirs(os.path.join(project_path, 'reports'))
+    os.makedirs(os.path.join(project_path, 'images'))
+    return project_path
+
+
+def touch(*parts):
+    open(os.path.join(*parts), 'w+').close()
+
+
+class TestWatcher(BrainyTest):
+
+    def check_watcher(self, watcher):
+        first_project = make_project()
+        second_project = make_project()
+        watcher.watch([first_project, second_project])
+        assert watcher.wait(0) == set()
+        # Reports are written by brainy itself.
+        touch(first_project, 'reports', 'demo-report.yaml')
+        assert watcher.wait(0.1) == set()
+        # Folders of no pipe (e.g. images) are never looked into.
+        touch(first_project, 'images', 'image.png')
+        assert watcher.wait(0.1) == set()
+        # A finished job leaves its report.
+        touch(first_project, 'demo', 'job_reports_of_step', 'step.job.out')
+        assert watcher.wait(5) == set([first_project])
+        watcher.rebase([first_project])
+        # Changes made while the project is being run are not lost.
+        touch(first_project, 'demo', 'step.submitted')
+        assert watcher.wait(5) == set([first_project])
+        watcher.rebase([first_project])
+        # Flags are set in the pipe output folder.
+        touch(second_project, 'demo', 'step.complete')
+        assert watcher.wait(5) == set([second_project])
+        watcher.rebase([second_project])
+        # New pipes are watched too.
+        touch(second_project, 'other.br')
+        assert watcher.wait(5) == set([second_project])
+        watcher.rebase([second_project])
+        os.makedirs(os.path.join(second_project, 'other'))
+        assert watcher.wait(5) == set([second_project])
+        watcher.rebase([second_project])
+        touch(second_project, 'other', 'step.submitted')
+        assert watcher.wait(5) == set([second_project])
+        watcher.close()
+
+    def test_polling_watcher(self):
+        '''Test watcher: polling notices changes of flags and job reports'''
+        # Changes must be visible in mtimes of the folders.
+        self.check_watcher(PollingWatcher(poll_interval=0.05))
+        # Polls are accounted as filesystem calls of brainy.
+        fs_accounting.start()
+        PollingWatcher.take_snapshot(make_project())
+        totals = fs_accounting.summarize()['totals'][FS_CALL]
+        assert totals['stat'] > 0 and totals['lstat'] > 0
+
+    def test_inotify_watcher(self):
+        '''Test watcher: inotify notices changes of flags and job reports'''
+        if pyinotify is None:
+            return
+        self.check_watcher(InotifyWatcher())
+
+    def test_auto_watch_mode(self):
+        '''Test watcher: projects on network filesystems are polled'''
+        mounts_path = os.path.join(tempfile.mkdtemp(), 'mounts')
+        with open(mounts_path, 'w+') as stream:
+            stream.write('/dev/sda1 / ext4 rw 0 0\n'
+                         'filer:/export /data nfs4 rw 0 0\n'
+                         'tmpfs /data/local\\040disk tmpfs rw 0 0\n')
+        assert get_filesystem_type('/home/user', mounts_path) == 'ext4'
+        assert get_filesystem_type('/data/project', mounts_path) == 'nfs4'
+        assert get_filesystem_type('/database', mounts_path) == 'ext4'
+        assert is_local_filesystem('/data/local disk/project', mounts_path)
+        assert not is_local_filesystem('/data', mounts_path)
+        assert not is_local_filesystem('/data', '/no/such/mounts')
+        # Without known local projects, auto falls back to polling.
+        assert isinstance(build_watcher('auto'), PollingWatcher)
+        project_path = make_project()
+        if pyinotify is not None and is_local_filesystem(project_path):
+            watcher = build_watcher('auto', project_paths=[project_path])
+            assert isinstance(watcher, InotifyWatcher)
+            watcher.close()
+
+    def test_project_watch(self):
+        '''Test watcher: watched project keeps parsed pipes until .br changes'''
+        mock_project = bake_a_project()
+        project = BrainyProject(mock_project.name, mock_project.path)
+        # Never idle, so that every tick runs the project.
+        watch = ProjectWatch(project, PollingWatcher(poll_interval=0.05),
+                             max_idle_interval=0)
+        watch.run(max_ticks=1)
+        pipes = project.pipes
+        assert pipes is not None
+        watch.run(max_ticks=2)
+        assert project.pipes is pipes
+        with open(os.path.join(project.path, 'mock_test.br'), 'a') as stream:
+            stream.write('\n')
+        watch.run(max_ticks=3)
+        assert project.pipes is not pipes